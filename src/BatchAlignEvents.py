@@ -0,0 +1,207 @@
+"""""""""""""""
+This file aligns the EEG data and gaze tracking events of every session in a study in one go, with `align_eeg_events.py`.
+Sessions are either listed in a manifest CSV, with the columns `participant`, `eeg` and `events` (and optionally
+`session` and `output`, with paths relative to the manifest), or found in a directory layout like:
+
+    root/
+        <participant>/
+            eeg.csv
+            events.csv
+        <participant>/
+            <session>/
+                eeg.csv
+                events.csv
+
+where any directory containing both files is a session, and its participant is the first directory under `root`.
+
+Sessions are aligned in parallel worker processes, and each one's output is written next to its events file, with the
+frequency bands and electrode channels it was aligned with in `<output>.settings.json`. Sessions whose output is newer
+than both of their inputs and was aligned with the same settings are skipped. Finally, every session's output is combined
+into one dataset keyed by `participant` (and `session`), which `helpers.merge_and_filter_participants()` can use
+directly, and a summary table of the sessions is printed and written next to it.
+"""""""""""""""
+
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import align_eeg_events as AE
+
+EEG_FILENAME = 'eeg.csv'
+EVENTS_FILENAME = 'events.csv'
+ALIGNED_FILENAME = 'eeg_events'
+COMBINED_FILENAME = 'aligned_sessions'
+SUMMARY_FILENAME = 'aligned_sessions_summary.csv'
+SETTINGS_SUFFIX = '.settings.json'
+EXTENSIONS = {'csv':'.csv', 'parquet':'.parquet', 'feather':'.feather', 'npy':''}
+
+# Returns the sessions of a directory layout, as a Dataframe with the same columns as a manifest
+def FindSessions(root_dir:str, eeg_filename:str = EEG_FILENAME, events_filename:str = EVENTS_FILENAME):
+    rows = []
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames.sort()
+        if eeg_filename in filenames and events_filename in filenames:
+            session = os.path.relpath(dirpath, root_dir)
+            session = os.path.basename(os.path.abspath(root_dir)) if session == '.' else session.replace(os.sep, '/')
+            rows.append({
+                'participant':session.split('/')[0],
+                'session':session,
+                'eeg':os.path.join(dirpath, eeg_filename),
+                'events':os.path.join(dirpath, events_filename)})
+    sessions = pd.DataFrame(rows, columns=['participant', 'session', 'eeg', 'events'])
+    # Participant directories like `01`, `02` are numbered, and are kept as numbers to match a participants table
+    if len(sessions) > 0 and sessions['participant'].str.isdigit().all():
+        sessions['participant'] = sessions['participant'].astype(int)
+    return sessions
+
+# Reads a manifest of sessions. Relative paths are relative to the manifest's directory.
+def ReadManifest(manifest_filepath:str):
+    sessions = pd.read_csv(manifest_filepath)
+    missing = [c for c in ['participant', 'eeg', 'events'] if c not in sessions.columns]
+    if len(missing) > 0:
+        raise ValueError(f"The manifest {manifest_filepath} is missing the columns {missing}")
+    root_dir = os.path.dirname(os.path.abspath(manifest_filepath))
+    for column in ['eeg', 'events', 'output']:
+        if column in sessions.columns:
+            sessions[column] = [p if pd.isna(p) else os.path.join(root_dir, p) for p in sessions[column]]
+    if 'session' not in sessions.columns:
+        sessions['session'] = sessions['participant'].astype(str)
+    return sessions
+
+# Returns the output of a session: `<events dir>/eeg_events.<format>` unless the manifest says otherwise
+def SessionOutput(session, fmt:str = 'csv'):
+    if 'output' in session and not pd.isna(session['output']):
+        return session['output']
+    return os.path.join(os.path.dirname(session['events']), ALIGNED_FILENAME + EXTENSIONS[fmt])
+
+# Returns where the settings a session's output was aligned with are saved
+def SettingsFilename(output_filepath:str):
+    return output_filepath.rstrip('/' + os.sep) + SETTINGS_SUFFIX
+
+# The settings that decide which columns a session's output has
+def AlignSettings(fbands, echannels):
+    return {'fbands':list(fbands), 'echannels':list(echannels)}
+
+# Whether a session's output is newer than both of its inputs and, if `settings` are given, was aligned with them.
+# Outputs without a settings file (e.g. from before they were saved) count as out of date.
+def IsUpToDate(eeg_filepath:str, events_filepath:str, output_filepath:str, settings:dict = None):
+    settings_filepath = SettingsFilename(output_filepath)
+    if os.path.isdir(output_filepath):
+        output_filepath = os.path.join(output_filepath, 'columns.json')
+    if not os.path.isfile(output_filepath):
+        return False
+    if os.path.getmtime(output_filepath) <= max(os.path.getmtime(eeg_filepath), os.path.getmtime(events_filepath)):
+        return False
+    if settings is None:
+        return True
+    if not os.path.isfile(settings_filepath):
+        return False
+    with open(settings_filepath) as jsonfile:
+        return json.load(jsonfile) == settings
+
+# Helper: align a single session in a worker process
+def _AlignSession(eeg_filepath:str, events_filepath:str, output_filepath:str, fbands, echannels, fmt:str, chunksize:int):
+    # The old settings are removed first, so an output that fails half way is never taken as up to date
+    settings_filepath = SettingsFilename(output_filepath)
+    if os.path.isfile(settings_filepath):
+        os.remove(settings_filepath)
+    if chunksize is None:
+        AE.AlignData(eeg_filepath, events_filepath, output_filepath, fbands, echannels, fmt)
+    else:
+        AE.AlignDataStreaming(eeg_filepath, events_filepath, output_filepath, fbands, echannels, fmt, chunksize)
+    with open(settings_filepath, 'w') as jsonfile:
+        json.dump(AlignSettings(fbands, echannels), jsonfile, indent=4)
+
+# Aligns every session in `sessions` (from `FindSessions()` or `ReadManifest()`) and combines their outputs into
+# `combined_filepath`, keyed by `participant` and `session`. Sessions whose output is newer than their inputs and was
+# aligned with the same `fbands` and `echannels` are skipped, unless `force` is set. With `chunksize`, each session is aligned in a streaming pass.
+# Returns the combined Dataframe and the summary table, with one row per session.
+def BatchAlignData(
+        sessions,
+        combined_filepath:str,
+        fbands = ['Theta', 'Alpha', 'Beta', 'Gamma'],
+        echannels = ['AF7', 'AF8'],
+        fmt:str = 'csv',
+        chunksize:int = None,
+        workers:int = None,
+        force:bool = False,
+        verbose:bool = True):
+    if verbose:
+        print(f"Found {len(sessions)} sessions")
+    status = {}
+    errors = {}
+    outputs = {}
+    pending = []
+    settings = AlignSettings(fbands, echannels)
+    for i, session in sessions.iterrows():
+        outputs[i] = SessionOutput(session, fmt)
+        if not force and IsUpToDate(session['eeg'], session['events'], outputs[i], settings):
+            status[i] = 'skipped'
+        else:
+            pending.append(i)
+
+    # Align the sessions that changed in parallel
+    if len(pending) > 0:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {i: pool.submit(_AlignSession, sessions.at[i, 'eeg'], sessions.at[i, 'events'], outputs[i], fbands, echannels, fmt, chunksize) for i in pending}
+            for i, future in futures.items():
+                try:
+                    future.result()
+                    status[i] = 'aligned'
+                except Exception as e:
+                    status[i] = 'failed'
+                    errors[i] = str(e)
+
+    # Combine every session's output, with the participant and session in front
+    frames = []
+    rows = []
+    for i, session in sessions.iterrows():
+        row = {'participant':session['participant'], 'session':session['session'], 'status':status[i], 'output':outputs[i]}
+        if status[i] != 'failed':
+            df = AE.ReadAligned(outputs[i])
+            df.insert(0, 'session', session['session'])
+            df.insert(0, 'participant', session['participant'])
+            frames.append(df)
+            row['rows'] = len(df)
+        else:
+            row['error'] = errors[i]
+        rows.append(row)
+    combined = pd.concat(frames, ignore_index=True) if len(frames) > 0 else pd.DataFrame(columns=['participant', 'session'])
+    AE.WriteAligned(combined, combined_filepath, fmt)
+
+    summary = pd.DataFrame(rows)
+    if 'rows' in summary.columns:
+        summary['rows'] = summary['rows'].astype('Int64')
+    summary.to_csv(os.path.join(os.path.dirname(os.path.abspath(combined_filepath)), SUMMARY_FILENAME), index=False)
+    if verbose:
+        print(summary.drop(columns=['output']).to_string(index=False))
+    return combined, summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # REQUIRED
+    parser.add_argument('root',help='The directory of sessions, or a manifest CSV listing them')
+
+    # OPTIONAL
+    parser.add_argument('-o','--output',help=f"Where to write the combined dataset. Defaults to `{COMBINED_FILENAME}` in the root directory (or next to the manifest)", default=None)
+    parser.add_argument('-fb','--frequency_bands',help='The list of frequency bands that must be included', nargs='+', default=['Theta', 'Alpha', 'Beta', 'Gamma'])
+    parser.add_argument('-ec','--electrode_channels',help='The list of electrode channels that must be included', nargs='+', default=['AF7', 'AF8'])
+    parser.add_argument('-f','--format',help='The format of every output. `npy` writes a directory with one file per column', choices=AE.OUTPUT_FORMATS, default='csv')
+    parser.add_argument('-c','--chunksize',help='Align each session in a streaming pass of this many rows at a time', type=int, default=None)
+    parser.add_argument('-w','--workers',help='How many sessions to align at once. Defaults to the number of CPUs', type=int, default=None)
+    parser.add_argument('-fo','--force',help='Align every session again, even if its output is up to date', action='store_true')
+    parser.add_argument('-e','--eeg_filename',help="The name of each session's EEG file, in a directory layout", default=EEG_FILENAME)
+    parser.add_argument('-v','--events_filename',help="The name of each session's events file, in a directory layout", default=EVENTS_FILENAME)
+    args = parser.parse_args()
+
+    if os.path.isdir(args.root):
+        sessions = FindSessions(args.root, args.eeg_filename, args.events_filename)
+        root_dir = args.root
+    else:
+        sessions = ReadManifest(args.root)
+        root_dir = os.path.dirname(os.path.abspath(args.root))
+    output = os.path.join(root_dir, COMBINED_FILENAME + EXTENSIONS[args.format]) if args.output is None else args.output
+    BatchAlignData(sessions, output, args.frequency_bands, args.electrode_channels, args.format, args.chunksize, args.workers, args.force)
@@ -0,0 +1,148 @@
+"""""""""""""""
+This file calibrates every anchor-mapping session under a directory (e.g. `to_correct/`) in one go.
+A session is any directory that contains the four anchor snapshots and `vr.csv` that `FindAnchorMapping.py` needs.
+Sessions are calibrated in parallel worker processes, and each one's mapping is written into its own directory.
+
+A cache file in the root directory records a content hash of each session's inputs (the snapshots, `vr.csv`,
+the template and the fitting options). On the next run, sessions whose inputs haven't changed and whose mapping
+file still exists are skipped.
+
+Finally, a summary table of how far each fitted transformation puts each anchor from where it was found in the
+image (in pixels) is printed and written to the root directory.
+"""""""""""""""
+
+import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import FindAnchorMapping as FA
+
+CACHE_FILENAME = '.anchor_mappings_cache.json'
+SUMMARY_FILENAME = 'anchor_mappings_summary.csv'
+
+# Returns every session directory under `root_dir` (including itself), sorted
+def FindSessions(root_dir:str):
+    sessions = []
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames.sort()
+        if FA.IsSession(dirpath):
+            sessions.append(dirpath)
+    return sessions
+
+# Returns a hash of everything a session's mapping depends on
+def SessionHash(session_dir:str, template_filename:str, thresh:float, degree:int = 1, lut_step:float = FA.LUT_STEP, lut_margin:float = FA.LUT_MARGIN):
+    digest = hashlib.sha256()
+    files = FA.CalibrationFiles(session_dir) if degree > 1 else FA.SessionFiles(session_dir)
+    for filepath in files + [template_filename]:
+        digest.update(os.path.basename(filepath).encode('utf-8'))
+        with open(filepath, 'rb') as infile:
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                digest.update(block)
+    digest.update(repr(float(thresh)).encode('utf-8'))
+    if degree > 1:
+        digest.update(repr((degree, float(lut_step), float(lut_margin))).encode('utf-8'))
+    return digest.hexdigest()
+
+# Helper: the files a session's calibration writes
+def _OutputFiles(session_dir:str, outfile:str, degree:int):
+    outputs = [os.path.join(session_dir, outfile)]
+    if degree > 1:
+        outputs.append(os.path.join(session_dir, FA.LookupTableFilename(outfile)))
+    return outputs
+
+# Helper: calibrate a single session in a worker process
+def _CalibrateSession(session_dir:str, template_filename:str, outfile:str, thresh:float, degree:int, lut_step:float, lut_margin:float):
+    return FA.FindAnchorMapping(session_dir, template_filename, outfile, thresh=thresh, degree=degree, lut_step=lut_step, lut_margin=lut_margin)
+
+# Calibrates every session under `root_dir`, writing `<session>/<outfile>` for each.
+# Sessions that are unchanged since the last run are skipped, unless `force` is set.
+# Returns the summary table, with one row per session.
+def BatchAnchorMapping(
+        root_dir:str,
+        template_filename:str,
+        outfile:str = 'mappings.json',
+        thresh:float = 0.975,
+        workers:int = None,
+        force:bool = False,
+        verbose:bool = True,
+        degree:int = 1,
+        lut_step:float = FA.LUT_STEP,
+        lut_margin:float = FA.LUT_MARGIN):
+    cache_filepath = os.path.join(root_dir, CACHE_FILENAME)
+    cache = {}
+    if os.path.isfile(cache_filepath):
+        with open(cache_filepath) as cachefile:
+            cache = json.load(cachefile)
+
+    sessions = FindSessions(root_dir)
+    if verbose:
+        print(f"Found {len(sessions)} sessions under {root_dir}")
+    hashes = {}
+    status = {}
+    pending = []
+    for session_dir in sessions:
+        key = os.path.relpath(session_dir, root_dir)
+        hashes[key] = SessionHash(session_dir, template_filename, thresh, degree, lut_step, lut_margin)
+        if not force and cache.get(key) == hashes[key] and all(os.path.isfile(f) for f in _OutputFiles(session_dir, outfile, degree)):
+            status[key] = 'cached'
+        else:
+            pending.append(session_dir)
+
+    # Calibrate the sessions that changed in parallel
+    errors = {}
+    if len(pending) > 0:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {os.path.relpath(d, root_dir): pool.submit(_CalibrateSession, d, template_filename, outfile, thresh, degree, lut_step, lut_margin) for d in pending}
+            for key, future in futures.items():
+                try:
+                    future.result()
+                    status[key] = 'calibrated'
+                    cache[key] = hashes[key]
+                except Exception as e:
+                    status[key] = 'failed'
+                    errors[key] = str(e)
+                    cache.pop(key, None)
+    with open(cache_filepath, 'w') as cachefile:
+        json.dump(cache, cachefile, indent=4)
+
+    # Summarize the residuals of every session's mapping
+    rows = []
+    for session_dir in sessions:
+        key = os.path.relpath(session_dir, root_dir)
+        row = {'session':key, 'status':status[key]}
+        if status[key] != 'failed':
+            with open(os.path.join(session_dir, outfile)) as jsonfile:
+                residuals = FA.AnchorResiduals(json.load(jsonfile))
+            row.update({f"residual_{anchor}":value for anchor, value in residuals.items()})
+            row['residual_max'] = max(residuals.values())
+            row['residual_rms'] = (sum(v*v for v in residuals.values()) / len(residuals)) ** 0.5
+        else:
+            row['error'] = errors[key]
+        rows.append(row)
+    summary = pd.DataFrame(rows)
+    summary.to_csv(os.path.join(root_dir, SUMMARY_FILENAME), index=False)
+    if verbose:
+        print(summary.to_string(index=False, float_format=lambda v: f"{v:.3f}"))
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # REQUIRED
+    parser.add_argument('root',help='The directory to search for AM sessions, e.g. `to_correct/`')
+    parser.add_argument('template',help='The template image of the anchor points')
+
+    # OPTIONAL
+    parser.add_argument('-o','--outfile',help="The name of each session's JSON mapping file", default='mappings.json')
+    parser.add_argument('-t','--threshold',help='The template matching threshold', type=float, default=0.975)
+    parser.add_argument('-w','--workers',help='How many sessions to calibrate at once. Defaults to the number of CPUs', type=int, default=None)
+    parser.add_argument('-f','--force',help='Recalibrate every session, even if its inputs have not changed', action='store_true')
+    parser.add_argument('-d','--degree',help='Also fit a polynomial model of this degree and save it as a lookup table (see `FindAnchorMapping.py`)', type=int, default=1)
+    parser.add_argument('-ls','--lut_step',help='The grid spacing of the lookup table, in VR screen units', type=float, default=FA.LUT_STEP)
+    parser.add_argument('-lm','--lut_margin',help='How far the lookup table extends past the calibration points, as a fraction of their extent', type=float, default=FA.LUT_MARGIN)
+    args = parser.parse_args()
+
+    BatchAnchorMapping(args.root, args.template, args.outfile, args.threshold, args.workers, args.force, degree=args.degree, lut_step=args.lut_step, lut_margin=args.lut_margin)
@@ -12,8 +12,11 @@ Make sure to follow installation instructions on the github repo's README before
 
 The file allows you to use a function `EstimateEyeCursor`, which should output a video file with the 
 eye tracking data from Unity overlapped on top of each frame. It also extracts a CSV containing each video frame's
-corresponding frame number in Unity, using EasyOCR to extract that number from the frame. There are also some 
-additional things you can do, such as extract the frames as images too.
+corresponding frame number in Unity. By default that number is read with `FrameCounterOCR.FrameCounterReader`,
+which locates the counter once and classifies its digits with templates, only falling back to EasyOCR when it is
+not confident. If the video and event clocks can be trusted, the Unity frames can instead be assigned from the frame
+timestamps saved by `ExtractFrameTimestamps.py` and the events' `unix_ms`, reading the counter only on a few frames to
+line up the two clocks. There are also some additional things you can do, such as extract the frames as images too.
 
 Note that the eye tracking CSV data from unity contains the following columns:
 - unix_ms
@@ -39,14 +42,23 @@ Relative values are between 0 and 100.
 """""""""""""""
 
 import numpy as np
-import json
-import pandas as pd
 
 import os
+import csv
+import shutil
+import subprocess
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
 import cv2 as cv
 import easyocr
+import LensCorrection as LC
+import VideoWriters as VW
+import FindAnchorMapping as FA
+import align_eeg_events as AE
+import ExtractFrameTimestamps as FT
+from FrameCounterOCR import FrameCounterReader, TrackFrameNumbers
+from Pipeline import RunStage, PrintStageStats
 
 import argparse
 
@@ -59,6 +71,8 @@ ECHANNELS = ['AF7', 'AF8']
 FCOLORS = [(0,0,255), (255,0,0), (0,255,0), (0,165,255)]
 FPOSITIONS = [50, 75, 100, 125]
 FHEIGHT = 25
+# Which videos each `outputs` setting writes. 'none' only writes the frames CSV.
+OUTPUTS = {'both':('eye','eeg'), 'eye':('eye',), 'eeg':('eeg',), 'none':()}
 
 # Helper function: is this an Integer?
 def check_int(s:str):
@@ -66,6 +80,198 @@ def check_int(s:str):
     except ValueError: return False
     else: return True
 
+# The original recognition path: EasyOCR over the whole thresholded frame, taking the first detection
+def ReadFrameNumberEasyOCR(image):
+    gry = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    thr = cv.threshold(gry, 100, 255, cv.THRESH_BINARY)[1]
+    screen_text = reader.readtext(thr)
+    if len(screen_text) > 0 and check_int(screen_text[0][1]):
+        return int(screen_text[0][1])
+    return None
+
+# Same as `ReadFrameNumberEasyOCR()`, but runs EasyOCR over a whole batch of frames at once
+def ReadFrameNumbersEasyOCR(images):
+    thrs = [cv.threshold(cv.cvtColor(image, cv.COLOR_BGR2GRAY), 100, 255, cv.THRESH_BINARY)[1] for image in images]
+    values = []
+    for screen_text in reader.readtext_batched(thrs, batch_size=len(thrs)):
+        if len(screen_text) > 0 and check_int(screen_text[0][1]):
+            values.append(int(screen_text[0][1]))
+        else:
+            values.append(None)
+    return values
+
+# Returns the region (y1, y2, x1, x2) of a frame that the EEG panel can draw into, given the largest
+# relative value that will be drawn as a bar. Everything outside of it is identical in the eye and EEG videos.
+def EEGPanelRegion(width:int, height:int, max_value:int = 100):
+    half_w = int(width/2)
+    margin = 4
+    y1, y2 = height, 0
+    x1, x2 = half_w-max_value-70, half_w+max_value+71
+    for i in range(len(FBANDS)):
+        toppoint = height - FPOSITIONS[i]
+        (text_w, text_h), baseline = cv.getTextSize(FBANDS[i], cv.FONT_HERSHEY_SIMPLEX, 1, 2)
+        y1 = min(y1, toppoint, toppoint + FHEIGHT - text_h - margin)
+        y2 = max(y2, toppoint + FHEIGHT + baseline + margin)
+        x1 = min(x1, half_w - 60 - margin)
+        x2 = max(x2, half_w - 60 + text_w + margin)
+    return max(y1, 0), min(y2, height), max(x1, 0), min(x2, width)
+
+# Draws one eye event's EEG bands and bars. `origin` is the frame position of the image's top left corner,
+# so the panel can be drawn into just the region from `EEGPanelRegion()`.
+def DrawEEGPanel(image, rel, width:int, height:int, origin=(0, 0)):
+    half_w = int(width/2) - origin[0]
+    for i in range(len(FBANDS)):
+        color = FCOLORS[i]
+        toppoint = height - FPOSITIONS[i] - origin[1]
+
+        # Frequency band
+        cv.putText(image, FBANDS[i], (half_w-60, toppoint + FHEIGHT), cv.FONT_HERSHEY_SIMPLEX, 1, color, 2, cv.LINE_AA)
+
+        for j in range(len(ECHANNELS)):
+            v = rel[i][j]
+            if j % 2 == 0:
+                # Even Number = Right Side
+                cv.rectangle(image, (half_w+70, toppoint), (half_w+v+70, toppoint+FHEIGHT), color, -1)
+            else:
+                # Odd Number = Left Side
+                cv.rectangle(image, (half_w-v-70, toppoint), (half_w-70, toppoint+FHEIGHT), color, -1)
+    return image
+
+# Helper: returns the functions that read the Unity frame number of a frame, and of a batch of frames, for an `ocr_mode`.
+# The frame counter reader locates the counter once and decodes it with digit templates,
+# falling back to EasyOCR (sharing the already-loaded model) when it isn't confident
+def _FrameNumberReaders(ocr_mode:str):
+    if ocr_mode == 'easyocr':
+        return ReadFrameNumberEasyOCR, ReadFrameNumbersEasyOCR
+    frame_reader = FrameCounterReader(threshold=100, ocr_reader=reader)
+    return (lambda frame: frame_reader.Read(frame)[0],
+            lambda frames: [value for value, _ in frame_reader.ReadBatch(frames)])
+
+# Helper: the timestamp (in ms) of every video frame, from a sidecar of `ExtractFrameTimestamps.py` or its records
+def _VideoTimestamps(frame_timestamps):
+    if isinstance(frame_timestamps, (str, os.PathLike)):
+        frame_timestamps = FT.LoadTimestamps(frame_timestamps)
+    return np.asarray(frame_timestamps['timestamp'], dtype=np.float64) * 1000.0
+
+# Helper: create the output dir if needed, and empty it of files
+def _PrepareOutputDir(output_dir:str):
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    for filename in os.listdir(output_dir):
+        filepath = os.path.join(output_dir, filename)
+        try:
+            if os.path.isfile(filepath) or os.path.islink(filepath):
+                os.unlink(filepath)
+        except Exception as e:
+            print("Failed to delete %s. Reason: %s" % (filepath, e))
+
+# Helper: seek a capture so that the next `read()` returns frame `frame_index`.
+# Seeking by frame isn't always exact for inter-coded or variable frame rate video. If the capture lands before the
+# frame (e.g. on the keyframe before it), it skips forward frame by frame with `grab()`, which doesn't convert them.
+# If it lands past the frame, it seeks `backoff` frames earlier, doubling that until it lands before it.
+def _SeekFrame(vidcap, frame_index:int, backoff:int = 32):
+    if frame_index <= 0:
+        return
+    vidcap.set(cv.CAP_PROP_POS_FRAMES, frame_index)
+    position = int(vidcap.get(cv.CAP_PROP_POS_FRAMES))
+    if position == frame_index:
+        return
+    while not 0 <= position < frame_index:
+        target = max(frame_index - backoff, 0)
+        vidcap.set(cv.CAP_PROP_POS_FRAMES, target)
+        position = int(vidcap.get(cv.CAP_PROP_POS_FRAMES))
+        if target == 0 and not 0 <= position < frame_index:
+            position = 0
+        backoff *= 2
+    print(f"Seeking to frame {frame_index} wasn't exact, skipping forward from frame {position}")
+    for _ in range(frame_index - position):
+        if not vidcap.grab():
+            break
+
+# Eye events indexed by Unity frame. All screen positions are pushed through the mapping's projection (the
+# transformation matrix, or its lookup table if it has one) in one batched call up front, and the rows are sorted by frame so that each frame is a contiguous slice of the
+# arrays. Looking up a frame is then a single dictionary access instead of a scan over the whole table.
+class EyeEventIndex:
+    def __init__(self, eye_df, projection, frame_height:int, with_rel:bool = True):
+        eye_df = eye_df[~eye_df['frame'].isna()]
+        # A stable sort keeps the rows of each frame in their original order
+        order = np.argsort(eye_df['frame'].to_numpy(), kind='stable')
+        self.frames = eye_df['frame'].to_numpy()[order].astype(np.int64)
+
+        # Project all positions at once, then flip the Y
+        screen = eye_df[['screen_pos_x', 'screen_pos_y']].to_numpy(dtype=np.float64)[order]
+        estimates = projection.Project(screen)
+        self.positions = np.column_stack([
+            estimates[:,0].astype(np.int64),
+            (frame_height - estimates[:,1]).astype(np.int64)])
+
+        # Relative EEG values, as (n, bands, channels). Only needed if the EEG video is drawn.
+        self.rel = None
+        if with_rel:
+            rel_columns = [f"Rel_{band}_{channel}" for band in FBANDS for channel in ECHANNELS]
+            self.rel = eye_df[rel_columns].to_numpy()[order].astype(np.int64).reshape(-1, len(FBANDS), len(ECHANNELS))
+
+        # Unity frame => slice of the arrays above
+        unique_frames, starts, counts = np.unique(self.frames, return_index=True, return_counts=True)
+        self._slices = {int(f): slice(int(s), int(s+c)) for f, s, c in zip(unique_frames, starts, counts)}
+
+    # Returns the row positions of a Unity frame's events in the arrays, which is empty if there are none
+    def Lookup(self, unity_frame:int):
+        return self._slices.get(int(unity_frame), slice(0, 0))
+
+# The start time of each Unity frame on the events' clock, which is the `unix_ms` of its first event.
+# Returns the Unity frames and their start times, in time order.
+def UnityFrameTimes(events_df):
+    events_df = events_df[~events_df['frame'].isna()]
+    frames = events_df['frame'].to_numpy().astype(np.int64)
+    times = events_df['unix_ms'].to_numpy(dtype=np.float64)
+    unique_frames = np.unique(frames)
+    starts = np.full(len(unique_frames), np.inf)
+    np.minimum.at(starts, np.searchsorted(unique_frames, frames), times)
+    order = np.argsort(starts, kind='stable')
+    return unique_frames[order], starts[order]
+
+# Assigns every video frame the Unity frame it shows from the timestamps alone, in one sorted merge: the frame at
+# `t` ms shows the last Unity frame that started at or before `t + clock_offset_ms`. Frames before the first Unity
+# frame, or more than `max_gap_ms` after the last one started, get -1.
+def AssignUnityFrames(video_ms, unity_frames, unity_ms, clock_offset_ms:float, max_gap_ms:float = 100.0):
+    t = np.asarray(video_ms, dtype=np.float64) + clock_offset_ms
+    idx = np.searchsorted(unity_ms, t, side='right') - 1
+    assigned = unity_frames[np.maximum(idx, 0)].copy()
+    assigned[(idx < 0) | (t > unity_ms[-1] + max_gap_ms)] = -1
+    return assigned
+
+# Estimates the offset (in ms) from the video's frame timestamps to the events' clock, by reading the frame counter of
+# `samples` frames spread out from `first_frame` to the end of the video. A frame at `t` ms that shows Unity frame U
+# puts the offset between U's start and the next Unity frame's start, minus `t`. The offset is the middle of the range
+# that every reading agrees with, or the median of the readings' midpoints if they don't all agree.
+# Returns the offset and a summary of the calibration; a negative `window_ms` is how far apart the readings are.
+def CalibrateClockOffset(video_filepath:str, read_fn, video_ms, unity_frames, unity_ms, samples:int = 5, first_frame:int = 0, correction:dict = None, max_gap_ms:float = 100.0):
+    position = {int(f): i for i, f in enumerate(unity_frames.tolist())}
+    indices = np.unique(np.linspace(first_frame, len(video_ms)-1, samples).astype(int))
+    lows, highs = [], []
+    vidcap = cv.VideoCapture(video_filepath)
+    for index in indices.tolist():
+        _SeekFrame(vidcap, index)
+        success, image = vidcap.read()
+        if not success:
+            continue
+        if correction is not None:
+            image = LC.CorrectFrame(image, **correction)
+        unity_frame = read_fn(image)
+        if unity_frame is None or int(unity_frame) not in position:
+            continue
+        i = position[int(unity_frame)]
+        end = unity_ms[i+1] if i+1 < len(unity_ms) else unity_ms[i] + max_gap_ms
+        lows.append(unity_ms[i] - video_ms[index])
+        highs.append(end - video_ms[index])
+    vidcap.release()
+    if len(lows) == 0:
+        raise ValueError("The frame counter couldn't be read on any calibration frame, pass the clock offset instead")
+    lows, highs = np.array(lows), np.array(highs)
+    lo, hi = lows.max(), highs.min()
+    offset = float((lo + hi) / 2) if lo < hi else float(np.median((lows + highs) / 2))
+    return offset, {'samples':len(indices), 'read':len(lows), 'offset_ms':offset, 'window_ms':float(hi - lo)}
+
 # Main function definition
 def EstimateCursor(
         video_filepath:str, 
@@ -75,36 +281,54 @@ def EstimateCursor(
 
         offset_seconds:float = 0,
         video_output_filename:str = 'output',
-        csv_output_filename:str = 'frames'):    
+        csv_output_filename:str = 'frames',
+        outputs:str = 'both',
+        video_backend:str = 'mjpg',
+        video_options:dict = None,
+        correct_eye:str = None,
+        ocr_mode:str = 'template',
+        ocr_stride:int = 1,
+        ocr_batch_size:int = 1,
+        pipelined:bool = False,
+        queue_size:int = 8,
+        start_frame:int = 0,
+        end_frame:int = None,
+        frame_timestamps = None,
+        clock_offset_ms:float = None,
+        calibration_samples:int = 5):    
+
+    if outputs not in OUTPUTS:
+        raise ValueError(f"Unknown outputs '{outputs}', expected one of {list(OUTPUTS)}")
+    # Frame number tracking reads its keyframes one at a time, so it can't be batched
+    if ocr_stride > 1 and ocr_batch_size > 1:
+        raise ValueError("The frame counter can either be read every `ocr_stride` frames or in batches of `ocr_batch_size`, not both")
+    draw_eye = len(OUTPUTS[outputs]) > 0
+    draw_eeg = 'eeg' in OUTPUTS[outputs]
+    video_options = {} if video_options is None else video_options
+    vfr = video_options.get('vfr', False)
 
     # If we want to save the output video, CSV, and images, we need an output dir. 
     # Thus, we need to check if it exists already and empty it.
-    Path(output_dir).mkdir(parents=True, exist_ok=True)
-    for filename in os.listdir(output_dir):
-        filepath = os.path.join(output_dir, filename)
-        try:
-            if os.path.isfile(filepath) or os.path.islink(filepath):
-                os.unlink(filepath)
-        except Exception as e:
-            print("Failed to delete %s. Reason: %s" % (filepath, e))
+    _PrepareOutputDir(output_dir)
     if video_output_filename is None or len(video_output_filename)==0:
         video_output_filename = os.path.splitext(os.path.basename(video_filepath))[0]
-    vid_eye_outpath = os.path.join(output_dir, video_output_filename+'_eye.avi')
-    vid_eeg_outpath = os.path.join(output_dir, video_output_filename+'_eeg.avi')
-
-    # Initialize mappings json, and get the transformation matrices
-    with open(mapping_filepath) as jsonfile:
-        mapping = json.load(jsonfile)
-    transformation_matrix = np.array(mapping['transformation_matrix'])
-
-    # Define a nested function that returns the transformed point, provided the transformation matrix
-    def transform(input):
-        A = np.array(input + [1])
-        return np.dot(A,transformation_matrix)
-    
+    video_ext = VW.OutputExtension(video_backend, vfr)
+    vid_eye_outpath = os.path.join(output_dir, video_output_filename+'_eye'+video_ext)
+    vid_eeg_outpath = os.path.join(output_dir, video_output_filename+'_eeg'+video_ext)
+    csv_outpath = os.path.join(output_dir, csv_output_filename+'.csv')
+
+    # Initialize mappings json, and get the projection from screen points to image points
+    projection = FA.LoadProjection(mapping_filepath)
+
     # Read the events filepath from Unity, extract only the relevant eye cursor data
     # Assume we want the left eye
-    events_df = pd.read_csv(events_filepath)
+    # Only the columns we use are loaded. The events can be any output format of `align_eeg_events.py`.
+    columns = ['frame', 'side', 'screen_pos_x', 'screen_pos_y']
+    if frame_timestamps is not None:
+        columns.append('unix_ms')
+    if draw_eeg:
+        columns += [f"Rel_{band}_{channel}" for band in FBANDS for channel in ECHANNELS]
+    events_df = AE.ReadAligned(events_filepath, columns)
     eye_df = events_df[events_df['side']=='Left']
 
     # Initialize OpenCV-Python to begin extracting frames
@@ -112,95 +336,271 @@ def EstimateCursor(
     vidcapw  = int(vidcap.get(cv.CAP_PROP_FRAME_WIDTH))   # float `width`
     vidcaph = int(vidcap.get(cv.CAP_PROP_FRAME_HEIGHT))   # float `height`
     vidcapfps = int(vidcap.get(cv.CAP_PROP_FPS))          # FPS
-    out_eye = cv.VideoWriter(vid_eye_outpath, cv.VideoWriter_fourcc('M','J','P','G'), vidcapfps, (vidcapw,vidcaph))
-    out_eeg = cv.VideoWriter(vid_eeg_outpath, cv.VideoWriter_fourcc('M','J','P','G'), vidcapfps, (vidcapw,vidcaph))
-    success, image = vidcap.read()
-    count = 0
+    video_fps = vidcap.get(cv.CAP_PROP_FPS)               # Exact FPS, for the output videos
+    # If the source is the raw scrcpy capture, correct each frame in-process with the given eye's parameters.
+    # The output then has the size of that eye's crop.
+    correction = None
+    if correct_eye is not None:
+        correction = LC.EYE_PARAMS[correct_eye]
+        vidcapw, vidcaph = correction['crop'][0], correction['crop'][1]
+    # Only the requested videos are opened, with the chosen writer backend (see `VideoWriters.py`)
+    out_eye, out_eeg = None, None
+    if 'eye' in OUTPUTS[outputs]:
+        out_eye = VW.OpenWriter(vid_eye_outpath, vidcapw, vidcaph, video_fps, backend=video_backend, **video_options)
+    if 'eeg' in OUTPUTS[outputs]:
+        out_eeg = VW.OpenWriter(vid_eeg_outpath, vidcapw, vidcaph, video_fps, backend=video_backend, **video_options)
+    # For variable frame rate output, the source timestamp of each frame is kept until it is written
+    output_timestamps = {}
     offset_frames = vidcapfps * offset_seconds
-    vidcaphalfW = int(vidcapw/2)
-    font = cv.FONT_HERSHEY_SIMPLEX
+    # Index the eye events by Unity frame, with their positions already transformed into this video's coordinates
+    eye_index = EyeEventIndex(eye_df, projection, vidcaph, with_rel=draw_eeg)
+    if draw_eeg:
+        max_rel = int(np.abs(eye_index.rel).max()) if eye_index.rel.size > 0 else 0
+        py1, py2, px1, px2 = EEGPanelRegion(vidcapw, vidcaph, max(max_rel, 100))
+
+    # How the Unity frame number is read from a frame (see `_FrameNumberReaders()`)
+    read_fn, read_batch_fn = _FrameNumberReaders(ocr_mode)
+
+    # With frame timestamps (a sidecar from `ExtractFrameTimestamps.py`, or its records), the Unity frame of every
+    # video frame is worked out up front from its timestamp, and the frame counter is only read on a few frames to
+    # calibrate the offset between the video's clock and the events' clock, unless that offset is given.
+    timestamp_frames = None
+    calibration = None
+    if frame_timestamps is not None:
+        video_ms = _VideoTimestamps(frame_timestamps)
+        unity_frames, unity_ms = UnityFrameTimes(events_df)
+        if clock_offset_ms is None:
+            clock_offset_ms, calibration = CalibrateClockOffset(
+                video_filepath, read_fn, video_ms, unity_frames, unity_ms,
+                samples=calibration_samples, first_frame=int(offset_frames)+1, correction=correction)
+        timestamp_frames = AssignUnityFrames(video_ms, unity_frames, unity_ms, clock_offset_ms).tolist()
+    # The frames themselves are only needed to draw on, or to read the counter from
+    need_images = draw_eye or timestamp_frames is None
+
+    csvfile = open(csv_outpath, 'w', newline='')
+    csvwriter = csv.writer(csvfile)
+    csvwriter.writerow(['frame', 'unity_frame', 'source'])
+
+    # Decode the frames past the offset, correcting them for lens distortion if requested.
+    # Only frames in [start_frame, end_frame) are decoded, which lets a video be processed in chunks.
+    def decode():
+        _SeekFrame(vidcap, start_frame)
+        count = start_frame
+        success, image = vidcap.read() if need_images else (vidcap.grab(), None)
+        while success and (end_frame is None or count < end_frame):
+            # We check if count exceeds the provided offset, which is set to a default frame offset of 30
+            if count > offset_frames:
+                timestamp = vidcap.get(cv.CAP_PROP_POS_MSEC)
+                if correction is not None and image is not None:
+                    image = LC.CorrectFrame(image, **correction)
+                if vfr:
+                    output_timestamps[count] = timestamp
+                yield count, timestamp, image
+            # Get the next frame
+            success, image = vidcap.read() if need_images else (vidcap.grab(), None)
+            count += 1
+
+    # Get the Unity frame number of each frame. Either every frame is read (one at a time, or in batches of
+    # `ocr_batch_size` frames), or only a sparse set of keyframes is read and the frames in between are predicted
+    # from their timestamps (see `FrameCounterOCR.TrackFrameNumbers`)
+    def read_every(frames):
+        for count, _, image in frames:
+            unity_frame = read_fn(image)
+            yield count, image, unity_frame, 'ocr' if unity_frame is not None else ''
+    def read_batched(frames):
+        batch = []
+        for item in frames:
+            batch.append(item)
+            if len(batch) == ocr_batch_size:
+                yield from zip_batch(batch)
+                batch = []
+        if len(batch) > 0:
+            yield from zip_batch(batch)
+    def zip_batch(batch):
+        values = read_batch_fn([image for _, _, image in batch])
+        for (count, _, image), unity_frame in zip(batch, values):
+            yield count, image, unity_frame, 'ocr' if unity_frame is not None else ''
+    def read_timestamps(frames):
+        for count, _, image in frames:
+            unity_frame = timestamp_frames[count] if count < len(timestamp_frames) else -1
+            yield count, image, unity_frame if unity_frame >= 0 else None, 'timestamp' if unity_frame >= 0 else ''
+    tracking_stats = {}
+
+    # Draw the estimated eye cursor directly on to each decoded frame, which is shared by both videos.
+    # The EEG panel is drawn into a copy of just the region it covers, along with any cursors that fall in that
+    # region, in the same order as before so overlapping drawings stack up the same way.
+    def render(recognized):
+        for count, image, unity_frame, source in recognized:
+            panel = None
+            # If the Unity frame number was detected and a video is being written, proceed
+            if unity_frame is not None and draw_eye:
+                # Get the eye events that represent this frame
+                rows = eye_index.Lookup(unity_frame)
+                eye_positions = eye_index.positions[rows].tolist()
+                if len(eye_positions) > 0 and draw_eeg:
+                    eye_rels = eye_index.rel[rows].tolist()
+                    panel = image[py1:py2, px1:px2].copy()
+                # Iterate through events, pasting their already-transformed positions on to the screen
+                for k, eye_pos in enumerate(eye_positions):
+                    # Print a rectangle to represent the estimated eye cursor
+                    cv.rectangle(
+                        image,
+                        (eye_pos[0] - 10, eye_pos[1] - 10),
+                        (eye_pos[0] + 10, eye_pos[1] + 10),
+                        (255,0,0), 3)
+                    if panel is not None:
+                        cv.rectangle(
+                            panel,
+                            (eye_pos[0] - 10 - px1, eye_pos[1] - 10 - py1),
+                            (eye_pos[0] + 10 - px1, eye_pos[1] + 10 - py1),
+                            (255,0,0), 3)
+                        # Print the Rel_AF7 and Rel_AF8
+                        DrawEEGPanel(panel, eye_rels[k], vidcapw, vidcaph, origin=(px1, py1))
+
+            yield count, unity_frame, source, image, panel
+
+    # Write the final frames to the output videos, and their Unity frame numbers to the CSV.
+    # The EEG frame is the eye frame with the panel pasted over it, so it is only built after the eye frame is written.
+    def encode(rendered):
+        for count, unity_frame, source, result, panel in rendered:
+            csvwriter.writerow([count, unity_frame if unity_frame is not None else '', source])
+            timestamp = output_timestamps.pop(count, None)
+            if out_eye is not None:
+                out_eye.write(result, timestamp)
+            if out_eeg is not None:
+                if panel is not None:
+                    result[py1:py2, px1:px2] = panel
+                out_eeg.write(result, timestamp)
+            yield count
+
+    # Chain the stages. In pipelined mode, each stage runs on its own thread and hands its frames, in order,
+    # to the next stage through a bounded queue.
+    pipeline_stats = {}
+    def stage(iterable, name):
+        if pipelined:
+            return RunStage(iterable, name, stats=pipeline_stats, maxsize=queue_size)
+        return iterable
+    frames = stage(decode(), 'decode')
+    if timestamp_frames is not None:
+        recognized = stage(read_timestamps(frames), 'recognize')
+    elif ocr_stride > 1:
+        recognized = stage(TrackFrameNumbers(frames, read_fn, stride=ocr_stride, stats=tracking_stats), 'recognize')
+    elif ocr_batch_size > 1:
+        recognized = stage(read_batched(frames), 'recognize')
+    else:
+        recognized = stage(read_every(frames), 'recognize')
+    rendered = stage(render(recognized), 'render')
 
     # Loop!
-    while success:
-        # We check if count exceeds the provided offset, which is set to a default frame offset of 30
-        if count > offset_frames:
-
-            # Make a copy of the frame
-            result = np.copy(image)
-            result_eeg = np.copy(image)
-
-            # Attempt to grayscale and apply threshold for easier frame processing
-            gry = cv.cvtColor(result, cv.COLOR_BGR2GRAY)
-            thr = cv.threshold(gry, 100, 255, cv.THRESH_BINARY)[1]
-
-            # Attempt to extract text. If detected, proceed
-            screen_text = reader.readtext(thr)
-            if len(screen_text) > 0:
-                # Get the most confident text, which should be the clearest. Check if it's an integer
-                conf_text = screen_text[0][1]
-                if check_int(conf_text):
-                    # Get the eye rows that represent this frame
-                    eye_rows = eye_df.loc[eye_df['frame'] == int(conf_text)]
-                    if not eye_rows.empty:
-                        # Iterate through rows, attempting to apply the correction matrix and pasting on to the screen
-                        for index, row in eye_rows.iterrows():
-                            eye_pos_est = transform([row['screen_pos_x'], row['screen_pos_y']])
-                            eye_pos = (int(eye_pos_est[0]), int(vidcaph-eye_pos_est[1])) # flip the Y
-                            #result = cv.drawMarker(result, eye_pos, (255,0,0), cv.MARKER_CROSS, 20, 2)
-                            # Print a rectangle to represent the estimated eye cursor
-                            result = cv.rectangle(
-                                result,
-                                (eye_pos[0] - 10, eye_pos[1] - 10),
-                                (eye_pos[0] + 10, eye_pos[1] + 10),
-                                (255,0,0), 3)
-                            result_eeg = cv.rectangle(
-                                result_eeg,
-                                (eye_pos[0] - 10, eye_pos[1] - 10),
-                                (eye_pos[0] + 10, eye_pos[1] + 10),
-                                (255,0,0), 3)
-                            
-                            # Print the Rel_AF7 and Rel_AF8, in a copy of result
-                            for i in range(len(FBANDS)):
-                                color = FCOLORS[i]
-                                toppoint = vidcaph - FPOSITIONS[i]
-
-                                # Frequency band
-                                result_eeg = cv.putText(
-                                    result_eeg, FBANDS[i], (vidcaphalfW-60, toppoint + FHEIGHT),
-                                    font, 1, color, 2, cv.LINE_AA)
-
-                                for j in range(len(ECHANNELS)):
-                                    colname = f"Rel_{FBANDS[i]}_{ECHANNELS[j]}"
-                                    v = row[colname]
-
-                                    if j % 2 == 0:
-                                        # Even Number = Right Side
-                                        result_eeg = cv.rectangle(
-                                            result_eeg,
-                                            (vidcaphalfW+70, toppoint),
-                                            (vidcaphalfW+v+70, toppoint+FHEIGHT),
-                                            color, -1)
-                                    else:
-                                        # Odd Number = Left Side
-                                        result_eeg = cv.rectangle(
-                                            result_eeg,
-                                            (vidcaphalfW-v-70, toppoint),
-                                            (vidcaphalfW-70, toppoint+FHEIGHT),
-                                            color, -1)
-                                        
-
-            # Write the final frame to the output video
-            out_eye.write(result)
-            out_eeg.write(result_eeg)
-
-        # Get the next frame
-        success, image = vidcap.read()
-        count += 1
+    for _ in stage(encode(rendered), 'encode'):
+        pass
 
     # Finally, close the video capture and output
     vidcap.release()
-    out_eye.release()
-    out_eeg.release()
+    for out in [out_eye, out_eeg]:
+        if out is not None:
+            out.release()
+    csvfile.close()
+    if calibration is not None:
+        print(f"Clock calibration: {calibration}")
+    if ocr_stride > 1 and timestamp_frames is None:
+        print(f"Frame number tracking: {tracking_stats}")
+    if pipelined:
+        PrintStageStats(pipeline_stats)
+
+# Joins videos with identical encoding settings end to end, without re-encoding them (ffmpeg's concat demuxer)
+def ConcatVideos(video_filepaths, output_filepath:str):
+    list_filepath = output_filepath + '.txt'
+    with open(list_filepath, 'w') as listfile:
+        for filepath in video_filepaths:
+            escaped = os.path.abspath(filepath).replace("'", "'\\''")
+            listfile.write(f"file '{escaped}'\n")
+    subprocess.run(
+        ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_filepath, '-c', 'copy', output_filepath],
+        check=True)
+    os.remove(list_filepath)
+    return output_filepath
+
+# Runs `EstimateCursor` over a single video in parallel, with each worker process handling a contiguous range of frames.
+# Each worker writes its own partial videos and frames CSV, which are then stitched into the final outputs without
+# re-encoding. Any other keyword arguments are passed on to `EstimateCursor`.
+def EstimateCursorParallel(
+        video_filepath:str,
+        events_filepath:str,
+        mapping_filepath:str,
+        output_dir:str,
+
+        workers:int = 4,
+        video_output_filename:str = 'output',
+        csv_output_filename:str = 'frames',
+        outputs:str = 'both',
+        video_backend:str = 'mjpg',
+        video_options:dict = None,
+        **kwargs):
+    video_options = {} if video_options is None else video_options
+    if video_options.get('segment_seconds') is not None:
+        raise ValueError("Segmented output can't be stitched back together, run with a single worker instead")
+    # Each worker's timestamps are relative to its own first frame, so the gaps between the chunks would be lost
+    if video_options.get('vfr', False):
+        raise ValueError("Variable frame rate output can't be stitched back together, run with a single worker instead")
+    _PrepareOutputDir(output_dir)
+    if video_output_filename is None or len(video_output_filename)==0:
+        video_output_filename = os.path.splitext(os.path.basename(video_filepath))[0]
+
+    # Split the frames after the offset into equal frame ranges, so that no chunk is left without frames to write.
+    # The last chunk always runs to the end of the video, in case the container's frame count is off.
+    vidcap = cv.VideoCapture(video_filepath)
+    frame_count = int(vidcap.get(cv.CAP_PROP_FRAME_COUNT))
+    first_frame = int(int(vidcap.get(cv.CAP_PROP_FPS)) * kwargs.get('offset_seconds', 0)) + 1
+    vidcap.release()
+    workers = max(min(workers, frame_count - first_frame), 1)
+    bounds = np.linspace(first_frame, frame_count, workers+1).astype(int)
+
+    # With frame timestamps, the clock offset is calibrated once here and passed on, rather than by every worker
+    if kwargs.get('frame_timestamps') is not None and kwargs.get('clock_offset_ms') is None:
+        read_fn, _ = _FrameNumberReaders(kwargs.get('ocr_mode', 'template'))
+        unity_frames, unity_ms = UnityFrameTimes(AE.ReadAligned(events_filepath, ['frame', 'unix_ms']))
+        correct_eye = kwargs.get('correct_eye')
+        kwargs['clock_offset_ms'], calibration = CalibrateClockOffset(
+            video_filepath, read_fn, _VideoTimestamps(kwargs['frame_timestamps']), unity_frames, unity_ms,
+            samples=kwargs.get('calibration_samples', 5), first_frame=first_frame,
+            correction=LC.EYE_PARAMS[correct_eye] if correct_eye is not None else None)
+        print(f"Clock calibration: {calibration}")
+    chunks_dir = os.path.join(output_dir, '_chunks')
+    chunk_dirs = [os.path.join(chunks_dir, f"chunk_{i:03d}") for i in range(workers)]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for i in range(workers):
+            futures.append(pool.submit(
+                EstimateCursor,
+                video_filepath, events_filepath, mapping_filepath, chunk_dirs[i],
+                video_output_filename=video_output_filename,
+                csv_output_filename=csv_output_filename,
+                outputs=outputs,
+                video_backend=video_backend,
+                video_options=video_options,
+                start_frame=int(bounds[i]),
+                end_frame=int(bounds[i+1]) if i < workers-1 else None,
+                **kwargs))
+        for future in futures:
+            future.result()
+
+    # Stitch the partial outputs back together, in order
+    video_ext = VW.OutputExtension(video_backend, video_options.get('vfr', False))
+    for video in OUTPUTS[outputs]:
+        suffix = f"_{video}{video_ext}"
+        ConcatVideos(
+            [os.path.join(d, video_output_filename+suffix) for d in chunk_dirs],
+            os.path.join(output_dir, video_output_filename+suffix))
+    with open(os.path.join(output_dir, csv_output_filename+'.csv'), 'w', newline='') as outfile:
+        for i, d in enumerate(chunk_dirs):
+            with open(os.path.join(d, csv_output_filename+'.csv'), newline='') as infile:
+                header = infile.readline()
+                if i == 0:
+                    outfile.write(header)
+                shutil.copyfileobj(infile, outfile)
+    shutil.rmtree(chunks_dir)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -214,17 +614,53 @@ if __name__ == "__main__":
     # OPTIONAL
     parser.add_argument('-ofs','--offset_seconds',help='How many seconds from the beginning should we initially ignore?', type=float, default=0)
     parser.add_argument('-outf','--output_filename',help='The output filename, no extension needed', type=str, default='')
+    parser.add_argument('-ocr','--ocr_mode',help='How to read the Unity frame counter: digit templates with EasyOCR as a fallback, or EasyOCR on every frame', choices=['template','easyocr'], default='template')
+    parser.add_argument('-stride','--ocr_stride',help='Only read the frame counter every N frames and predict the frames in between. 1 reads every frame', type=int, default=1)
+    parser.add_argument('-bs','--ocr_batch_size',help='Read the frame counter of this many frames in a single EasyOCR batch', type=int, default=1)
+    parser.add_argument('-p','--pipelined',help='Run decoding, frame number recognition, rendering and encoding on separate threads', action='store_true')
+    parser.add_argument('-q','--queue_size',help='In pipelined mode, how many frames may wait between two stages', type=int, default=8)
+    parser.add_argument('-w','--workers',help='Split the video into this many frame ranges and process them in parallel processes', type=int, default=1)
+    parser.add_argument('-o','--outputs',help='Which videos to write. With "none", only the frames CSV is written', choices=list(OUTPUTS), default='both')
+    parser.add_argument('-vb','--video_backend',help='Write the videos as MJPG with OpenCV, or stream them to ffmpeg', choices=VW.BACKENDS, default='mjpg')
+    parser.add_argument('-vc','--video_codec',help='With the ffmpeg backend, the codec to encode with', default='libx264')
+    parser.add_argument('-vp','--video_preset',help='With the ffmpeg backend, the encoder preset', default='veryfast')
+    parser.add_argument('-crf','--crf',help='With the ffmpeg backend, the constant rate factor (lower is better quality)', type=int, default=23)
+    parser.add_argument('-vfr','--vfr',help='With the ffmpeg backend, keep the source timestamp of every frame', action='store_true')
+    parser.add_argument('-seg','--segment_seconds',help='With the ffmpeg backend, split the videos into segments of this many seconds', type=float, default=None)
+    parser.add_argument('-ts','--timestamps',help='Assign Unity frames from the frame timestamps in this sidecar (from ExtractFrameTimestamps.py) instead of reading every frame counter', default=None)
+    parser.add_argument('-co','--clock_offset',help='With -ts, the offset (ms) from the video timestamps to the events\' unix_ms. Calibrated by reading a few frame counters if not given', type=float, default=None)
+    parser.add_argument('-cs','--calibration_samples',help='With -ts, how many frame counters to read to calibrate the clock offset', type=int, default=5)
+    parser.add_argument('-ce','--correct_eye',help='If the source is raw scrcpy footage, which eye to crop and lens-correct in-process', choices=['left','right'], default=None)
 
     args = parser.parse_args()
+    if args.ocr_stride > 1 and args.ocr_batch_size > 1:
+        parser.error("-stride and -bs can't be combined")
 
-    EstimateCursor(
-        args.source, 
-        args.events, 
-        args.mapping, 
-        args.output_dir, 
-        
+    options = dict(
         offset_seconds=args.offset_seconds, 
-        video_output_filename=args.output_filename)
+        video_output_filename=args.output_filename,
+        outputs=args.outputs,
+        video_backend=args.video_backend,
+        correct_eye=args.correct_eye,
+        ocr_mode=args.ocr_mode,
+        ocr_stride=args.ocr_stride,
+        ocr_batch_size=args.ocr_batch_size,
+        pipelined=args.pipelined,
+        queue_size=args.queue_size,
+        frame_timestamps=args.timestamps,
+        clock_offset_ms=args.clock_offset,
+        calibration_samples=args.calibration_samples)
+    if args.video_backend == 'ffmpeg':
+        options['video_options'] = dict(
+            codec=args.video_codec,
+            preset=args.video_preset,
+            crf=args.crf,
+            vfr=args.vfr,
+            segment_seconds=args.segment_seconds)
+    if args.workers > 1:
+        EstimateCursorParallel(args.source, args.events, args.mapping, args.output_dir, workers=args.workers, **options)
+    else:
+        EstimateCursor(args.source, args.events, args.mapping, args.output_dir, **options)
 
 """
 import os
@@ -0,0 +1,239 @@
+"""""""""""""""
+This file extracts the presentation timestamp of every frame of a video with `ffprobe`. Captured footage can have a
+variable frame rate, so the time of each frame can't be worked out from its index.
+
+`ffprobe`'s CSV output is read block by block as it is produced, and each block of lines is parsed into compact
+arrays, so memory only grows with the number of frames. The timestamps are sorted (packets come in decode order), and the time between frames
+and some frame rate statistics are computed with NumPy. The result is saved as a binary sidecar next to the video,
+`<video>.timestamps.npy` (e.g. `left.mp4.timestamps.npy`), which `LoadTimestamps()` reads back. It holds one record
+per frame with its timestamp (in seconds, minus the offset) and whether it is a keyframe. The offset is recorded in
+`<video>.timestamps.json`. `-csv` also writes the original `frame_timestamps.csv`.
+
+Given a directory, every video in it is processed, several at a time. Videos whose sidecar is newer than the video
+and was made with the same offset are skipped. With `-csv`, each video's CSV is written next to it as
+`<video>.frame_timestamps.csv`.
+"""""""""""""""
+
+import os
+import csv
+import json
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from FindCropDimensions import VIDEO_EXTENSIONS
+
+SIDECAR_SUFFIX = '.timestamps.npy'
+SETTINGS_SUFFIX = '.timestamps.json'
+CSV_SUFFIX = '.frame_timestamps.csv'
+TIMESTAMP_DTYPE = np.dtype([('timestamp', '<f8'), ('keyframe', '?')])
+# How many of `ffprobe`'s last error lines to report if it fails
+PROBE_ERROR_LINES = 20
+# Deltas further than this from the median (as a fraction of it) mean the frame rate is variable
+VFR_TOLERANCE = 0.1
+
+# The `ffprobe` command that prints the timestamp and flags of every packet of the first video stream, as CSV
+def ProbeCommand(input_vid:str):
+    return ['ffprobe', '-loglevel', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'csv=print_section=0', input_vid]
+
+# Parses `ffprobe`'s CSV output (`<pts_time>,<flags>` lines, from a binary stream) into arrays of timestamps and
+# keyframe flags. The output is read `block_size` bytes at a time, and each block's complete lines are parsed
+# together with NumPy. Packets without a timestamp are skipped.
+def ReadProbeOutput(stream, block_size:int = 1 << 20):
+    timestamps = []
+    keyframes = []
+    remainder = b''
+    while True:
+        block = stream.read(block_size)
+        data = remainder + block
+        if len(block) > 0:
+            cut = data.rfind(b'\n') + 1
+            data, remainder = data[:cut], data[cut:]
+        lines = data.split()
+        if len(lines) > 0:
+            pts_time, _, flags = np.char.partition(np.array(lines), b',').T
+            valid = (pts_time != b'') & (pts_time != b'N/A')
+            timestamps.append(pts_time[valid].astype(np.float64))
+            keyframes.append(np.char.find(flags[valid], b'K') >= 0)
+        if len(block) == 0:
+            break
+    if len(timestamps) == 0:
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=bool)
+    return np.concatenate(timestamps), np.concatenate(keyframes)
+
+# Runs `ffprobe` on a video and reads its output as it comes. Returns the sorted frame records, minus `offset_ts`.
+# Errors go to a temporary file rather than a pipe, so a damaged video that produces a lot of them can't fill the
+# pipe and block `ffprobe` while its output is being read.
+def ProbeTimestamps(input_vid:str, offset_ts:float = 0.0):
+    with tempfile.TemporaryFile() as errfile:
+        with subprocess.Popen(ProbeCommand(input_vid), stdout=subprocess.PIPE, stderr=errfile) as process:
+            timestamps, keyframes = ReadProbeOutput(process.stdout)
+        if process.returncode != 0:
+            errfile.seek(0)
+            errors = errfile.read().decode('utf-8', errors='replace').strip().splitlines()[-PROBE_ERROR_LINES:]
+            raise RuntimeError(f"ffprobe failed on {input_vid}: " + '\n'.join(errors))
+    order = np.argsort(timestamps, kind='stable')
+    frames = np.empty(len(timestamps), dtype=TIMESTAMP_DTYPE)
+    frames['timestamp'] = timestamps[order] - offset_ts
+    frames['keyframe'] = keyframes[order]
+    return frames
+
+# The time between each frame and the one before it, with 0 for the first frame
+def TimestampDeltas(timestamps):
+    return np.diff(timestamps, prepend=timestamps[:1]) if len(timestamps) > 0 else np.empty(0)
+
+# Frame rate statistics of a sorted array of timestamps. The frame rate is variable if more than 1% of the deltas
+# are further than `tolerance` (as a fraction) from the median. Gaps of 1.5 median deltas or more are counted as
+# the number of frames missing from them.
+def TimestampStats(timestamps, tolerance:float = VFR_TOLERANCE):
+    deltas = np.diff(timestamps)
+    stats = {'frames':len(timestamps), 'duration':float(timestamps[-1] - timestamps[0]) if len(timestamps) > 0 else 0.0}
+    if len(deltas) == 0:
+        return stats
+    median = float(np.median(deltas))
+    off = np.abs(deltas - median) > tolerance * median
+    gaps = deltas[deltas >= 1.5 * median]
+    stats.update({
+        'fps_mean':len(deltas) / stats['duration'] if stats['duration'] > 0 else np.nan,
+        'fps_median':1.0 / median if median > 0 else np.nan,
+        'delta_median':median,
+        'delta_min':float(deltas.min()),
+        'delta_max':float(deltas.max()),
+        'delta_std':float(deltas.std()),
+        'irregular_fraction':float(off.mean()),
+        'missing_frames':int(np.sum(np.round(gaps / median) - 1)) if median > 0 else 0,
+        'vfr':bool(off.mean() > 0.01)})
+    return stats
+
+# Returns where the sidecar of a video is saved. The video's extension is kept, so `a.mp4` and `a.avi` don't share one.
+def SidecarFilename(input_vid:str):
+    return input_vid + SIDECAR_SUFFIX
+
+# Returns where the offset a video's sidecar was made with is saved
+def SettingsFilename(input_vid:str):
+    return input_vid + SETTINGS_SUFFIX
+
+# Returns where a video's CSV is saved when a whole directory is processed
+def CSVFilename(input_vid:str):
+    return input_vid + CSV_SUFFIX
+
+# Reads a sidecar back as frame records (see `TIMESTAMP_DTYPE`), memory-mapped
+def LoadTimestamps(sidecar_filepath:str):
+    return np.load(sidecar_filepath, mmap_mode='r')
+
+# Writes the frame records in the CSV format of the original script: frame, timestamp, time_delta
+def SaveTimestampsCSV(frames, csv_outfile:str):
+    with open(csv_outfile, 'w', newline='') as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(['frame', 'timestamp', 'time_delta'])
+        csvwriter.writerows(zip(range(len(frames)), frames['timestamp'].tolist(), TimestampDeltas(frames['timestamp']).tolist()))
+
+# Extracts the timestamps of a video, saves them as a sidecar next to it, and returns the sidecar's path and the
+# frame rate statistics. With `save_csv` or `save_fig`, `frame_timestamps.csv` and/or a plot of the deltas are
+# also saved, in `<video>_timestamps/` if there is a plot. `csv_filepath` saves the CSV somewhere else instead.
+def ExtractTimestamps(input_vid:str, offset_ts:float = 0.0, save_csv:bool = False, save_fig:bool = False, verbose:bool = False, csv_filepath:str = None):
+    if verbose:
+        print(f"Probing frame timestamps of {input_vid}")
+    frames = ProbeTimestamps(input_vid, offset_ts)
+    # The old offset is removed first, so a sidecar that fails half way is never taken as up to date
+    settings_filepath = SettingsFilename(input_vid)
+    if os.path.isfile(settings_filepath):
+        os.remove(settings_filepath)
+    sidecar_filepath = SidecarFilename(input_vid)
+    np.save(sidecar_filepath, frames)
+    with open(settings_filepath, 'w') as jsonfile:
+        json.dump({'offset':offset_ts}, jsonfile, indent=4)
+    stats = TimestampStats(frames['timestamp'])
+
+    if save_csv or save_fig:
+        input_basename = os.path.splitext(os.path.basename(input_vid))[0]
+        output_dir = os.path.join(os.path.dirname(input_vid), input_basename+"_timestamps") if save_fig else os.path.dirname(input_vid)
+        os.makedirs(output_dir, exist_ok=True)
+        if save_csv:
+            SaveTimestampsCSV(frames, os.path.join(output_dir, "frame_timestamps.csv") if csv_filepath is None else csv_filepath)
+        if save_fig:
+            import matplotlib.pyplot as plt
+            plt.figure()
+            plt.plot(TimestampDeltas(frames['timestamp']), c='b')
+            plt.title("Timestamp Deltas")
+            plt.xlabel("Frame #")
+            plt.ylabel("Time Between Frames (sec)")
+            plt.savefig(os.path.join(output_dir,"timestamp_deltas.png"))
+            plt.close()
+
+    if verbose:
+        print(f"{stats['frames']} frames, saved as {sidecar_filepath}")
+    return sidecar_filepath, stats
+
+# Helper: whether a video's sidecar is newer than the video, and was made with the offset `offset_ts`
+def _IsUpToDate(input_vid:str, offset_ts:float = 0.0):
+    sidecar_filepath = SidecarFilename(input_vid)
+    settings_filepath = SettingsFilename(input_vid)
+    if not os.path.isfile(sidecar_filepath) or not os.path.isfile(settings_filepath):
+        return False
+    if os.path.getmtime(sidecar_filepath) <= os.path.getmtime(input_vid):
+        return False
+    with open(settings_filepath) as jsonfile:
+        return json.load(jsonfile).get('offset') == offset_ts
+
+# Extracts the timestamps of every video in a directory, `workers` at a time. Videos with an up-to-date sidecar
+# are skipped unless `force` is set. With `save_csv`, each video's CSV is saved as `<video>.frame_timestamps.csv`,
+# from its sidecar if it was skipped. Returns a table of each video's frame rate statistics.
+def ExtractDirectory(root_dir:str, offset_ts:float = 0.0, save_csv:bool = False, workers:int = None, force:bool = False):
+    videos = sorted(os.path.join(root_dir, f) for f in os.listdir(root_dir) if f.lower().endswith(VIDEO_EXTENSIONS))
+    rows = {}
+    pending = []
+    for video in videos:
+        if not force and _IsUpToDate(video, offset_ts):
+            frames = LoadTimestamps(SidecarFilename(video))
+            if save_csv:
+                SaveTimestampsCSV(frames, CSVFilename(video))
+            rows[video] = {'video':os.path.basename(video), 'status':'skipped', **TimestampStats(frames['timestamp'])}
+        else:
+            pending.append(video)
+    if len(pending) > 0:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {video:pool.submit(ExtractTimestamps, video, offset_ts, save_csv, csv_filepath=CSVFilename(video)) for video in pending}
+            for video, future in futures.items():
+                try:
+                    rows[video] = {'video':os.path.basename(video), 'status':'extracted', **future.result()[1]}
+                except Exception as e:
+                    rows[video] = {'video':os.path.basename(video), 'status':'failed', 'error':str(e)}
+    return pd.DataFrame([rows[video] for video in videos])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', help='The video, or a directory of videos')
+    parser.add_argument('-o', '--offset',
+                        help='If needed, an offset timestamp (in seconds) after the video starts',
+                        type=float,
+                        default=0.0)
+    parser.add_argument('-csv', '--save_csv',
+                        help="Also save the timestamps as `frame_timestamps.csv` (`<video>.frame_timestamps.csv` for each video of a directory)",
+                        action="store_true")
+    parser.add_argument('-sf', '--save_fig',
+                        help="Should we store a figure of all the frame-to-frame time deltas too? Only for a single video",
+                        action="store_true")
+    parser.add_argument('-w', '--workers',
+                        help='How many videos of a directory to process at once. Defaults to the number of CPUs',
+                        type=int,
+                        default=None)
+    parser.add_argument('-fo', '--force',
+                        help='Process every video of a directory, even if its sidecar is up to date and made with the same offset',
+                        action="store_true")
+    parser.add_argument('-v', '--verbose',
+                        help="Should we print statements verbosely?",
+                        action="store_true")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.input):
+        summary = ExtractDirectory(args.input, args.offset, args.save_csv, args.workers, args.force)
+        print(summary.to_string(index=False, float_format=lambda v: f"{v:.4f}"))
+    else:
+        output_file, stats = ExtractTimestamps(args.input, offset_ts=args.offset, save_csv=args.save_csv, save_fig=args.save_fig, verbose=args.verbose)
+        for key, value in stats.items():
+            print(f"{key}: {value}")
+        print(f"Timestamps saved as: {output_file}")
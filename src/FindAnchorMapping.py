@@ -6,14 +6,8 @@ import cv2
 import json
 import argparse
 
-parser = argparse.ArgumentParser()
-parser.add_argument('root',help='The root directory to an AM session')
-parser.add_argument('template',help="The relative path to the template image for the anchor points.")
-parser.add_argument('outfile',help='The name of the JSON file where to output the results')
-args = parser.parse_args()
-
 """
-The Root Directory (args.root) should contain the following files:
+The Root Directory (root_dir) should contain the following files:
 - center.png
 - topleft.png
 - topright.png
@@ -22,114 +16,273 @@ The Root Directory (args.root) should contain the following files:
 We need to check if these files are present
 """
 
-_EXTRACTED_FRAMES = {
-    'center':cv2.imread(os.path.join(args.root, 'center.png')),
-    'topleft':cv2.imread(os.path.join(args.root, 'topleft.png')),
-    'topright':cv2.imread(os.path.join(args.root, 'topright.png')),
-    'bottomleft':cv2.imread(os.path.join(args.root, 'bottomleft.png'))
+# Each anchor's snapshot (`<key>.png`) and its description in `vr.csv`
+ANCHORS = {
+    'center':"Center",
+    'topleft':"Top Left",
+    'topright':"Top Right",
+    'bottomleft':"Bottom Left"
 }
-_REF_HEIGHT, _REF_WIDTH, _ = _EXTRACTED_FRAMES['center'].shape
-print("SCRCPY LEFT EYE CAPTURE SIZE: ", _REF_HEIGHT, _REF_WIDTH)
+VR_FILENAME = 'vr.csv'
+# Default spacing (in VR screen units) of the lookup table's grid, and how far past the calibration points it extends,
+# as a fraction of their extent
+LUT_STEP = 4.0
+LUT_MARGIN = 0.5
+
+# Returns the files a session directory needs, in a fixed order
+def SessionFiles(root_dir:str):
+    return [os.path.join(root_dir, key+'.png') for key in ANCHORS] + [os.path.join(root_dir, VR_FILENAME)]
+
+# Helper: is this directory a session that can be calibrated?
+def IsSession(root_dir:str):
+    return all(os.path.isfile(f) for f in SessionFiles(root_dir))
+
+# Helper: the snapshot name of an anchor's description in `vr.csv`, e.g. "Top Left" => `topleft`
+def _SnapshotKey(description:str):
+    return description.replace(' ', '').lower()
+
+# Returns the four anchors' snapshot names, followed by those of any extra calibration points in `vr.csv` that
+# have a snapshot in `root_dir`
+def CalibrationKeys(root_dir:str, side:str = "Left"):
+    events_df = pd.read_csv(os.path.join(root_dir, VR_FILENAME))
+    descriptions = events_df[(events_df['event_type'] == "Anchor") & (events_df['title'] == side)]['description']
+    keys = list(ANCHORS)
+    for description in descriptions.dropna().unique():
+        key = _SnapshotKey(description)
+        if key not in keys and os.path.isfile(os.path.join(root_dir, key+'.png')):
+            keys.append(key)
+    return keys
+
+# Returns every file a session's calibration reads: `vr.csv` and the snapshots of all of its calibration points
+def CalibrationFiles(root_dir:str):
+    return [os.path.join(root_dir, key+'.png') for key in CalibrationKeys(root_dir)] + [os.path.join(root_dir, VR_FILENAME)]
 
+# Returns the name of the lookup table written next to a mapping file, e.g. `mappings.json` => `mappings_lut.npy`
+def LookupTableFilename(outfile:str):
+    return os.path.splitext(outfile)[0] + '_lut.npy'
 
 """
 We need to get the anchor positions from the `vr.csv` file, which should give us the screen point scale of each anchor point, as seen by the left eye camera
+Note that the origin is on the bottom left
 """
-
-_EVENTS_DF = pd.read_csv(os.path.join(args.root, 'vr.csv'))
-cam_rows = _EVENTS_DF[
-    (_EVENTS_DF['event_type'] == "Anchor") 
-    & (_EVENTS_DF['title'] == "Left")
-]
-cam_center = cam_rows[cam_rows['description'] == "Center"].values[0]
-cam_topleft = cam_rows[cam_rows['description'] == "Top Left"].values[0]
-cam_topright = cam_rows[cam_rows['description'] == "Top Right"].values[0]
-cam_bottomleft = cam_rows[cam_rows['description'] == "Bottom Left"].values[0]
-# Note that the origin is on the bottom left
-_VR_ANCHOR_POSITIONS = {
-    'center':{
-        'x':cam_center[4],
-        'y':cam_center[5],
-        'coords':[cam_center[4],cam_center[5]]
-    },
-    'topleft':{
-        'x':cam_topleft[4],
-        'y':cam_topleft[5],
-        'coords':[cam_topleft[4],cam_topleft[5]]
-    },
-    'topright':{
-        'x':cam_topright[4],
-        'y':cam_topright[5],
-        'coords':[cam_topright[4],cam_topright[5]]
-    },
-    'bottomleft':{
-        'x':cam_bottomleft[4],
-        'y':cam_bottomleft[5],
-        'coords':[cam_bottomleft[4],cam_bottomleft[5]]
-    }
-}
+def ReadVRAnchors(vr_filepath:str, side:str = "Left", keys = None):
+    events_df = pd.read_csv(vr_filepath)
+    cam_rows = events_df[
+        (events_df['event_type'] == "Anchor")
+        & (events_df['title'] == side)
+    ]
+    descriptions = {_SnapshotKey(d):d for d in cam_rows['description'].dropna().unique()}
+    descriptions.update(ANCHORS)
+    positions = {}
+    for key in (ANCHORS if keys is None else keys):
+        row = cam_rows[cam_rows['description'] == descriptions[key]].values[0]
+        positions[key] = {
+            'x':row[4],
+            'y':row[5],
+            'coords':[row[4],row[5]]
+        }
+    return positions
 
 """
 We now need to calculate the image positions of each reference image extracted from our SCRCPY image
 Note that we do an additional subtraction where we subtract the height from the predicted center.
 This is because we need to change the detected y-axis position to be relative to the bottom left, as opposed to the top left.
 """
-_IMAGE_ANCHOR_POSITIONS = {}
-for key, value in _EXTRACTED_FRAMES.items():
-    mean_center, median_center = FT.FindTemplateMatch(value, args.template, thresh=0.975)
-    # Note that the coordinates are provided in (x,y) format, with respect to the origin being on the topleft corner
-    # We need to remap these coordinates to be relative to the bottom left instead
-    new_y = _REF_HEIGHT - median_center[1]
-    _IMAGE_ANCHOR_POSITIONS[key] = {
-        'x':median_center[0],
-        'y':new_y,
-        'coords':[median_center[0],new_y]
+def FindImageAnchors(root_dir:str, template_filename:str, thresh:float = 0.975, verbose:bool = False, keys = None):
+    positions = {}
+    for key in (ANCHORS if keys is None else keys):
+        frame = cv2.imread(os.path.join(root_dir, key+'.png'))
+        ref_height = frame.shape[0]
+        if verbose and key == 'center':
+            print("SCRCPY LEFT EYE CAPTURE SIZE: ", frame.shape[0], frame.shape[1])
+        mean_center, median_center = FT.FindTemplateMatch(frame, template_filename, thresh=thresh)
+        # Note that the coordinates are provided in (x,y) format, with respect to the origin being on the topleft corner
+        # We need to remap these coordinates to be relative to the bottom left instead
+        new_y = ref_height - median_center[1]
+        positions[key] = {
+            'x':median_center[0],
+            'y':new_y,
+            'coords':[median_center[0],new_y]
+        }
+    return positions
+
+# Solves for the 3x2 transformation matrix `x` that maps VR coordinates to image coordinates: Ax => (nx3)(3x2)
+def FitTransformation(vr_positions:dict, img_positions:dict, verbose:bool = False):
+    vr_coords = np.array([vr_positions[key]['coords'] for key in ANCHORS], dtype=np.float64)
+    img_coords = np.array([img_positions[key]['coords'] for key in ANCHORS], dtype=np.float64)
+    # Square matrix
+    A = np.vstack([vr_coords.T, np.ones(len(vr_coords))]).T
+    if verbose:
+        print(A)
+    # Least squares method
+    x, res, rank, s = np.linalg.lstsq(A, img_coords, rcond=None)
+    if verbose:
+        print(x)
+    return x
+
+# Returns the monomials x^i * y^j (i + j <= degree) of each point, as a (n x terms) matrix.
+# Degree 1 gives the same columns as the affine fit: [x, y, 1] up to order.
+def PolynomialTerms(coords, degree:int):
+    x, y = coords[:,0], coords[:,1]
+    return np.column_stack([x**(d-j) * y**j for d in range(degree+1) for j in range(d+1)])
+
+# Helper: evaluates a polynomial model (see `FitPolynomial`) at (n x 2) VR coordinates
+def _EvaluatePolynomial(model:dict, coords):
+    normalized = (np.asarray(coords, dtype=np.float64) - model['center']) / model['scale']
+    return PolynomialTerms(normalized, model['degree']) @ np.asarray(model['coefficients'], dtype=np.float64)
+
+# Fits a 2D polynomial of the given degree from VR coordinates to image coordinates over every calibration point,
+# which can follow the lens distortion that the affine transformation can't. Coordinates are centered and scaled
+# first so that the higher powers stay well conditioned. Points whose anchor wasn't found in the image are skipped.
+def FitPolynomial(vr_positions:dict, img_positions:dict, degree:int = 2):
+    keys = [key for key in vr_positions if np.all(np.isfinite(img_positions[key]['coords']))]
+    n_terms = (degree+1) * (degree+2) // 2
+    if len(keys) < n_terms:
+        raise ValueError(f"A degree {degree} model needs at least {n_terms} calibration points, but only {len(keys)} were found")
+    vr_coords = np.array([vr_positions[key]['coords'] for key in keys], dtype=np.float64)
+    img_coords = np.array([img_positions[key]['coords'] for key in keys], dtype=np.float64)
+    center = vr_coords.mean(axis=0)
+    scale = max(float(np.abs(vr_coords - center).max()), 1.0)
+    model = {'degree':degree, 'center':center.tolist(), 'scale':scale}
+    coefficients, res, rank, s = np.linalg.lstsq(PolynomialTerms((vr_coords - center) / scale, degree), img_coords, rcond=None)
+    model['coefficients'] = coefficients.tolist()
+    return model
+
+# Evaluates a polynomial model on a regular grid over the calibration points' bounding box, padded by `margin` times
+# its size on each side. Returns the (rows x cols x 2) float32 table of image coordinates, and the grid's origin.
+def BakeLookupTable(model:dict, vr_coords, step:float = LUT_STEP, margin:float = LUT_MARGIN):
+    vr_coords = np.asarray(vr_coords, dtype=np.float64)
+    low, high = vr_coords.min(axis=0), vr_coords.max(axis=0)
+    pad = (high - low) * margin
+    origin = low - pad
+    cols, rows = (np.ceil((high + pad - origin) / step).astype(np.int64) + 1).tolist()
+    gx, gy = np.meshgrid(origin[0] + step*np.arange(cols), origin[1] + step*np.arange(rows))
+    table = _EvaluatePolynomial(model, np.column_stack([gx.ravel(), gy.ravel()]))
+    return table.reshape(rows, cols, 2).astype(np.float32), origin.tolist()
+
+# Projects VR screen points into image coordinates (origin on the bottom left), using either the affine
+# `transformation_matrix` or, if the mapping has one, its dense lookup table.
+# With a lookup table, each point is bilinearly interpolated from the four grid nodes around it, for all points at
+# once, so the cost per point doesn't depend on the model. Points outside the grid are extrapolated from the
+# nearest cell.
+class Projection:
+    def __init__(self, transformation_matrix, table = None, origin = None, step:float = None):
+        self.transformation_matrix = np.asarray(transformation_matrix, dtype=np.float64)
+        self.table = table
+        self.origin = None if origin is None else np.asarray(origin, dtype=np.float64)
+        self.step = step
+
+    # Returns the (n x 2) image coordinates of (n x 2) VR screen coordinates
+    def Project(self, coords):
+        coords = np.asarray(coords, dtype=np.float64)
+        if self.table is None:
+            A = np.hstack([coords, np.ones((len(coords), 1))])
+            return A @ self.transformation_matrix
+        rows, cols = self.table.shape[:2]
+        f = (coords - self.origin) / self.step
+        cell = np.clip(np.floor(f), 0, [cols-2, rows-2])
+        t = f - cell
+        tx, ty = t[:,0:1], t[:,1:2]
+        # Gather the four corners of each point's cell from the flattened table
+        flat = self.table.reshape(-1, 2)
+        idx = cell[:,1].astype(np.int64) * cols + cell[:,0].astype(np.int64)
+        top = flat[idx]
+        top += (flat[idx+1] - top) * tx
+        bottom = flat[idx+cols]
+        bottom += (flat[idx+cols+1] - bottom) * tx
+        return top + (bottom - top) * ty
+
+# Loads the projection of a mapping file, along with its lookup table if it has one
+def LoadProjection(mapping_filepath:str):
+    with open(mapping_filepath) as jsonfile:
+        mapping = json.load(jsonfile)
+    if 'lookup_table' not in mapping:
+        return Projection(mapping['transformation_matrix'])
+    lut = mapping['lookup_table']
+    table = np.load(os.path.join(os.path.dirname(mapping_filepath), lut['filename']))
+    return Projection(mapping['transformation_matrix'], table, lut['origin'], lut['step'])
+
+# Returns the distance (in pixels) between where the mapping puts each calibration point and where it was found in
+# the image. This uses the polynomial model over all points if the mapping has one, and the affine transformation
+# over the four anchors otherwise.
+def AnchorResiduals(mapping:dict):
+    keys = list(mapping['img_anchors_positions']) if 'model' in mapping else list(ANCHORS)
+    vr_coords = np.array([mapping['vr_anchors_positions'][key]['coords'] for key in keys], dtype=np.float64)
+    img_coords = np.array([mapping['img_anchors_positions'][key]['coords'] for key in keys], dtype=np.float64)
+    if 'model' in mapping:
+        estimates = _EvaluatePolynomial(mapping['model'], vr_coords)
+    else:
+        A = np.hstack([vr_coords, np.ones((len(vr_coords), 1))])
+        estimates = A @ np.array(mapping['transformation_matrix'])
+    return dict(zip(keys, np.linalg.norm(estimates - img_coords, axis=1).tolist()))
+
+# Calibrates a single session: finds the anchors in its four snapshots, fits the transformation from its `vr.csv`,
+# and writes the result to `<root_dir>/<outfile>` if `outfile` is given. Returns the mapping.
+# With `degree` above 1, every calibration point with a snapshot (see `CalibrationKeys`) is also used to fit a
+# polynomial model, which is baked into a lookup table saved next to the JSON (see `LookupTableFilename`).
+def FindAnchorMapping(
+        root_dir:str,
+        template_filename:str,
+        outfile:str = None,
+        thresh:float = 0.975,
+        verbose:bool = False,
+        degree:int = 1,
+        lut_step:float = LUT_STEP,
+        lut_margin:float = LUT_MARGIN):
+    missing = [f for f in SessionFiles(root_dir) if not os.path.isfile(f)]
+    if len(missing) > 0:
+        raise FileNotFoundError(f"Session {root_dir} is missing {', '.join(os.path.basename(f) for f in missing)}")
+    keys = CalibrationKeys(root_dir) if degree > 1 else list(ANCHORS)
+    vr_positions = ReadVRAnchors(os.path.join(root_dir, VR_FILENAME), keys=keys)
+    img_positions = FindImageAnchors(root_dir, template_filename, thresh=thresh, verbose=verbose, keys=keys)
+
+    # INTERMISSION: Print out current results
+    if verbose:
+        print("FROM VR:", vr_positions)
+        print("FROM CV2:", img_positions)
+
+    # In other words, `x` is the transformation matrix. It will be a 3x2 matrix
+    # All that needs to be done beforehand is to create `A`.
+    # The transformation results in Ax => (nx3)(3x2) where `n` is the number of coordinates you want to transform
+    x = FitTransformation(vr_positions, img_positions, verbose=verbose)
+
+    output = {
+        'vr_anchors_positions':vr_positions,
+        'img_anchors_positions':img_positions,
+        'transformation_matrix':x.tolist(),
     }
+    table = None
+    if degree > 1:
+        output['model'] = FitPolynomial(vr_positions, img_positions, degree)
+        vr_coords = [vr_positions[key]['coords'] for key in keys]
+        table, origin = BakeLookupTable(output['model'], vr_coords, lut_step, lut_margin)
+        if outfile is not None:
+            output['lookup_table'] = {
+                'filename':LookupTableFilename(outfile),
+                'origin':origin,
+                'step':lut_step,
+                'shape':list(table.shape)
+            }
+        if verbose:
+            print("RESIDUALS:", AnchorResiduals(output))
+    if outfile is not None:
+        with open(os.path.join(root_dir, outfile), "w") as jsonfile:
+            json.dump(output, jsonfile, indent=4)
+        if table is not None:
+            np.save(os.path.join(root_dir, LookupTableFilename(outfile)), table)
+    return output
 
-# INTERMISSION: Print out current results
-print("FROM VR:", _VR_ANCHOR_POSITIONS)
-print("FROM CV2:", _IMAGE_ANCHOR_POSITIONS)
-
-# Step 3: Set up system of equations
-# Step 3a: 10m calculations
-vr_coords = np.array([
-    _VR_ANCHOR_POSITIONS['center']['coords'],
-    _VR_ANCHOR_POSITIONS['topleft']['coords'],
-    _VR_ANCHOR_POSITIONS['topright']['coords'],
-    _VR_ANCHOR_POSITIONS['bottomleft']['coords']
-])
-img_coords = np.array([
-    _IMAGE_ANCHOR_POSITIONS['center']['coords'],
-    _IMAGE_ANCHOR_POSITIONS['topleft']['coords'],
-    _IMAGE_ANCHOR_POSITIONS['topright']['coords'],
-    _IMAGE_ANCHOR_POSITIONS['bottomleft']['coords']
-])
-# Square matrix
-A = np.vstack([vr_coords.T, np.ones(4)]).T
-print(A)
-# Least squares method
-x, res, rank, s = np.linalg.lstsq(A, img_coords, rcond=None)
-print(x)
-
-# Now, we can calculate the estimated transformation from vr to img coordinates using np.dot
-# In other words, `x` is the transformation matrix. It will be a 3x2 matrix
-# All that needs to be done beforehand is to create `A`.
-# The transformation results in Ax => (nx3)(3x2) where `n` is the number of coordinates you want to transform
-#print(np.dot(A_10m,x_10m))
-
-# Now, we can calculate the estimated transformation from vr to img coordinates using np.dot
-# In other words, `x` is the transformation matrix. It will be a 3x2 matrix
-# All that needs to be done beforehand is to create `A`.
-# The transformation results in Ax => (nx3)(3x2) where `n` is the number of coordinates you want to transform
-#print(np.dot(A_10m,x_10m))
-
-output = {
-    'vr_anchors_positions':_VR_ANCHOR_POSITIONS,
-    'img_anchors_positions':_IMAGE_ANCHOR_POSITIONS,
-    'transformation_matrix':x.tolist(),
-}
-with open(os.path.join(args.root, args.outfile), "w") as outfile: 
-    json.dump(output, outfile, indent=4)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root',help='The root directory to an AM session')
+    parser.add_argument('template',help="The relative path to the template image for the anchor points.")
+    parser.add_argument('outfile',help='The name of the JSON file where to output the results')
+    parser.add_argument('-d','--degree',help='Also fit a polynomial model of this degree from every calibration point in `vr.csv` with a snapshot, and save it as a lookup table', type=int, default=1)
+    parser.add_argument('-ls','--lut_step',help='The grid spacing of the lookup table, in VR screen units', type=float, default=LUT_STEP)
+    parser.add_argument('-lm','--lut_margin',help='How far the lookup table extends past the calibration points, as a fraction of their extent', type=float, default=LUT_MARGIN)
+    args = parser.parse_args()
+
+    FindAnchorMapping(args.root, args.template, args.outfile, verbose=True, degree=args.degree, lut_step=args.lut_step, lut_margin=args.lut_margin)
 
 """
 Why we need to do this:
@@ -1,67 +1,173 @@
 import os
+import re
 import numpy as np
 import cv2
 import argparse
 
-# Argument parser - the user must specify the image to use
-parser = argparse.ArgumentParser()
-parser.add_argument('source', help="The image to use.")
-parser.add_argument('-p', '--preview', default=False, help="Should we render the preview of the cutted image?")
-args = parser.parse_args()
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov', '.webm')
+# The white level that used to be fixed, used when the frames have no clear white background
+DEFAULT_WHITE_VALUE = 242
+# How much of the frame a bright gray value must cover to be taken as the white background
+MIN_WHITE_FRACTION = 0.05
 
-# Read the image in grayscale
-src_raw = cv2.imread(args.source)
-src_gray = cv2.cvtColor(src_raw, cv2.COLOR_BGR2GRAY)
+# Estimates the white level of raw scrcpy frames as the most common bright gray value in their histogram.
+# `hist` is a 256-bin histogram of gray values, summed over as many frames as you like.
+# The clipped 255 bin is left out, as it holds saturated scene content rather than the background. If no bright value
+# covers at least `min_fraction` of the pixels, there is no background to go by and `DEFAULT_WHITE_VALUE` is used.
+def EstimateWhiteLevel(hist, min_value:int = 200, min_fraction:float = MIN_WHITE_FRACTION):
+    bright = hist[min_value:255]
+    if len(bright) == 0 or bright.max() < min_fraction * hist.sum():
+        return DEFAULT_WHITE_VALUE
+    return int(min_value + np.argmax(bright))
 
-# Need to detect the rightmost true white x-coordinate
-# For the moment, '242' is the most ocmmon white value. You'll have to find a way to determine this yourself.
-white_pixels = np.array(np.where(src_gray == 242))
-min_x = min(white_pixels[1])
-max_x = max(white_pixels[1])
+# Returns the leftmost and rightmost columns of a gray frame that contain the white level, or None if none do.
+# This reduces the frame column-wise instead of collecting the coordinates of every white pixel.
+def WhiteColumns(src_gray, white_value:int):
+    columns = np.flatnonzero((src_gray == white_value).any(axis=0))
+    if len(columns) == 0:
+        return None
+    return int(columns[0]), int(columns[-1])
 
-# Based on the rightmost white pixel, we have to extract the leftmost crop amount
-src_shape = np.shape(src_gray)
-right_crop = src_shape[1]-max_x
-new_min_x = min_x - right_crop
+# Helper: turns the white columns of a (width x height) frame into the leftmost crop amount and the (w,h,x,y)
+# crops of each eye. The right edge of the white area tells how much is cut off on the right, which is
+# assumed to be the same on the left. Raises a ValueError if that doesn't give a crop inside the frame.
+def _EyeCrops(min_x:int, max_x:int, width:int, height:int):
+    right_crop = width-max_x
+    new_min_x = min_x - right_crop
+    out_x = width - new_min_x
+    out_x_half = round(out_x / 2)
+    if new_min_x < 0 or out_x_half <= 0:
+        raise ValueError(f"The white area (columns {min_x} to {max_x} of {width}) doesn't give a valid crop, is this a raw scrcpy frame?")
+    left = (out_x_half, height, int(new_min_x), 0)
+    right = (out_x_half, height, int(new_min_x+out_x_half), 0)
+    return int(new_min_x), left, right
 
-# Based on these, we will have to crop the image accordingly
-crop = src_raw[:,new_min_x:]
-crop_shape = np.shape(crop)
+# Estimates the crop of the left and right eye views from a raw scrcpy frame.
+# The white level is estimated from the frame if `white_value` isn't given (it used to be fixed at 242).
+# Returns the leftmost crop amount, the cropped image, and the (w,h,x,y) crops of each eye.
+def FindCropDimensions(src_raw, white_value:int = None):
+    # Read the image in grayscale
+    src_gray = cv2.cvtColor(src_raw, cv2.COLOR_BGR2GRAY)
+    if white_value is None:
+        white_value = EstimateWhiteLevel(np.bincount(src_gray.ravel(), minlength=256))
 
-# Print the results
-dirname = os.path.dirname(args.source)
-basename = os.path.basename(args.source)
-filename = os.path.splitext(basename)[0]
-results_filename = os.path.join(dirname,filename+".txt")
-# If the filename exists alreayd, delete it.
-if os.path.exists(results_filename):
-    os.remove(results_filename)
-# Get the params
-out_x = src_shape[1] - new_min_x
-out_y = src_shape[0]
-out_x_half = round(out_x / 2)
-with open(results_filename, 'a') as file:
-    file.write(f'Left_crop: {new_min_x}\n')
-    file.write('Crop range:\n')
-    file.write(f'\tX: {new_min_x} - {src_shape[1]}\n')
-    file.write(f'\tY: 0 - {src_shape[0]}\n')
-    file.write('FFMPEG command filters:\n')
-    file.write(f"\tLEFT EYE: crop={out_x_half}:{out_y}:{new_min_x}:0\n")
-    file.write(f"\tRIGHT EYE: crop={out_x_half}:{out_y}:{new_min_x+out_x_half}:0\n")
-    file.write(f'Cropped image shape: {np.shape(crop)}')
+    # Need to detect the leftmost and rightmost true white x-coordinates
+    edges = WhiteColumns(src_gray, white_value)
+    if edges is None:
+        raise ValueError(f"The image doesn't contain the white level {white_value}")
+    min_x, max_x = edges
 
-print(f'For file "{args.source}":')
-print(f'Left_crop: {new_min_x}')
-print('Crop range:')
-print(f'\tX: {new_min_x} - {src_shape[1]}')
-print(f'\tY: 0 - {src_shape[0]}')
-print(f'cropped image shape: {np.shape(crop)}')
-print('FFMPEG command filters:')
-print(f"\tLEFT EYE: crop={out_x_half}:{out_y}:{new_min_x}:0")
-print(f"\tRIGHT EYE: crop={out_x_half}:{out_y}:{new_min_x+out_x_half}:0")
-print(f'Results stored in "{results_filename}"')
-    
-if args.preview:
-    cv2.imshow("hello", crop)
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
\ No newline at end of file
+    # Based on these, we will have to crop the image accordingly
+    new_min_x, left, right = _EyeCrops(min_x, max_x, src_gray.shape[1], src_gray.shape[0])
+    crop = src_raw[:,new_min_x:]
+    return new_min_x, crop, left, right
+
+# Yields (frame index, frame) for `n_samples` frames spread evenly across a video. Each sample is a seek to
+# its frame, so only the frames around the samples are decoded, however long the video is.
+def SampleFrames(video_filepath:str, n_samples:int = 9):
+    vidcap = cv2.VideoCapture(video_filepath)
+    if not vidcap.isOpened():
+        raise FileNotFoundError(f"Unable to open video: {video_filepath}")
+    n_frames = int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT))
+    # Skip the very start and end, where the headset is often still being put on or taken off
+    if n_frames > 0:
+        indices = np.unique(np.linspace(0, n_frames-1, n_samples+2).astype(np.int64)[1:-1])
+    else:
+        indices = np.arange(n_samples)
+    for index in indices:
+        if n_frames > 0:
+            vidcap.set(cv2.CAP_PROP_POS_FRAMES, int(index))
+        success, frame = vidcap.read()
+        if success:
+            yield int(index), frame
+    vidcap.release()
+
+# Estimates the crop of the left and right eye views from a raw scrcpy video, using `n_samples` frames spread across it.
+# The white level is estimated from the histogram of all of the samples together, and the white columns are found in
+# each sample separately. The median of the samples' edges is used, so a few frames with little white in them
+# (e.g. a dark scene) don't shift the crop.
+# Returns the leftmost crop amount, the (w,h,x,y) crops of each eye, and the (width,height) of the video.
+def FindVideoCropDimensions(video_filepath:str, n_samples:int = 9, white_value:int = None):
+    grays = [cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for index, frame in SampleFrames(video_filepath, n_samples)]
+    if len(grays) == 0:
+        raise ValueError(f"No frames could be read from {video_filepath}")
+    if white_value is None:
+        hist = np.zeros(256, dtype=np.int64)
+        for gray in grays:
+            hist += np.bincount(gray.ravel(), minlength=256)
+        white_value = EstimateWhiteLevel(hist)
+    edges = [c for c in (WhiteColumns(gray, white_value) for gray in grays) if c is not None]
+    if len(edges) == 0:
+        raise ValueError(f"None of the sampled frames of {video_filepath} contain the white level {white_value}")
+    min_x, max_x = np.median(np.array(edges), axis=0).round().astype(np.int64).tolist()
+    height, width = grays[0].shape
+    new_min_x, left, right = _EyeCrops(min_x, max_x, width, height)
+    return new_min_x, left, right, (width, height)
+
+# Reads the left and right eye crops back from a results file written by this script, as (w,h,x,y) tuples
+def ReadCropFile(results_filename):
+    crops = {}
+    with open(results_filename) as file:
+        for line in file:
+            match = re.search(r'(LEFT|RIGHT) EYE: crop=(\d+):(\d+):(\d+):(\d+)', line)
+            if match:
+                crops[match.group(1).lower()] = tuple(int(v) for v in match.groups()[1:])
+    if 'left' not in crops or 'right' not in crops:
+        raise ValueError(f"No left and right eye crops found in {results_filename}")
+    return crops['left'], crops['right']
+
+def main(args):
+    if os.path.splitext(args.source)[1].lower() in VIDEO_EXTENSIONS:
+        new_min_x, left, right, (width, height) = FindVideoCropDimensions(args.source, args.n_samples, args.white_value)
+        src_shape = (height, width, 3)
+        crop = None
+        crop_shape = (height, width-new_min_x, 3)
+    else:
+        src_raw = cv2.imread(args.source)
+        src_shape = np.shape(src_raw)
+        new_min_x, crop, left, right = FindCropDimensions(src_raw, args.white_value)
+        crop_shape = np.shape(crop)
+
+    # Print the results
+    dirname = os.path.dirname(args.source)
+    basename = os.path.basename(args.source)
+    filename = os.path.splitext(basename)[0]
+    results_filename = os.path.join(dirname,filename+".txt")
+    # If the filename exists alreayd, delete it.
+    if os.path.exists(results_filename):
+        os.remove(results_filename)
+    with open(results_filename, 'a') as file:
+        file.write(f'Left_crop: {new_min_x}\n')
+        file.write('Crop range:\n')
+        file.write(f'\tX: {new_min_x} - {src_shape[1]}\n')
+        file.write(f'\tY: 0 - {src_shape[0]}\n')
+        file.write('FFMPEG command filters:\n')
+        file.write(f"\tLEFT EYE: crop={left[0]}:{left[1]}:{left[2]}:{left[3]}\n")
+        file.write(f"\tRIGHT EYE: crop={right[0]}:{right[1]}:{right[2]}:{right[3]}\n")
+        file.write(f'Cropped image shape: {crop_shape}')
+
+    print(f'For file "{args.source}":')
+    print(f'Left_crop: {new_min_x}')
+    print('Crop range:')
+    print(f'\tX: {new_min_x} - {src_shape[1]}')
+    print(f'\tY: 0 - {src_shape[0]}')
+    print(f'cropped image shape: {crop_shape}')
+    print('FFMPEG command filters:')
+    print(f"\tLEFT EYE: crop={left[0]}:{left[1]}:{left[2]}:{left[3]}")
+    print(f"\tRIGHT EYE: crop={right[0]}:{right[1]}:{right[2]}:{right[3]}")
+    print(f'Results stored in "{results_filename}"')
+
+    if args.preview and crop is not None:
+        cv2.imshow("hello", crop)
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()
+
+if __name__ == "__main__":
+    # Argument parser - the user must specify the image or raw video to use
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source', help="The image or raw scrcpy video to use.")
+    parser.add_argument('-p', '--preview', default=False, help="Should we render the preview of the cutted image?")
+    parser.add_argument('-n', '--n_samples', type=int, default=9, help="How many frames to sample from a video")
+    parser.add_argument('-w', '--white_value', type=int, default=None, help="The gray value of the white area. Estimated from the frames if not given")
+    args = parser.parse_args()
+    main(args)
\ No newline at end of file
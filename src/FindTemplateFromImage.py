@@ -1,7 +1,293 @@
+import os
+import glob
+import time
+import threading
 import numpy as np
 import argparse
 import cv2
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
+# The result map is refined at full resolution in tiles of at least this size (in pixels)
+_TILE_SIZE = 32
+
+# Templates are never shrunk below this size (in pixels) at the coarse level, as they become too blurry to be trusted.
+# Small templates are therefore matched against a less downscaled frame, or at full resolution if that isn't worth it.
+_MIN_COARSE_SIZE = 6
+_MAX_COARSE_SCALE = 0.75
+
+# Loads a template once and searches frames for it at several sizes. The resized templates, split into BGR
+# and a 3-channel alpha mask, are cached for both full resolution and the downscaled coarse level.
+# Each size is first matched against a copy of the frame downscaled by `coarse_scale` (or less, for small templates),
+# with a threshold lowered by `coarse_margin`.
+# Only the windows around the coarse candidates are then matched at full resolution, which gives the same
+# matches as searching the whole frame as long as every true match also passes the coarse level.
+# With `workers` > 1, the sizes are searched in parallel on a pool of threads (OpenCV releases the GIL).
+# Sizes of at least `fft_min_size` that have to be searched over the whole frame are correlated in the frequency
+# domain instead, where the frame is transformed once and then shared by every size.
+class TemplateMatcher:
+    def __init__(
+            self,
+            template,
+            min_size=10,
+            max_size=50,
+            delta_size=5,
+            coarse_scale=0.25,
+            coarse_margin=0.1,
+            workers=1,
+            fft_min_size=None):
+        # `template` is either a filename or an already-loaded BGRA image
+        self.template = cv2.imread(template, cv2.IMREAD_UNCHANGED) if isinstance(template, str) else template
+        if self.template is None or self.template.ndim != 3 or self.template.shape[2] != 4:
+            raise ValueError(f"The template must be an image with an alpha channel: {template}")
+        self.sizes = [int(p) for p in np.arange(min_size, max_size, delta_size)]
+        self.coarse_scale = coarse_scale
+        self.coarse_margin = coarse_margin
+        self.workers = workers
+        self.fft_min_size = fft_min_size
+        self._templates = {}
+        self._spectra = {}
+        self._pool = None
+        self._lock = threading.Lock()
+
+    # Returns the (BGR, alpha) template of the given size, at the given scale, resized the same way as before
+    def GetTemplate(self, size:int, scale:float = 1.0):
+        key = (size, scale)
+        if key not in self._templates:
+            template_resize = cv2.resize(self.template, (size,size))
+            if scale != 1.0:
+                small = max(int(round(size*scale)), 1)
+                template_resize = cv2.resize(template_resize, (small,small), interpolation=cv2.INTER_AREA)
+            # We assume transparency, so we have to separate alpha from bgr
+            alpha = template_resize[:,:,3]
+            self._templates[key] = (np.ascontiguousarray(template_resize[:,:,0:3]), cv2.merge([alpha,alpha,alpha]))
+        return self._templates[key]
+
+    # Helper: the scale that a template of the given size is searched for at in the coarse level, or None if
+    # it should only be searched for at full resolution
+    def _CoarseScale(self, size:int):
+        scale = max(self.coarse_scale, _MIN_COARSE_SIZE/size)
+        return scale if scale <= _MAX_COARSE_SCALE else None
+
+    # Helper: the top-left positions (full resolution) whose match might pass `thresh`, as a list of disjoint
+    # (x, y, w, h) windows of the result map. None means the whole frame has to be searched.
+    def _CoarseWindows(self, frame_small, size:int, scale:float, thresh:float, result_shape):
+        template, alpha = self.GetTemplate(size, scale)
+        if template.shape[0] > min(frame_small.shape[:2]):
+            return None
+        res = cv2.matchTemplate(frame_small, template, cv2.TM_CCORR_NORMED, mask=alpha)
+        # Windows with no variance under the mask score NaN or infinity, and are kept since they may not at full resolution
+        ys, xs = np.nonzero((res >= thresh - self.coarse_margin) | ~np.isfinite(res))
+        if len(xs) == 0:
+            return []
+
+        # Each coarse candidate stands for the full resolution positions it was downscaled from, padded by a few pixels.
+        # Mark the tiles of the result map that those fall in. A tile is at least as large as that span, so
+        # the corners of the span are enough to mark every tile it overlaps.
+        pad = int(np.ceil(1/scale)) + 1
+        tile = max(_TILE_SIZE, int(np.ceil(1/scale)) + 2*pad + 1)
+        rows, cols = result_shape
+        x1 = np.clip((xs/scale).astype(int) - pad, 0, cols-1) // tile
+        x2 = np.clip(np.ceil((xs+1)/scale).astype(int) + pad, 0, cols-1) // tile
+        y1 = np.clip((ys/scale).astype(int) - pad, 0, rows-1) // tile
+        y2 = np.clip(np.ceil((ys+1)/scale).astype(int) + pad, 0, rows-1) // tile
+        active = np.zeros(((rows-1)//tile + 1, (cols-1)//tile + 1), dtype=bool)
+        for ty, tx in [(y1, x1), (y1, x2), (y2, x1), (y2, x2)]:
+            active[ty, tx] = True
+        # If most of the frame is a candidate, a single search over the whole frame is cheaper
+        if active.mean() > 0.5:
+            return None
+
+        # Join the runs of neighbouring tiles in each row of tiles into a single window
+        windows = []
+        for ty, row in enumerate(active):
+            edges = np.diff(np.concatenate([[0], row.astype(np.int8), [0]]))
+            for start, end in zip(np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]):
+                wx, wy = int(start*tile), int(ty*tile)
+                windows.append((wx, wy, min(int(end*tile), cols) - wx, min(wy+tile, rows) - wy))
+        return windows
+
+    # Yields `(size, w, h, x, y, res)` for every template size and every searched window of the result map, where
+    # `res` holds the scores of the top-left positions starting at (x, y). Scores that can't be a match are set to -inf.
+    # Without workers, only one window's scores are held at a time, so memory doesn't depend on how many positions
+    # pass `thresh`. With workers, the sizes are searched concurrently and then yielded in order.
+    def _Results(self, frame, thresh=0.9, coarse=True):
+        frame_h, frame_w = frame.shape[:2]
+        sizes = [p for p in self.sizes if p <= min(frame_h, frame_w)]
+        context = {'frame':frame, 'thresh':thresh, 'coarse':coarse, 'spectrum':None}
+        # Counts of non-black pixels, to rule out windows that are entirely black. Their score is 0/0, which
+        # rounds to an arbitrary value when only part of the frame is matched.
+        context['lit'] = cv2.integral(np.any(frame > 0, axis=2).astype(np.uint8)) if frame.ndim == 3 else cv2.integral((frame > 0).astype(np.uint8))
+        # The downscaled frames are shared by every size, so they are made up front
+        context['small'] = {}
+        if coarse:
+            for scale in set(self._CoarseScale(p) for p in sizes) - {None}:
+                context['small'][scale] = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        if self.workers > 1:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers)
+            for results in self._pool.map(lambda p: list(self._SizeResults(p, context)), sizes):
+                yield from results
+        else:
+            for p in sizes:
+                yield from self._SizeResults(p, context)
+
+    # Helper: the results of `_Results()` for a single template size
+    def _SizeResults(self, p:int, context:dict):
+        frame, thresh, lit = context['frame'], context['thresh'], context['lit']
+        frame_h, frame_w = frame.shape[:2]
+        template, alpha = self.GetTemplate(p)
+        h, w = template.shape[:2]
+        result_shape = (frame_h-h+1, frame_w-w+1)
+        windows = None
+        scale = self._CoarseScale(p) if context['coarse'] else None
+        if scale is not None:
+            windows = self._CoarseWindows(context['small'][scale], p, scale, thresh, result_shape)
+        if windows is None:
+            windows = [(0, 0, result_shape[1], result_shape[0])]
+        for (x, y, ww, wh) in windows:
+            if self.fft_min_size is not None and p >= self.fft_min_size and (ww, wh) == (result_shape[1], result_shape[0]):
+                res = self._MatchFFT(p, context)
+            else:
+                res = cv2.matchTemplate(frame[y:y+wh+h-1, x:x+ww+w-1], template, cv2.TM_CCORR_NORMED, mask=alpha)
+            # Windows with no variance under the mask (e.g. black borders) have an infinite score, which isn't a match
+            res[~np.isfinite(res)] = -np.inf
+            loc_y, loc_x = np.nonzero(res >= thresh)
+            gy, gx = loc_y + y, loc_x + x
+            dark = (lit[gy+h, gx+w] - lit[gy, gx+w] - lit[gy+h, gx] + lit[gy, gx]) == 0
+            res[loc_y[dark], loc_x[dark]] = -np.inf
+            yield p, w, h, x, y, res
+
+    # Helper: the masked TM_CCORR_NORMED scores of a size over the whole frame, computed with FFTs.
+    # For a mask M, the score is sum(I*T*M^2) / sqrt(sum(I^2*M^2) * sum(T^2*M^2)), summed over the channels.
+    # The frame's spectra are computed once per frame, and the template's once per frame size.
+    def _MatchFFT(self, p:int, context:dict):
+        frame = context['frame']
+        frame_h, frame_w = frame.shape[:2]
+        shape = (cv2.getOptimalDFTSize(frame_h), cv2.getOptimalDFTSize(frame_w))
+        with self._lock:
+            if context['spectrum'] is None:
+                channels = frame.reshape(frame_h, frame_w, -1).astype(np.float64)
+                context['spectrum'] = (
+                    [np.fft.rfft2(channels[:,:,c], s=shape) for c in range(channels.shape[2])],
+                    np.fft.rfft2((channels*channels).sum(axis=2), s=shape))
+            key = (p, shape)
+            if key not in self._spectra:
+                template, alpha = self.GetTemplate(p)
+                mask2 = (alpha[:,:,0].astype(np.float64) / 255.0) ** 2
+                weighted = template.astype(np.float64) * mask2[:,:,np.newaxis]
+                self._spectra[key] = (
+                    [np.conj(np.fft.rfft2(weighted[:,:,c], s=shape)) for c in range(weighted.shape[2])],
+                    np.conj(np.fft.rfft2(mask2, s=shape)),
+                    float((weighted * template).sum()))
+        frame_spectra, energy_spectrum = context['spectrum']
+        template_spectra, mask_spectrum, template_energy = self._spectra[(p, shape)]
+        rows, cols = frame_h-p+1, frame_w-p+1
+        numerator = np.fft.irfft2(sum(f*t for f, t in zip(frame_spectra, template_spectra)), s=shape)[:rows,:cols]
+        energy = np.fft.irfft2(energy_spectrum * mask_spectrum, s=shape)[:rows,:cols]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            res = numerator / np.sqrt(np.maximum(energy, 0) * template_energy)
+        return res.astype(np.float32)
+
+    # Returns, for every template size, the template (w, h) and the positions and scores of every match >= `thresh`:
+    # a list of (w, h, xs, ys, scores), where (xs, ys) are the top-left corners of the matches.
+    def Search(self, frame, thresh=0.9, coarse=True):
+        matches = {}
+        for p, w, h, x, y, res in self._Results(frame, thresh, coarse):
+            loc = np.nonzero(res >= thresh)
+            xs, ys, scores = matches.setdefault(p, (w, h, [], [], []))[2:]
+            xs.append(loc[1] + x)
+            ys.append(loc[0] + y)
+            scores.append(res[loc])
+        return [(w, h, np.concatenate(xs), np.concatenate(ys), np.concatenate(scores)) for w, h, xs, ys, scores in matches.values()]
+
+    # Returns the best matches as a list of `(cx, cy, size, score)`, ranked by score. Only local maxima of each size's
+    # scores are considered, and a match is dropped if more than `nms_threshold` of its box (or of the better match's
+    # box, if that is smaller) overlaps a better match of any size. Centers are refined to sub-pixel accuracy by
+    # fitting a parabola through the scores around each peak.
+    # A plain color template matches any smaller square inside the target almost as well as the target itself, so
+    # scores within `score_tolerance` of each other are ranked by size, largest first.
+    def Detect(self, frame, thresh=0.9, max_detections=10, nms_threshold=0.5, score_tolerance=0.005, coarse=True):
+        # The best peaks of each size, capped so that memory stays bounded
+        limit = max(_MIN_PEAKS, 4*max_detections)
+        peaks = {}
+        for p, w, h, x, y, res in self._Results(frame, thresh, coarse):
+            is_peak = (res >= thresh) & (res >= cv2.dilate(res, np.ones((3,3), dtype=np.uint8)))
+            py, px = np.nonzero(is_peak)
+            if len(py) == 0:
+                continue
+            scores = res[py, px]
+            cx = px + x + _ParabolaOffset(res, py, px, axis=1) + w/2
+            cy = py + y + _ParabolaOffset(res, py, px, axis=0) + h/2
+            found = np.column_stack([cx, cy, np.full(len(py), p), scores])
+            if p in peaks:
+                found = np.vstack([peaks[p], found])
+            if len(found) > limit:
+                found = found[np.argpartition(-found[:,3], limit)[:limit]]
+            peaks[p] = found
+        if len(peaks) == 0:
+            return []
+        found = np.vstack(list(peaks.values()))
+        keep = _NonMaxSuppression(found, nms_threshold, max_detections, score_tolerance)
+        return [(float(cx), float(cy), int(size), float(score)) for cx, cy, size, score in found[keep]]
+
+# How many peaks of each size `TemplateMatcher.Detect()` keeps at least, before non-max suppression
+_MIN_PEAKS = 64
+
+# Helper: the sub-pixel offset of each peak (py, px) along an axis of `res`, from a parabola through it and its two
+# neighbours. Peaks on the edge of `res`, or next to scores that can't be a match, aren't moved.
+def _ParabolaOffset(res, py, px, axis:int):
+    offset = np.zeros(len(py))
+    pos = px if axis == 1 else py
+    inside = (pos > 0) & (pos < res.shape[axis]-1)
+    iy, ix = py[inside], px[inside]
+    dy, dx = (0, 1) if axis == 1 else (1, 0)
+    before = res[iy-dy, ix-dx].astype(np.float64)
+    center = res[iy, ix].astype(np.float64)
+    after = res[iy+dy, ix+dx].astype(np.float64)
+    curvature = before - 2*center + after
+    valid = np.isfinite(before) & np.isfinite(after) & (curvature < 0)
+    shift = np.zeros(len(iy))
+    shift[valid] = 0.5 * (before[valid] - after[valid]) / curvature[valid]
+    offset[inside] = np.clip(shift, -0.5, 0.5)
+    return offset
+
+# Helper: greedy non-max suppression over rows of (cx, cy, size, score), where the overlap of two boxes is their
+# intersection over the area of the smaller one. Returns the indices of the rows to keep, best first.
+def _NonMaxSuppression(found, overlap:float, limit:int, score_tolerance:float = 0.0):
+    half = found[:,2] / 2
+    x1, y1, x2, y2 = found[:,0]-half, found[:,1]-half, found[:,0]+half, found[:,1]+half
+    areas = found[:,2] * found[:,2]
+    order = np.argsort(-found[:,3], kind='stable')
+    keep = []
+    while len(order) > 0 and len(keep) < limit:
+        # The largest of the boxes scoring within the tolerance of the best one left
+        tied = order[found[order,3] >= found[order[0],3] - score_tolerance]
+        i = tied[np.argmax(found[tied,2])]
+        rest = order[order != i]
+        keep.append(i)
+        iw = np.maximum(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0)
+        ih = np.maximum(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0)
+        inter = iw * ih
+        order = rest[inter / np.minimum(areas[i], areas[rest]) <= overlap]
+    return keep
+
+# Helper: the median of values given as a histogram of their doubled values (index = 2 x value)
+def _HistogramMedian(hist):
+    cumulative = np.cumsum(hist)
+    n = cumulative[-1]
+    lo = np.searchsorted(cumulative, (n-1)//2 + 1)
+    hi = np.searchsorted(cumulative, n//2 + 1)
+    return (lo + hi) / 4.0
+
+# Cached matchers, so that searching several frames for the same template only loads and resizes it once
+@lru_cache(maxsize=8)
+def GetMatcher(template_filename, min_size=10, max_size=50, delta_size=5, workers=1, fft_min_size=None):
+    return TemplateMatcher(template_filename, min_size, max_size, delta_size, workers=workers, fft_min_size=fft_min_size)
+
+# Returns the mean and median center of every position (at every size) that matches the template with at least
+# `thresh`. The centers are accumulated into sums and histograms rather than collected, so memory stays bounded
+# however many positions pass. `template_filename` can also be an existing `TemplateMatcher`.
 def FindTemplateMatch(
         frame, 
         template_filename, 
@@ -13,55 +299,48 @@ def FindTemplateMatch(
         draw_centers=False,
         bbox_color=[0,255,255],
         bbox_thickness=1,
-        verbose=False):
-    # Load template using opencv
-    template_all = cv2.imread(template_filename, cv2.IMREAD_UNCHANGED)
-    # Prep boxes list
-    boxes = []
-    # Iterate through possible sizes of the template, upwards to half of the size
-    for p in np.arange(min_size, max_size, delta_size):
-        # Resize the frame
-        template_resize = cv2.resize(template_all, (p,p))
-        # Get particular attributes of the image itself. 
-        # We assume transparency, so we have to separate alpha from bgr
-        template = template_resize[:,:,0:3]
-        alpha = template_resize[:,:,3]
-        alpha = cv2.merge([alpha,alpha,alpha])
-        # get the width and height of the template
-        h,w = template.shape[:2]
-        # Prepare possible locations where the template matches
-        loc = []
-        # Find those matches.
-        res = cv2.matchTemplate(
-            frame,
-            template,
-            cv2.TM_CCORR_NORMED,
-            mask=alpha
-        )
-        # threshold by a 
-        loc = np.where(res >= thresh)
-        if len(loc) > 0:
-            for pt in zip(*loc[::-1]):
-                boxes.append((pt[0],pt[1],pt[0]+w,pt[1]+h, pt[0]+(w/2), pt[1]+(h/2)))
-
-    
-    centers = []
-    for (x1, y1, x2, y2, cx, cy) in boxes:
-        #result = cv2.rectangle(result, (x1, y1), (x2, y2), bbox_color, bbox_thickness)
-        centers.append([cx,cy])
+        verbose=False,
+        coarse=True,
+        workers=1,
+        fft_min_size=None):
+    # Load the template (only the first time) using opencv
+    if isinstance(template_filename, TemplateMatcher):
+        matcher = template_filename
+    else:
+        matcher = GetMatcher(template_filename, min_size, max_size, delta_size, workers, fft_min_size)
+    frame_h, frame_w = frame.shape[:2]
+    if draw_bbox or draw_centers:
+        result = frame.copy()
+    # Centers are always whole or half pixels, so their doubled values are integers
+    count = 0
+    sums = np.zeros(2, dtype=np.int64)
+    hist_x = np.zeros(2*frame_w+1, dtype=np.int64)
+    hist_y = np.zeros(2*frame_h+1, dtype=np.int64)
+    # Find the matches at every possible size of the template
+    for p, w, h, x, y, res in matcher._Results(frame, thresh, coarse=coarse):
+        loc_y, loc_x = np.nonzero(res >= thresh)
+        cx2 = 2*(loc_x + x) + w
+        cy2 = 2*(loc_y + y) + h
+        count += len(cx2)
+        sums += [cx2.sum(), cy2.sum()]
+        hist_x += np.bincount(cx2, minlength=len(hist_x))
+        hist_y += np.bincount(cy2, minlength=len(hist_y))
+        if draw_bbox:
+            for x1, y1 in zip(loc_x + x, loc_y + y):
+                result = cv2.rectangle(result, (int(x1), int(y1)), (int(x1)+w, int(y1)+h), bbox_color, bbox_thickness)
 
-    mean_center = np.mean(centers, axis=0)
-    median_center = np.median(centers, axis=0)
+    if count > 0:
+        mean_center = sums / (2.0*count)
+        median_center = np.array([_HistogramMedian(hist_x), _HistogramMedian(hist_y)])
+    else:
+        mean_center = np.array([np.nan, np.nan])
+        median_center = np.array([np.nan, np.nan])
     
     if verbose:
         print(f"ESTIMATED MEAN POSITION: {mean_center}")
         print(f"ESTIMATED MEDIAN POSITION: {median_center}")
     
     if draw_bbox or draw_centers:
-        result = frame.copy()
-        if draw_bbox:
-             for (x1, y1, x2, y2, cx, cy) in boxes:
-                 result = cv2.rectangle(result, (x1, y1), (x2, y2), bbox_color, bbox_thickness)
         if draw_centers:
             result = cv2.drawMarker(result, (int(mean_center[0]), int(mean_center[1])), (0,255,255),cv2.MARKER_CROSS,20,2)
             result = cv2.drawMarker(result, (int(median_center[0]), int(median_center[1])), (255,255,0),cv2.MARKER_TILTED_CROSS,20,2)
@@ -69,7 +348,66 @@ def FindTemplateMatch(
     
     return mean_center, median_center
 
+# Returns the best detections of the template in the frame as a list of `(cx, cy, size, score)`, best first.
+# Like `FindTemplateMatch`, `template_filename` can also be an existing `TemplateMatcher`.
+def FindTemplateDetections(
+        frame,
+        template_filename,
+        min_size=10,
+        max_size=50,
+        delta_size=5,
+        thresh=0.9,
+        max_detections=10,
+        nms_threshold=0.5,
+        coarse=True,
+        workers=1,
+        fft_min_size=None):
+    if isinstance(template_filename, TemplateMatcher):
+        matcher = template_filename
+    else:
+        matcher = GetMatcher(template_filename, min_size, max_size, delta_size, workers, fft_min_size)
+    return matcher.Detect(frame, thresh, max_detections, nms_threshold, coarse=coarse)
+
+# The snapshots that `FindAnchorMapping.py` looks for the anchor in
+ANCHOR_IMAGES = ['center.png', 'topleft.png', 'topright.png', 'bottomleft.png']
+
+# Times `FindTemplateMatch` on every anchor snapshot under `root_dir` (e.g. `to_correct/`) with the search done
+# over the whole frame one size at a time (like the original), coarse-to-fine, and with the pool and FFT options.
+# Prints the time per anchor image of each, and whether its median centers agree with the whole-frame search.
+def BenchmarkMatcher(root_dir, template_filename, thresh=0.975, workers=None, fft_min_size=25):
+    workers = os.cpu_count() if workers is None else workers
+    filepaths = sorted(f for f in glob.glob(os.path.join(root_dir, '**', '*.png'), recursive=True) if os.path.basename(f) in ANCHOR_IMAGES)
+    if len(filepaths) == 0:
+        raise FileNotFoundError(f"No anchor images ({', '.join(ANCHOR_IMAGES)}) found under {root_dir}")
+    frames = [cv2.imread(f) for f in filepaths]
+    configs = [
+        ('whole frame', False, {}),
+        ('whole frame + fft', False, {'fft_min_size':fft_min_size}),
+        (f'whole frame + {workers} workers', False, {'workers':workers}),
+        ('coarse-to-fine', True, {}),
+        (f'coarse-to-fine + {workers} workers', True, {'workers':workers}),
+        (f'coarse-to-fine + fft + {workers} workers', True, {'workers':workers, 'fft_min_size':fft_min_size})]
+    print(f"{len(frames)} anchor images under {root_dir}")
+    results = {}
+    baseline = None
+    for name, coarse, options in configs:
+        matcher = TemplateMatcher(template_filename, **options)
+        start = time.perf_counter()
+        medians = [FindTemplateMatch(frame, matcher, thresh=thresh, coarse=coarse)[1] for frame in frames]
+        per_image = (time.perf_counter() - start) / len(frames)
+        if baseline is None:
+            baseline = medians
+        agree = np.mean([np.allclose(a, b, equal_nan=True) for a, b in zip(medians, baseline)])
+        results[name] = {'seconds_per_image':per_image, 'agreement':agree}
+        print(f"{name:<40}{per_image*1000:>10.1f} ms/image{agree*100:>8.1f}% same median")
+        if matcher._pool is not None:
+            matcher._pool.shutdown()
+    return results
+
 def main(args):
+    if args.benchmark:
+        BenchmarkMatcher(args.source, args.template, thresh=args.threshold, workers=args.workers if args.workers > 1 else None)
+        return
     img = cv2.imread(args.source)
     img_h, img_w, _ = img.shape
     min_dim = min(img_h, img_w)
@@ -79,8 +417,16 @@ def main(args):
         thresh=args.threshold, 
         draw_bbox=False, 
         draw_centers=True, 
-        verbose=True
+        verbose=True,
+        workers=args.workers,
+        fft_min_size=args.fft_min_size
     )
+    if args.n_detections > 0:
+        detections = FindTemplateDetections(img, args.template, thresh=args.threshold, max_detections=args.n_detections, workers=args.workers, fft_min_size=args.fft_min_size)
+        for rank, (cx, cy, size, score) in enumerate(detections):
+            print(f"DETECTION {rank}: center ({cx:.2f}, {cy:.2f}), size {size}, score {score:.4f}")
+            half = size/2
+            result = cv2.rectangle(result, (int(cx-half), int(cy-half)), (int(cx+half), int(cy+half)), args.color, 1)
     cv2.imshow('Template Match', result)
     cv2.waitKey(0)
     cv2.destroyAllWindows()
@@ -98,5 +444,20 @@ if __name__ == "__main__":
                         nargs='+',
                         type=int,
                         default=[0,255,255])
+    parser.add_argument('-n', '--n_detections',
+                        help='Also print and draw up to this many separate detections, best first',
+                        type=int,
+                        default=0)
+    parser.add_argument('-w', '--workers',
+                        help='Search this many template sizes in parallel',
+                        type=int,
+                        default=1)
+    parser.add_argument('-fft', '--fft_min_size',
+                        help='Correlate template sizes of at least this many pixels in the frequency domain when the whole frame has to be searched',
+                        type=int,
+                        default=None)
+    parser.add_argument('-b', '--benchmark',
+                        help='Treat `source` as a directory (e.g. to_correct/) and time the search on every anchor snapshot in it',
+                        action='store_true')
     args = parser.parse_args()
     main(args)
\ No newline at end of file
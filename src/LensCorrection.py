@@ -0,0 +1,151 @@
+"""""""""""""""
+This file reproduces the `crop -> rotate -> lenscorrection` ffmpeg filter chain from the README in-process,
+using OpenCV. Rather than running three filter passes over every frame, the three geometric steps are composed
+into a single pair of `cv2.remap` lookup tables that map every corrected output pixel back to a pixel in the
+raw scrcpy frame. The tables are cached per (frame size, crop, angle, cx, cy, k1, k2), so a long recording only
+pays for building them once and then costs one resample per frame.
+
+The conventions follow ffmpeg:
+- crop=w:h:x:y        => `crop=(w,h,x,y)`
+- rotate=a*(PI/180)   => `angle=a` (degrees, positive is clockwise, output keeps the cropped size, black fill)
+- lenscorrection      => `cx`, `cy` (relative focal point), `k1`, `k2` (radial coefficients, r0 = half diagonal)
+"""""""""""""""
+
+import os
+import argparse
+from functools import lru_cache
+
+import numpy as np
+import cv2
+
+# Parameters derived in `docs/CROPPING.md`, `docs/ROTATION.md` and `docs/LENS_CORRECTION.md` for `-m1280` captures
+LEFT_EYE = {'crop':(632,672,16,0), 'angle':21.0, 'cx':0.57, 'cy':0.51, 'k1':-0.48, 'k2':0.2}
+RIGHT_EYE = {'crop':(632,672,648,0), 'angle':-21.0, 'cx':0.43, 'cy':0.51, 'k1':-0.48, 'k2':0.2}
+EYE_PARAMS = {'left':LEFT_EYE, 'right':RIGHT_EYE}
+
+# Any map coordinate set to this value falls far enough outside the frame that remap fills it with black
+_OUTSIDE = -16.0
+
+# Returns the ffmpeg filter string equivalent to the given correction parameters
+def FilterString(crop=None, angle=0.0, cx=0.5, cy=0.5, k1=0.0, k2=0.0):
+    filters = []
+    if crop is not None:
+        filters.append(f"crop={crop[0]}:{crop[1]}:{crop[2]}:{crop[3]}")
+    if angle != 0:
+        filters.append(f"rotate={angle:g}*(PI/180)")
+    filters.append(f"lenscorrection=cx={cx:g}:cy={cy:g}:k1={k1:g}:k2={k2:g}")
+    return ",".join(filters)
+
+# Builds the float coordinate maps (in raw frame coordinates) for the combined crop/rotate/lenscorrection.
+# Pixels that any of the three ffmpeg filters would have filled with black are pushed outside of the frame.
+def BuildCorrectionMaps(frame_w:int, frame_h:int, crop=None, angle=0.0, cx=0.5, cy=0.5, k1=0.0, k2=0.0):
+    if crop is None:
+        crop = (frame_w, frame_h, 0, 0)
+    w, h, x0, y0 = crop
+    if w <= 0 or h <= 0 or x0 < 0 or y0 < 0 or x0+w > frame_w or y0+h > frame_h:
+        raise ValueError(f"Crop {crop} does not fit inside a {frame_w}x{frame_h} frame")
+
+    # Step 1: lenscorrection. For every output pixel, find the pixel it samples in the rotated image.
+    xs, ys = np.meshgrid(np.arange(w, dtype=np.float64), np.arange(h, dtype=np.float64))
+    xcenter = int(cx * w)
+    ycenter = int(cy * h)
+    off_x = xs - xcenter
+    off_y = ys - ycenter
+    r2 = (off_x*off_x + off_y*off_y) * (4.0 / (w*w + h*h))
+    radius_mult = 1.0 + k1*r2 + k2*r2*r2
+    lens_x = xcenter + radius_mult*off_x
+    lens_y = ycenter + radius_mult*off_y
+    valid = (lens_x > -0.5) & (lens_x < w-0.5) & (lens_y > -0.5) & (lens_y < h-0.5)
+
+    # Step 2: rotate. The rotated image keeps the size of the crop and rotates around its center.
+    theta = np.deg2rad(angle)
+    c, s = np.cos(theta), np.sin(theta)
+    half_w, half_h = (w-1)/2.0, (h-1)/2.0
+    dx = lens_x - half_w
+    dy = lens_y - half_h
+    rot_x = dx*c + dy*s + half_w
+    rot_y = -dx*s + dy*c + half_h
+    valid &= (rot_x > -1) & (rot_x < w) & (rot_y > -1) & (rot_y < h)
+
+    # Step 3: crop. Offset into the raw frame, and push invalid pixels outside so they are filled with black.
+    map_x = np.where(valid, rot_x + x0, _OUTSIDE).astype(np.float32)
+    map_y = np.where(valid, rot_y + y0, _OUTSIDE).astype(np.float32)
+    return map_x, map_y
+
+# Cached, fixed-point version of `BuildCorrectionMaps()`, which is what `cv2.remap` is fastest with.
+# All arguments must be hashable, so `crop` has to be a tuple.
+@lru_cache(maxsize=16)
+def GetCorrectionMaps(frame_w:int, frame_h:int, crop=None, angle=0.0, cx=0.5, cy=0.5, k1=0.0, k2=0.0):
+    map_x, map_y = BuildCorrectionMaps(frame_w, frame_h, crop, angle, cx, cy, k1, k2)
+    return cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+# Applies the correction to a single frame in one resample
+def CorrectFrame(frame, crop=None, angle=0.0, cx=0.5, cy=0.5, k1=0.0, k2=0.0):
+    frame_h, frame_w = frame.shape[:2]
+    crop = tuple(int(v) for v in crop) if crop is not None else None
+    map1, map2 = GetCorrectionMaps(frame_w, frame_h, crop, float(angle), float(cx), float(cy), float(k1), float(k2))
+    return cv2.remap(frame, map1, map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+# Helper: pick a fourcc that matches the output container
+def GetFourCC(filepath:str):
+    if os.path.splitext(filepath)[1].lower() == '.avi':
+        return cv2.VideoWriter_fourcc('M','J','P','G')
+    return cv2.VideoWriter_fourcc('m','p','4','v')
+
+# Corrects an entire video, decoding each frame once and writing the corrected frames to `output_filepath`
+def CorrectVideo(
+        video_filepath:str,
+        output_filepath:str,
+        crop=None,
+        angle=0.0,
+        cx=0.5,
+        cy=0.5,
+        k1=0.0,
+        k2=0.0,
+        verbose=False):
+    vidcap = cv2.VideoCapture(video_filepath)
+    if not vidcap.isOpened():
+        raise FileNotFoundError(f"Unable to open video: {video_filepath}")
+    vidcapw = int(vidcap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    vidcaph = int(vidcap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    vidcapfps = vidcap.get(cv2.CAP_PROP_FPS)
+    outw, outh = (crop[0], crop[1]) if crop is not None else (vidcapw, vidcaph)
+    out = cv2.VideoWriter(output_filepath, GetFourCC(output_filepath), vidcapfps, (outw,outh))
+
+    count = 0
+    success, image = vidcap.read()
+    while success:
+        out.write(CorrectFrame(image, crop, angle, cx, cy, k1, k2))
+        count += 1
+        success, image = vidcap.read()
+
+    vidcap.release()
+    out.release()
+    if verbose:
+        print(f"Corrected {count} frames into {output_filepath}")
+    return output_filepath
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # REQUIRED
+    parser.add_argument('source',help='The raw scrcpy footage that needs to be corrected')
+    parser.add_argument('output',help='The filepath of the corrected video')
+
+    # OPTIONAL
+    parser.add_argument('-e','--eye',help='Which eye preset to start from', choices=['left','right'], default='left')
+    parser.add_argument('-c','--crop',help='Override the crop as W H X Y', nargs=4, type=int, default=None)
+    parser.add_argument('-a','--angle',help='Override the rotation, in degrees (positive is clockwise)', type=float, default=None)
+    parser.add_argument('-cx','--cx',help='Override the relative x of the focal point', type=float, default=None)
+    parser.add_argument('-cy','--cy',help='Override the relative y of the focal point', type=float, default=None)
+    parser.add_argument('-k1','--k1',help='Override the k1 coefficient', type=float, default=None)
+    parser.add_argument('-k2','--k2',help='Override the k2 coefficient', type=float, default=None)
+    args = parser.parse_args()
+
+    params = dict(EYE_PARAMS[args.eye])
+    if args.crop is not None: params['crop'] = tuple(args.crop)
+    for key in ['angle', 'cx', 'cy', 'k1', 'k2']:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    print(f"Equivalent ffmpeg filter: {FilterString(**params)}")
+    CorrectVideo(args.source, args.output, verbose=True, **params)
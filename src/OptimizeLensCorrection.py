@@ -0,0 +1,236 @@
+"""""""""""""""
+This file estimates the `lenscorrection` parameters (`cx`, `cy`, `k1`, `k2`) of each eye automatically, from a raw
+scrcpy frame of a pattern made of straight lines, such as `template/DistortionTestGrid2.png` or
+`template/800px-Checkerboard_Pattern_8x6.svg.png` rendered in front of both eyes.
+
+1. Each eye is cropped and rotated with its preset from `LensCorrection.py`, and the edges of the pattern are
+   found with Canny. Edge pixels are split into mostly-horizontal and mostly-vertical ones by their gradient, and
+   each group is joined along its direction and labelled into separate lines.
+2. For a set of parameters, every edge pixel is moved to where `lenscorrection` would put it. ffmpeg's filter maps
+   each corrected pixel back to a source pixel, so this inverts its radial polynomial with a few Newton steps.
+   It runs on all pixels at once, and on many parameter sets at once.
+3. How straight the lines are is measured per line as the ratio between the smallest and largest spread of its
+   pixels (from their 2x2 covariance), which doesn't change with the scale of the image. The objective is
+   the average of this ratio over the lines.
+4. A batch of random parameter sets is scored, and the best few are refined with Nelder-Mead in parallel processes.
+
+The result is printed as ready-to-use ffmpeg filter strings, with each eye's crop and rotation.
+"""""""""""""""
+
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import cv2
+import LensCorrection as LC
+import FindCropDimensions as FC
+
+# The order of the parameters in a parameter vector, and the range that each one is searched in
+PARAM_NAMES = ['cx', 'cy', 'k1', 'k2']
+PARAM_BOUNDS = np.array([[0.3, 0.7], [0.3, 0.7], [-1.0, 1.0], [-1.0, 1.0]])
+# Score given to parameters that fold the image over itself or fall outside of the bounds
+_INVALID = 1.0
+
+# Returns the edge pixels (n x 2, as x/y) of the lines in a cropped and rotated eye image, the line that each one
+# belongs to, and the number of lines. Lines shorter than `min_length` pixels are dropped.
+def ExtractLines(image, min_length:int = 40, border:int = 12):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    h, w = gray.shape
+
+    # Only keep edges well inside the lit area of the lens, so that its border isn't mistaken for a line.
+    # Closing first fills any dark parts of the pattern itself, like the squares of a checkerboard.
+    size = max(h, w) // 8 | 1
+    lit = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+    # Everything past the edges of the image counts as dark too, since that is where the crop and rotation cut off
+    inside = cv2.morphologyEx(lit, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size)), borderType=cv2.BORDER_CONSTANT, borderValue=0)
+    inside = cv2.erode(inside, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2*border+1, 2*border+1)), borderType=cv2.BORDER_CONSTANT, borderValue=0)
+    edges = cv2.Canny(cv2.GaussianBlur(gray, (3, 3), 0), 20, 60) & (inside * 255)
+
+    # Split the edges by orientation, join each group along its direction, and label the lines
+    gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+    horizontal = (edges > 0) & (np.abs(gy) > np.abs(gx))
+    vertical = (edges > 0) & ~horizontal
+    points, labels = [], []
+    n_lines = 0
+    for mask, kernel in [(horizontal, (15, 3)), (vertical, (3, 15))]:
+        joined = cv2.morphologyEx(mask.astype(np.uint8), cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, kernel))
+        n, components, stats, centroids = cv2.connectedComponentsWithStats(joined, connectivity=8)
+        extent = np.maximum(stats[:,cv2.CC_STAT_WIDTH], stats[:,cv2.CC_STAT_HEIGHT])
+        keep = extent >= min_length
+        keep[0] = False
+        # Renumber the kept components after the lines found so far
+        renumber = np.full(n, -1, dtype=np.int64)
+        renumber[keep] = n_lines + np.arange(np.count_nonzero(keep))
+        ys, xs = np.nonzero(mask)
+        line = renumber[components[ys, xs]]
+        found = line >= 0
+        points.append(np.column_stack([xs[found], ys[found]]).astype(np.float64))
+        labels.append(line[found])
+        n_lines += int(np.count_nonzero(keep))
+    return np.concatenate(points), np.concatenate(labels), n_lines
+
+# Moves points of a (width x height) image to where `lenscorrection` puts them, for a batch of parameter sets.
+# `params` is (p x 4) and `points` is (n x 2). Returns the (p x n x 2) corrected points, and a (p,) mask of the
+# parameter sets that are invertible over all of the points.
+def UndistortPoints(params, points, width:int, height:int, iterations:int = 8):
+    params = np.atleast_2d(params)
+    cx, cy, k1, k2 = [params[:,i,None] for i in range(4)]
+    # ffmpeg's radius is relative to half of the image diagonal: r^2 / r0^2 = r^2 * 4 / (w^2 + h^2)
+    scale2 = 4.0 / (width*width + height*height)
+    off_x = points[None,:,0] - cx*width
+    off_y = points[None,:,1] - cy*height
+    source2 = (off_x*off_x + off_y*off_y) * scale2
+    source = np.sqrt(source2)
+
+    # Solve r * (1 + k1 r^2 + k2 r^4) = source for r (in units of r0), starting from r = source
+    r = source.copy()
+    for _ in range(iterations):
+        r2 = r*r
+        f = r * (1.0 + k1*r2 + k2*r2*r2) - source
+        df = 1.0 + 3.0*k1*r2 + 5.0*k2*r2*r2
+        r -= f / np.where(np.abs(df) < 1e-6, 1e-6, df)
+    r2 = r*r
+    # Invertible only where the mapping keeps going outwards and the solution is positive
+    valid = np.all((1.0 + 3.0*k1*r2 + 5.0*k2*r2*r2 > 0) & (r >= 0), axis=1)
+    ratio = np.where(source > 0, r / np.where(source > 0, source, 1.0), 1.0)
+    corrected = np.stack([cx*width + off_x*ratio, cy*height + off_y*ratio], axis=-1)
+    return corrected, valid
+
+# Scores how crooked the lines are after correcting them with each parameter set (p x 4): the average, over lines,
+# of the ratio between the spread across each line and the spread along it. 0 means perfectly straight.
+def Crookedness(params, points, labels, n_lines:int, width:int, height:int):
+    params = np.atleast_2d(np.asarray(params, dtype=np.float64))
+    corrected, valid = UndistortPoints(params, points, width, height)
+    p = len(params)
+
+    # Per-line sums over all parameter sets at once, by offsetting each set's labels
+    keys = (labels[None,:] + n_lines*np.arange(p)[:,None]).ravel()
+    x = corrected[...,0].ravel()
+    y = corrected[...,1].ravel()
+    count = np.bincount(keys, minlength=p*n_lines)
+    sums = [np.bincount(keys, weights=v, minlength=p*n_lines) for v in (x, y, x*x, y*y, x*y)]
+    count = np.maximum(count, 1)
+    mx, my = sums[0]/count, sums[1]/count
+    sxx = sums[2]/count - mx*mx
+    syy = sums[3]/count - my*my
+    sxy = sums[4]/count - mx*my
+
+    # Eigenvalues of each line's covariance
+    half_trace = (sxx + syy) / 2.0
+    spread = np.sqrt(np.maximum(((sxx - syy) / 2.0)**2 + sxy*sxy, 0.0))
+    ratio = (half_trace - spread) / np.maximum(half_trace + spread, 1e-9)
+    scores = ratio.reshape(p, n_lines).mean(axis=1)
+
+    in_bounds = np.all((params >= PARAM_BOUNDS[:,0]) & (params <= PARAM_BOUNDS[:,1]), axis=1)
+    return np.where(valid & in_bounds & np.isfinite(scores), scores, _INVALID)
+
+# Minimizes `f` from `x0` with the Nelder-Mead simplex method
+def NelderMead(f, x0, step, max_iterations:int = 400, tolerance:float = 1e-9):
+    simplex = np.vstack([x0, x0 + np.diag(step)])
+    values = np.array([f(x) for x in simplex])
+    for _ in range(max_iterations):
+        order = np.argsort(values)
+        simplex, values = simplex[order], values[order]
+        if values[-1] - values[0] < tolerance:
+            break
+        centroid = simplex[:-1].mean(axis=0)
+        reflected = centroid + (centroid - simplex[-1])
+        fr = f(reflected)
+        if fr < values[0]:
+            expanded = centroid + 2.0*(centroid - simplex[-1])
+            fe = f(expanded)
+            simplex[-1], values[-1] = (expanded, fe) if fe < fr else (reflected, fr)
+        elif fr < values[-2]:
+            simplex[-1], values[-1] = reflected, fr
+        else:
+            contracted = centroid + 0.5*(simplex[-1] - centroid)
+            fc = f(contracted)
+            if fc < values[-1]:
+                simplex[-1], values[-1] = contracted, fc
+            else:
+                # Shrink towards the best point
+                simplex[1:] = simplex[0] + 0.5*(simplex[1:] - simplex[0])
+                values[1:] = [f(x) for x in simplex[1:]]
+    best = np.argmin(values)
+    return simplex[best], values[best]
+
+# Helper: refine one starting point in a worker process
+def _Refine(x0, points, labels, n_lines:int, width:int, height:int):
+    f = lambda x: float(Crookedness(x, points, labels, n_lines, width, height)[0])
+    step = (PARAM_BOUNDS[:,1] - PARAM_BOUNDS[:,0]) * 0.05
+    return NelderMead(f, x0, step)
+
+# Estimates the `lenscorrection` parameters of a cropped and rotated eye image of a line pattern.
+# `n_random` random parameter sets are scored in batches, and the best `n_starts` of them (plus the current
+# preset, if given) are refined in parallel. Returns the best parameters, and how crooked the lines still are.
+def OptimizeLensCorrection(
+        image,
+        n_random:int = 512,
+        n_starts:int = 8,
+        workers:int = None,
+        initial:dict = None,
+        seed:int = 0,
+        verbose:bool = False):
+    height, width = image.shape[:2]
+    points, labels, n_lines = ExtractLines(image)
+    if n_lines < 2:
+        raise ValueError(f"Only {n_lines} lines were found in the pattern, at least 2 are needed")
+    if verbose:
+        print(f"Found {n_lines} lines ({len(points)} edge pixels)")
+
+    rng = np.random.default_rng(seed)
+    candidates = rng.uniform(PARAM_BOUNDS[:,0], PARAM_BOUNDS[:,1], (n_random, 4))
+    candidates[0] = [0.5, 0.5, 0.0, 0.0]
+    scores = np.concatenate([Crookedness(batch, points, labels, n_lines, width, height) for batch in np.array_split(candidates, max(1, n_random // 32))])
+    starts = list(candidates[np.argsort(scores)[:n_starts]])
+    if initial is not None:
+        starts.append(np.array([initial[name] for name in PARAM_NAMES], dtype=np.float64))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(_Refine, starts, *[[v]*len(starts) for v in (points, labels, n_lines, width, height)]))
+    best, score = min(results, key=lambda result: result[1])
+    if verbose:
+        before = Crookedness([[0.5, 0.5, 0.0, 0.0]], points, labels, n_lines, width, height)[0]
+        print(f"Crookedness: {before:.6f} uncorrected => {score:.6f}")
+    return {name:round(float(v), 3) for name, v in zip(PARAM_NAMES, best)}, float(score)
+
+# Estimates the parameters of each eye from a raw scrcpy frame, and returns their ffmpeg filter strings
+def OptimizeEyes(frame, eyes = ('left', 'right'), crops:dict = None, **options):
+    filters = {}
+    for eye in eyes:
+        params = dict(LC.EYE_PARAMS[eye])
+        if crops is not None:
+            params['crop'] = crops[eye]
+        # Only crop and rotate, so that the lens correction is all that's left to estimate
+        image = LC.CorrectFrame(frame, params['crop'], params['angle'])
+        start = time.perf_counter()
+        found, score = OptimizeLensCorrection(image, initial={name:params[name] for name in PARAM_NAMES}, **options)
+        params.update(found)
+        filters[eye] = LC.FilterString(**params)
+        print(f"{eye.upper()} EYE ({time.perf_counter()-start:.1f} s): {filters[eye]}")
+    return filters
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # REQUIRED
+    parser.add_argument('source',help='A raw scrcpy frame of a pattern of straight lines (a grid or a checkerboard)')
+
+    # OPTIONAL
+    parser.add_argument('-e','--eyes',help='Which eyes to estimate', nargs='+', choices=['left','right'], default=['left','right'])
+    parser.add_argument('-cf','--crop_file',help='A results file from `FindCropDimensions.py` to take the eye crops from', default=None)
+    parser.add_argument('-n','--n_random',help='How many random parameter sets to score', type=int, default=512)
+    parser.add_argument('-s','--n_starts',help='How many of the best ones to refine', type=int, default=8)
+    parser.add_argument('-w','--workers',help='How many processes to refine them with. Defaults to the number of CPUs', type=int, default=None)
+    args = parser.parse_args()
+
+    frame = cv2.imread(args.source)
+    if frame is None:
+        raise FileNotFoundError(f"Unable to read image: {args.source}")
+    crops = None
+    if args.crop_file is not None:
+        left, right = FC.ReadCropFile(args.crop_file)
+        crops = {'left':left, 'right':right}
+    OptimizeEyes(frame, args.eyes, crops, n_random=args.n_random, n_starts=args.n_starts, workers=args.workers, verbose=True)
@@ -0,0 +1,100 @@
+"""""""""""""""
+This file runs chains of generators as a pipeline of threads joined by bounded queues.
+Each stage is a generator that consumes the output of the previous one, e.g.
+
+    frames = RunStage(decode(), 'decode', stats)
+    rendered = RunStage(render(frames), 'render', stats)
+    for item in rendered: ...
+
+Every stage iterates its generator on its own thread, so items stay in order, and the bounded queues keep
+a slow stage from letting the others run ahead and fill memory. OpenCV and EasyOCR release the GIL while they
+work, so stages genuinely overlap.
+
+For each stage, `stats` records how long it was busy, how long it was blocked waiting on the stage before it,
+and how long it was blocked waiting for the stage after it to make room. The stage with the highest occupancy
+(busy time over wall-clock time) is the bottleneck.
+"""""""""""""""
+
+import time
+import queue
+import threading
+
+# Sentinel that marks the end of a stage's output
+_DONE = object()
+
+# Per-thread total of the time spent blocked waiting for an upstream stage
+_local = threading.local()
+
+# Helper: the time the current thread has spent blocked waiting for upstream stages so far
+def _input_wait():
+    return getattr(_local, 'wait', 0.0)
+
+class _StageError:
+    def __init__(self, error):
+        self.error = error
+
+class _StageOutput:
+    def __init__(self, q):
+        self._queue = q
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        item = self._queue.get()
+        _local.wait = _input_wait() + time.perf_counter() - start
+        if item is _DONE:
+            raise StopIteration
+        if isinstance(item, _StageError):
+            raise item.error
+        return item
+
+# Helper: the body of a stage's thread. Stats are recorded before the end of the output is signalled,
+# so they are complete by the time the consumer finishes iterating.
+def _RunWorker(iterable, q, name, stats):
+    record = {'items':0, 'busy':0.0, 'wait_input':0.0, 'wait_output':0.0}
+    end_item = _DONE
+    start = time.perf_counter()
+    try:
+        iterator = iter(iterable)
+        while True:
+            step_start = time.perf_counter()
+            wait_before = _input_wait()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            waited = _input_wait() - wait_before
+            record['wait_input'] += waited
+            record['busy'] += time.perf_counter() - step_start - waited
+            record['items'] += 1
+
+            put_start = time.perf_counter()
+            q.put(item)
+            record['wait_output'] += time.perf_counter() - put_start
+    except BaseException as e:
+        end_item = _StageError(e)
+    record['elapsed'] = time.perf_counter() - start
+    record['occupancy'] = record['busy'] / record['elapsed'] if record['elapsed'] > 0 else 0.0
+    if stats is not None:
+        stats[name] = record
+    q.put(end_item)
+
+# Iterates `iterable` on a new thread and returns an iterator over its items, in order.
+# At most `maxsize` items are buffered between this stage and the next.
+def RunStage(iterable, name:str, stats:dict = None, maxsize:int = 8):
+    q = queue.Queue(maxsize=maxsize)
+    thread = threading.Thread(target=_RunWorker, args=(iterable, q, name, stats), name=f"stage-{name}", daemon=True)
+    thread.start()
+    return _StageOutput(q)
+
+# Prints the stats collected by `RunStage`, and which stage was the bottleneck
+def PrintStageStats(stats:dict):
+    if len(stats) == 0:
+        return
+    print(f"{'Stage':<12}{'Items':>8}{'Busy (s)':>10}{'Wait in (s)':>13}{'Wait out (s)':>14}{'Occupancy':>11}")
+    for name, record in stats.items():
+        print(f"{name:<12}{record['items']:>8}{record['busy']:>10.2f}{record['wait_input']:>13.2f}{record['wait_output']:>14.2f}{record['occupancy']*100:>10.1f}%")
+    bottleneck = max(stats, key=lambda name: stats[name]['occupancy'])
+    print(f"Bottleneck: {bottleneck}")
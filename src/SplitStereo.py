@@ -0,0 +1,129 @@
+"""""""""""""""
+This file splits a raw side-by-side scrcpy capture into corrected left and right eye videos in a single pass.
+Each frame is decoded once, and the two halves are cropped, rotated and lens-corrected in parallel
+(see `LensCorrection.py`) before being written to their own output files. This replaces running the two
+ffmpeg commands from the README, which each decode the entire raw file.
+
+The crop offsets can be taken from the results file that `FindCropDimensions.py` writes next to its input image.
+"""""""""""""""
+
+import os
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import LensCorrection as LC
+import FindCropDimensions as FC
+
+# Returns the left and right eye parameters, with the crops optionally replaced by those from a `FindCropDimensions.py` results file
+def GetEyeParams(crop_filepath:str = None):
+    left_params = dict(LC.LEFT_EYE)
+    right_params = dict(LC.RIGHT_EYE)
+    if crop_filepath is not None:
+        left_params['crop'], right_params['crop'] = FC.ReadCropFile(crop_filepath)
+    return left_params, right_params
+
+# Helper: correct a frame and write it to the given writer. Executed on each eye's worker thread.
+def _CorrectAndWrite(writer, frame, params):
+    writer.write(LC.CorrectFrame(frame, **params))
+
+# Decodes `video_filepath` once and writes both corrected eye streams.
+# Each eye has its own single worker thread, so its frames are written in order while the other eye
+# and the decoder run concurrently. `queue_size` bounds how many decoded frames can be waiting per eye.
+def SplitStereo(
+        video_filepath:str,
+        left_output_filepath:str,
+        right_output_filepath:str,
+        left_params:dict = None,
+        right_params:dict = None,
+        queue_size:int = 8,
+        verbose:bool = False):
+    if left_params is None or right_params is None:
+        default_left, default_right = GetEyeParams()
+        left_params = default_left if left_params is None else left_params
+        right_params = default_right if right_params is None else right_params
+
+    vidcap = cv2.VideoCapture(video_filepath)
+    if not vidcap.isOpened():
+        raise FileNotFoundError(f"Unable to open video: {video_filepath}")
+    vidcapfps = vidcap.get(cv2.CAP_PROP_FPS)
+    eyes = []
+    for output_filepath, params in [(left_output_filepath, left_params), (right_output_filepath, right_params)]:
+        writer = cv2.VideoWriter(output_filepath, LC.GetFourCC(output_filepath), vidcapfps, (params['crop'][0], params['crop'][1]))
+        eyes.append((writer, params, ThreadPoolExecutor(max_workers=1), deque()))
+
+    count = 0
+    success, image = vidcap.read()
+    while success:
+        for writer, params, executor, pending in eyes:
+            pending.append(executor.submit(_CorrectAndWrite, writer, image, params))
+            if len(pending) > queue_size:
+                pending.popleft().result()
+        count += 1
+        success, image = vidcap.read()
+
+    # Drain both eyes, then close everything
+    for writer, params, executor, pending in eyes:
+        while pending:
+            pending.popleft().result()
+        executor.shutdown()
+        writer.release()
+    vidcap.release()
+
+    if verbose:
+        print(f"Split {count} frames into {left_output_filepath} and {right_output_filepath}")
+    return count
+
+# Compares the single-decode split against correcting each eye in its own pass, like the two README commands do.
+# Returns the throughput (in raw frames per second) of both approaches.
+def BenchmarkSplit(video_filepath:str, output_dir:str, left_params:dict = None, right_params:dict = None):
+    if left_params is None or right_params is None:
+        left_params, right_params = GetEyeParams()
+    vidcap = cv2.VideoCapture(video_filepath)
+    frame_count = int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT))
+    vidcap.release()
+    left_outpath = os.path.join(output_dir, 'benchmark_left.avi')
+    right_outpath = os.path.join(output_dir, 'benchmark_right.avi')
+
+    start = time.perf_counter()
+    LC.CorrectVideo(video_filepath, left_outpath, **left_params)
+    LC.CorrectVideo(video_filepath, right_outpath, **right_params)
+    two_pass = time.perf_counter() - start
+
+    start = time.perf_counter()
+    SplitStereo(video_filepath, left_outpath, right_outpath, left_params, right_params)
+    single_pass = time.perf_counter() - start
+
+    os.remove(left_outpath)
+    os.remove(right_outpath)
+    results = {'two_pass_fps':frame_count/two_pass, 'single_pass_fps':frame_count/single_pass}
+    print(f"Two-pass: {two_pass:.2f}s ({results['two_pass_fps']:.1f} fps)")
+    print(f"Single-pass: {single_pass:.2f}s ({results['single_pass_fps']:.1f} fps)")
+    print(f"Speedup: {two_pass/single_pass:.2f}x")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # REQUIRED
+    parser.add_argument('source',help='The raw side-by-side scrcpy footage')
+
+    # OPTIONAL
+    parser.add_argument('-l','--left',help='The output filepath of the left eye video', default=None)
+    parser.add_argument('-r','--right',help='The output filepath of the right eye video', default=None)
+    parser.add_argument('-cf','--crop_file',help='A results file from `FindCropDimensions.py` to take the eye crops from', default=None)
+    parser.add_argument('-q','--queue_size',help='How many decoded frames may be waiting for each eye', type=int, default=8)
+    parser.add_argument('-b','--benchmark',help='Compare against correcting each eye in a separate pass instead', action='store_true')
+    args = parser.parse_args()
+
+    _dir = os.path.dirname(args.source)
+    _filename = os.path.splitext(os.path.basename(args.source))[0]
+    left_params, right_params = GetEyeParams(args.crop_file)
+    if args.benchmark:
+        BenchmarkSplit(args.source, _dir, left_params, right_params)
+    else:
+        left_outpath = args.left if args.left is not None else os.path.join(_dir, _filename+'_left.mp4')
+        right_outpath = args.right if args.right is not None else os.path.join(_dir, _filename+'_right.mp4')
+        SplitStereo(args.source, left_outpath, right_outpath, left_params, right_params, queue_size=args.queue_size, verbose=True)
@@ -0,0 +1,204 @@
+"""""""""""""""
+This file provides the writers that annotated videos are encoded with. All of them share the same small interface:
+
+    writer = OpenWriter('output_eye.mp4', width, height, fps, backend='ffmpeg', codec='libx264', crf=23)
+    writer.write(frame, timestamp_ms)
+    writer.release()
+
+- `mjpg` is the original `cv2.VideoWriter` MJPG AVI output. It is fast to encode but produces very large files.
+- `ffmpeg` streams the raw BGR frames into an `ffmpeg` subprocess through a pipe, which encodes them with any codec
+  ffmpeg supports (`libx264` by default) at the given preset and CRF. Frame rates are kept as exact fractions
+  (e.g. 30000/1001 instead of 29), the output can be split into fixed-length segments, and with `vfr=True`
+  each frame keeps its own source timestamp.
+
+ffmpeg's raw video input cannot carry per-frame timestamps, so variable frame rate output is encoded at the nominal
+rate and the timestamps are written next to it as a Matroska timestamps (v2) file. If `mkvmerge` is installed, they
+are applied to the video right away; otherwise they can be applied later with
+`mkvmerge -o fixed.mkv --timestamps 0:<video>.timestamps.txt <video>`.
+"""""""""""""""
+
+import os
+import glob
+import time
+import shutil
+import argparse
+import subprocess
+from fractions import Fraction
+
+import numpy as np
+import cv2
+
+BACKENDS = ['mjpg', 'ffmpeg']
+
+# Returns the frame rate as an exact fraction. Floats are snapped to the nearest fraction with a denominator of
+# at most 1001, so that e.g. 29.97002997 becomes 30000/1001. Strings such as '30000/1001' are parsed as-is.
+def RationalFPS(fps):
+    if isinstance(fps, str):
+        return Fraction(fps)
+    return Fraction(fps).limit_denominator(1001)
+
+# Returns the file extension that a backend writes
+def OutputExtension(backend:str = 'mjpg', vfr:bool = False):
+    if backend == 'mjpg':
+        return '.avi'
+    return '.mkv' if vfr else '.mp4'
+
+# Helper: the filename pattern of the segments of `filepath`, e.g. `output_eye_%03d.mp4`
+def _SegmentPattern(filepath:str):
+    root, ext = os.path.splitext(filepath)
+    return f"{root}_%03d{ext}"
+
+# Returns the files a writer produced for `filepath`, which is several if it was split into segments
+def OutputFiles(filepath:str, segment_seconds:float = None):
+    if segment_seconds is None:
+        return [filepath]
+    root, ext = os.path.splitext(filepath)
+    return sorted(glob.glob(f"{glob.escape(root)}_[0-9][0-9][0-9]{ext}"))
+
+# The original output: MJPG in an AVI container, through OpenCV
+class MJPGWriter:
+    def __init__(self, filepath:str, width:int, height:int, fps):
+        self.filepath = filepath
+        self._writer = cv2.VideoWriter(filepath, cv2.VideoWriter_fourcc('M','J','P','G'), float(fps), (width, height))
+
+    def write(self, frame, timestamp_ms:float = None):
+        self._writer.write(frame)
+
+    def release(self):
+        self._writer.release()
+
+# Streams raw BGR frames to an ffmpeg subprocess, which encodes them in the background
+class FFmpegWriter:
+    def __init__(
+            self,
+            filepath:str,
+            width:int,
+            height:int,
+            fps,
+            codec:str = 'libx264',
+            preset:str = 'veryfast',
+            crf:int = 23,
+            pix_fmt:str = 'yuv420p',
+            vfr:bool = False,
+            segment_seconds:float = None,
+            ffmpeg:str = 'ffmpeg'):
+        if vfr and segment_seconds is not None:
+            raise ValueError("Variable frame rate output can't be split into segments")
+        self.filepath = filepath
+        self.shape = (height, width, 3)
+        self.fps = RationalFPS(fps)
+        self.vfr = vfr
+        self._timestamps = []
+
+        cmd = [ffmpeg, '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f"{width}x{height}", '-r', str(self.fps), '-i', '-',
+               '-c:v', codec]
+        if preset is not None:
+            cmd += ['-preset', preset]
+        if crf is not None:
+            cmd += ['-crf', str(crf)]
+        cmd += ['-pix_fmt', pix_fmt]
+        if segment_seconds is not None:
+            cmd += ['-f', 'segment', '-segment_time', f"{segment_seconds:g}", '-reset_timestamps', '1', _SegmentPattern(filepath)]
+        else:
+            cmd += [filepath]
+        self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, frame, timestamp_ms:float = None):
+        if frame.shape != self.shape:
+            raise ValueError(f"Expected a frame of shape {self.shape}, got {frame.shape}")
+        if self.vfr:
+            if timestamp_ms is None:
+                raise ValueError("Variable frame rate output needs the timestamp of every frame")
+            self._timestamps.append(timestamp_ms)
+        try:
+            # Hand the frame's buffer to the pipe directly, without copying it to a bytes object first
+            self._process.stdin.write(memoryview(np.ascontiguousarray(frame)).cast('B'))
+        except BrokenPipeError:
+            raise RuntimeError(f"ffmpeg exited early with code {self._process.wait()} while writing {self.filepath}")
+
+    def release(self):
+        self._process.stdin.close()
+        returncode = self._process.wait()
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with code {returncode} while writing {self.filepath}")
+        if self.vfr:
+            self._ApplyTimestamps()
+
+    # Writes the frame timestamps (relative to the first frame) next to the video, and applies them if possible
+    def _ApplyTimestamps(self):
+        timestamps_filepath = os.path.splitext(self.filepath)[0] + '.timestamps.txt'
+        with open(timestamps_filepath, 'w') as outfile:
+            outfile.write('# timestamp format v2\n')
+            first = self._timestamps[0] if len(self._timestamps) > 0 else 0.0
+            for timestamp in self._timestamps:
+                outfile.write(f"{timestamp-first:.3f}\n")
+        if shutil.which('mkvmerge') is None:
+            print(f"mkvmerge not found, the frame timestamps of {self.filepath} were saved to {timestamps_filepath}")
+            return
+        remuxed_filepath = self.filepath + '.tmp.mkv'
+        subprocess.run(
+            ['mkvmerge', '-q', '-o', remuxed_filepath, '--timestamps', f"0:{timestamps_filepath}", self.filepath],
+            check=True)
+        os.replace(remuxed_filepath, self.filepath)
+
+# Opens a writer for the given backend. Any other keyword arguments are passed on to `FFmpegWriter`.
+def OpenWriter(filepath:str, width:int, height:int, fps, backend:str = 'mjpg', **options):
+    if backend == 'mjpg':
+        return MJPGWriter(filepath, width, height, fps)
+    if backend == 'ffmpeg':
+        return FFmpegWriter(filepath, width, height, fps, **options)
+    raise ValueError(f"Unknown video backend '{backend}', expected one of {BACKENDS}")
+
+# Encodes the first `n_frames` frames of a video with the MJPG writer and with ffmpeg at each of the given CRFs.
+# The frames are decoded up front so that only the encoding is timed. Returns the throughput and size of each.
+def BenchmarkWriters(
+        video_filepath:str,
+        output_dir:str,
+        n_frames:int = 300,
+        codec:str = 'libx264',
+        preset:str = 'veryfast',
+        crfs = (18, 23, 28)):
+    vidcap = cv2.VideoCapture(video_filepath)
+    if not vidcap.isOpened():
+        raise FileNotFoundError(f"Unable to open video: {video_filepath}")
+    fps = vidcap.get(cv2.CAP_PROP_FPS)
+    frames = []
+    success, image = vidcap.read()
+    while success and len(frames) < n_frames:
+        frames.append(image)
+        success, image = vidcap.read()
+    vidcap.release()
+    height, width = frames[0].shape[:2]
+
+    configs = [('mjpg', {})] + [('ffmpeg', {'codec':codec, 'preset':preset, 'crf':crf}) for crf in crfs]
+    results = []
+    for backend, options in configs:
+        filepath = os.path.join(output_dir, 'benchmark_writer' + OutputExtension(backend))
+        start = time.perf_counter()
+        writer = OpenWriter(filepath, width, height, fps, backend=backend, **options)
+        for frame in frames:
+            writer.write(frame)
+        writer.release()
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(filepath)
+        os.remove(filepath)
+        label = backend if backend == 'mjpg' else f"{codec} {preset} crf={options['crf']}"
+        results.append({'writer':label, 'fps':len(frames)/elapsed, 'megabytes':size/1e6})
+        print(f"{label:<28}{len(frames)/elapsed:>10.1f} fps{size/1e6:>10.2f} MB")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # REQUIRED
+    parser.add_argument('source',help='The footage to encode')
+
+    # OPTIONAL
+    parser.add_argument('-n','--n_frames',help='How many frames to encode', type=int, default=300)
+    parser.add_argument('-vc','--video_codec',help='The ffmpeg codec to compare against MJPG', default='libx264')
+    parser.add_argument('-vp','--video_preset',help='The ffmpeg preset', default='veryfast')
+    parser.add_argument('-crf','--crf',help='The CRFs to try', type=int, nargs='+', default=[18, 23, 28])
+    args = parser.parse_args()
+
+    BenchmarkWriters(args.source, os.path.dirname(os.path.abspath(args.source)), args.n_frames, args.video_codec, args.video_preset, args.crf)
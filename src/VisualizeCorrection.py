@@ -1,52 +1,169 @@
-import numpy as np
+"""""""""""""""
+This file previews the `lenscorrection` filter on an image, with trackbars for `cx`, `cy`, `k1` and `k2`.
+The correction is applied in memory with the cached remap tables from `LensCorrection.py`, so moving a trackbar
+never runs ffmpeg or touches the disk. The tables are only rebuilt when a parameter actually changes.
+
+Trackbar callbacks only record the new parameters. A worker thread waits until they have stopped changing for a
+short moment (the debounce) and then renders them, while the window keeps showing the latest finished preview.
+Dragging a trackbar therefore never blocks the UI, and intermediate positions that were dragged past are skipped.
+
+With `--headless`, no window is opened: a sequence of random parameter changes is pushed through the same worker,
+and the time from each change to its preview is reported.
+"""""""""""""""
+
 import os
-import cv2
+import time
+import threading
 import argparse
 
-parser = argparse.ArgumentParser()
-parser.add_argument('source',help="The source image to visualize")
-args = parser.parse_args()
-
-src_img = cv2.imread(args.source)
-basename = os.path.basename(args.source)
-filename = os.path.splitext(basename)[0]
-
-output_img = np.copy(src_img)
-output_filename = f'{filename}_temp.png'
-cx = 50
-cy = 50
-k2 = 50
-k1 = 50
-def nothing(x):
-    global output_img, cx, cy, k2, k1, output_filename
-    _cx = threshold_value = cv2.getTrackbarPos('cx', window_name)
-    _cy = threshold_value = cv2.getTrackbarPos('cy', window_name)
-    _k2 = threshold_value = cv2.getTrackbarPos('k2', window_name)
-    _k1 = threshold_value = cv2.getTrackbarPos('k1', window_name)
-    cx = float(_cx/100.0)
-    cy = float(_cy/100.0)
-    k2 = float((_k2-50.0)/50.0)
-    k1 = float((_k1-50.0)/50.0)
-    cmd_str = 'ffmpeg -y -i {} -vf "lenscorrection=cx={}:cy={}:k2={}:k1={}" -vsync 2 {}'.format(
-            args.source, cx, cy, k2, k1, output_filename)
-    correction_code = os.system(cmd_str)
-    if correction_code == 0:
-        output_img = cv2.imread(output_filename) 
-
-window_name = f"Lens correction: {basename}"
-cv2.namedWindow(window_name)
-cv2.createTrackbar('cx', window_name, 50, 100, nothing)
-cv2.createTrackbar('cy', window_name, 50, 100, nothing)
-cv2.createTrackbar('k2', window_name, 50, 100, nothing)
-cv2.createTrackbar('k1', window_name, 50, 100, nothing)
-
-while True:
-    frame = cv2.imread(output_filename)
-    fshape = np.shape(frame)
-    p = [int(cx*fshape[0]),int(cy*fshape[1])]
-    out_frame = cv2.drawMarker(frame,p,[0,255,255],cv2.MARKER_CROSS,5,3)
-    cv2.imshow(window_name, out_frame)
-    if cv2.waitKey(1) & 0xFF == 27:
-        break
-
-cv2.destroyAllWindows()
+import numpy as np
+import cv2
+import LensCorrection as LC
+
+# Trackbar positions (0-100) => parameters. The focal point is relative, the coefficients go from -1 to 1.
+def TrackbarParams(_cx:int, _cy:int, _k1:int, _k2:int):
+    return {
+        'cx':float(_cx/100.0),
+        'cy':float(_cy/100.0),
+        'k1':float((_k1-50.0)/50.0),
+        'k2':float((_k2-50.0)/50.0)
+    }
+
+# Renders previews of an image in a background thread, always working on the most recent parameters
+class CorrectionPreview:
+    def __init__(self, src_img, debounce:float = 0.03, cx:float = 0.5, cy:float = 0.5, k1:float = 0.0, k2:float = 0.0):
+        self.src_img = src_img
+        self.debounce = debounce
+        self._params = {'cx':cx, 'cy':cy, 'k1':k1, 'k2':k2}
+        self._changed_at = 0.0
+        self._version = 1
+        self._rendered_version = 0
+        self._result = (dict(self._params), np.copy(src_img), 0)
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    # Draws the focal point on a corrected frame
+    @staticmethod
+    def DrawFocalPoint(frame, params:dict):
+        h, w = frame.shape[:2]
+        p = (int(params['cx']*w), int(params['cy']*h))
+        return cv2.drawMarker(frame, p, [0,255,255], cv2.MARKER_CROSS, 5, 3)
+
+    # Corrects the image with the given parameters, in the calling thread
+    def Render(self, params:dict):
+        frame = LC.CorrectFrame(self.src_img, None, 0.0, params['cx'], params['cy'], params['k1'], params['k2'])
+        return self.DrawFocalPoint(frame, params)
+
+    # Records new parameters for the worker to render. Setting the same parameters again does nothing.
+    def Set(self, **params):
+        with self._condition:
+            updated = {**self._params, **params}
+            if updated == self._params:
+                return
+            self._params = updated
+            self._changed_at = time.perf_counter()
+            self._version += 1
+            self._condition.notify()
+
+    # Returns the parameters, image and version of the latest finished preview
+    def Latest(self):
+        with self._condition:
+            return self._result
+
+    # Blocks until the preview of the current parameters is finished, or the timeout passes
+    def Wait(self, timeout:float = None):
+        with self._condition:
+            return self._condition.wait_for(lambda: self._rendered_version == self._version, timeout)
+
+    def Start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._Run, daemon=True)
+        self._thread.start()
+        return self
+
+    def Stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join()
+
+    # Helper: the worker loop. Waits for a change, waits out the debounce, then renders the newest parameters.
+    def _Run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: not self._running or self._rendered_version != self._version)
+                if not self._running:
+                    return
+                remaining = self._changed_at + self.debounce - time.perf_counter()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                params, version = dict(self._params), self._version
+            image = self.Render(params)
+            with self._condition:
+                self._result = (params, image, version)
+                self._rendered_version = version
+                self._condition.notify_all()
+
+# Pushes `n_changes` random parameter changes through a preview without a window, and reports how long each one
+# took to show up. The first change of each set also pays for building its remap tables.
+def BenchmarkPreview(src_img, n_changes:int = 50, debounce:float = 0.03, seed:int = 0):
+    rng = np.random.default_rng(seed)
+    preview = CorrectionPreview(src_img, debounce=debounce).Start()
+    latencies = []
+    for i in range(n_changes):
+        params = TrackbarParams(*rng.integers(0, 101, 4))
+        start = time.perf_counter()
+        preview.Set(**params)
+        preview.Wait()
+        latencies.append((time.perf_counter() - start) * 1000.0)
+    preview.Stop()
+    latencies = np.array(latencies)
+    print(f"{n_changes} changes, debounce {debounce*1000:.0f} ms: "
+          f"mean {latencies.mean():.1f} ms, median {np.median(latencies):.1f} ms, max {latencies.max():.1f} ms")
+    return latencies
+
+def main(args):
+    src_img = cv2.imread(args.source)
+    if src_img is None:
+        raise FileNotFoundError(f"Unable to read image: {args.source}")
+    basename = os.path.basename(args.source)
+
+    if args.headless:
+        BenchmarkPreview(src_img, args.n_changes, args.debounce)
+        return
+
+    preview = CorrectionPreview(src_img, debounce=args.debounce).Start()
+    window_name = f"Lens correction: {basename}"
+    def update(x):
+        preview.Set(**TrackbarParams(*[cv2.getTrackbarPos(name, window_name) for name in ['cx', 'cy', 'k1', 'k2']]))
+
+    cv2.namedWindow(window_name)
+    cv2.createTrackbar('cx', window_name, 50, 100, update)
+    cv2.createTrackbar('cy', window_name, 50, 100, update)
+    cv2.createTrackbar('k2', window_name, 50, 100, update)
+    cv2.createTrackbar('k1', window_name, 50, 100, update)
+    update(None)
+
+    shown = -1
+    while True:
+        params, frame, version = preview.Latest()
+        if version != shown:
+            cv2.imshow(window_name, frame)
+            shown = version
+        if cv2.waitKey(10) & 0xFF == 27:
+            break
+
+    preview.Stop()
+    cv2.destroyAllWindows()
+    print(f"Equivalent ffmpeg filter: {LC.FilterString(**preview.Latest()[0])}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source',help="The source image to visualize")
+    parser.add_argument('-d','--debounce',help='How long (in sec) the parameters must stay still before they are rendered', type=float, default=0.03)
+    parser.add_argument('-hl','--headless',help='Time random parameter changes without opening a window', action='store_true')
+    parser.add_argument('-n','--n_changes',help='How many parameter changes to time with --headless', type=int, default=50)
+    args = parser.parse_args()
+    main(args)
@@ -2,42 +2,40 @@
 This file takes the gaze tracking data from a Unity Meta Quest Pro build and the EEG data from MindMonitor
 to create an aligned version of EEG data and gaze tracking events. This system assumes that EEG data
 was sampled at a lower rate than the gaze tracking events.
+
+The aligned output can be written as:
+- `csv`: a single wide CSV file, as before
+- `parquet` / `feather`: a single columnar file (requires `pyarrow`)
+- `npy`: a directory with one NumPy file per column, plus `columns.json` listing them in order. Text columns
+  are stored as category codes. Columns are memory-mapped when read back, so a reader only touches the
+  columns it asks for.
+`ReadAligned()` reads any of these back, optionally only some of the columns.
 """""""""""""""
 
 # Basic Imports
+import os
+import json
+import hashlib
+import tempfile
 import argparse
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 
 # Custom helper functions
-from helpers import timestamp_to_unix_seconds as unix_seconds # Timestamps to Unix Seconds
-from helpers import timestamp_to_unix_milliseconds as unix_milliseconds # Timestamps to Unix Milliseconds
+from helpers import load_eeg, iter_eeg_chunks, open_byte_range, complete_rows_end # Typed, column-pruned EEG loading with vectorized timestamps
 
 def AlignData(
     EEG_FILEPATH:str,
     EVENTS_FILEPATH:str,
     OUTPUT_EVENTS_FILEPATH:str,
     FBANDS = ['Theta', 'Alpha', 'Beta', 'Gamma'],
-    ECHANNELS = ['AF7', 'AF8']
+    ECHANNELS = ['AF7', 'AF8'],
+    OUTPUT_FORMAT:str = 'csv'
 ):
     
     # === PART 1: EEG DATA ===
-    # Read EEG
-    eeg_df = pd.read_csv(EEG_FILEPATH)
-    # Remove NA rows
-    eeg_df = eeg_df[~eeg_df['TimeStamp'].isna()] # Remove rows where timestamp is na
-    eeg_df = eeg_df[~eeg_df['Battery'].isna()]   # Remove battery rows - useless
-    # TimeStamp => Unix Milliseconds
-    eeg_df['unix_ms'] = eeg_df['TimeStamp'].apply(lambda x: int(unix_milliseconds(x)))
-    # Remove all TP channels, Accelerometer, Gyroscope, and raw data columns
-    eeg_df = eeg_df.loc[:,~eeg_df.columns.str.contains('TP', case=False)]
-    eeg_df = eeg_df.loc[:,~eeg_df.columns.str.contains('Accelerometer', case=False)]
-    eeg_df = eeg_df.loc[:,~eeg_df.columns.str.contains('Gyro', case=False)]
-    eeg_df = eeg_df.loc[:,~eeg_df.columns.str.contains('RAW', case=False)]
-    eeg_df = eeg_df.loc[:,~eeg_df.columns.str.contains('AUX', case=False)]
-    # Drop useless columns
-    eeg_df.drop(columns=['TimeStamp', 'Elements', 'Battery', 'HeadBandOn'], inplace=True)
+    # Read only the EEG columns we need, removing NA rows, with TimeStamp => Unix Milliseconds
+    eeg_df = load_eeg(EEG_FILEPATH, [f"{band}_{channel}" for band in FBANDS for channel in ECHANNELS])
 
 
     # === PART 2: GAZE EVENTS DATA ===
@@ -53,46 +51,454 @@ def AlignData(
     system to be able to look at each `unix_ms` in `events_df`, check which `unix_ms` is the 
     closest but smaller to that timestamp, and then join.
     """
-    # Sort both dataframes by `unix_ms`
-    eeg_df = eeg_df.sort_values(by='unix_ms')
-    events_df = events_df.sort_values(by='unix_ms')
+    # Sort both dataframes by `unix_ms`, keeping rows with the same timestamp in their original order
+    eeg_df = eeg_df.sort_values(by='unix_ms', kind='stable')
+    events_df = events_df.sort_values(by='unix_ms', kind='stable')
     # Use numpy searchsorted to find the closest smaller `unix_ms` from eeg_df for each timestamp in events_df
     indices = np.searchsorted(eeg_df['unix_ms'].values, events_df['unix_ms'].values, side='right') - 1
     # Ensure indices are within bounds
     indices = np.clip(indices, 0, len(eeg_df) - 1)
     # Add the closest smaller `unix_ms`
     events_df['closest_unix_ms'] = eeg_df['unix_ms'].iloc[indices].values
-    # Add the corresponding values from eeg_df into events_df
-    for band in FBANDS:
-        for channel in ECHANNELS:
-            colname = f"{band}_{channel}"
-            events_df[colname] = 10 ** eeg_df[colname].iloc[indices].values
+    # Add the corresponding values from eeg_df into events_df, converted from log power to power, as one
+    # (events x bands*channels) block
+    colnames = [f"{band}_{channel}" for band in FBANDS for channel in ECHANNELS]
+    power = 10 ** eeg_df[colnames].to_numpy()[indices]
     # Calculate the max possible value
-    maxs = []
-    for band in FBANDS:
-        for channel in ECHANNELS:
-            colname = f"{band}_{channel}"
-            max_value = events_df[colname].max()
-            maxs.append(max_value)
-    global_max = np.max(maxs)
-    # Re-calcualte the relative values for each EEG column
-    for band in FBANDS:
-        for channel in ECHANNELS:
-            in_colname = f"{band}_{channel}"
-            out_colname = f"Rel_{band}_{channel}"
-            events_df[out_colname] = (events_df[in_colname] / global_max) * 100
-    # Cast relative values into ints
-    for band in FBANDS:
-        for channel in ECHANNELS:
-            colname = f"Rel_{band}_{channel}"
-            events_df[colname] = events_df[colname].astype('int')
+    global_max = np.max(np.nanmax(power, axis=0)) if len(power) > 0 else np.nan
+    # Re-calculate the relative values for each EEG column, cast into ints
+    rel = pd.DataFrame((power / global_max) * 100, columns=[f"Rel_{c}" for c in colnames], index=events_df.index).astype('int')
+    events_df = pd.concat([events_df, pd.DataFrame(power, columns=colnames, index=events_df.index), rel], axis=1)
     
 
     # === PART 4: OUTPUTS ===
-    # Print output CSV to dictated output filepath without index
-    events_df.to_csv(OUTPUT_EVENTS_FILEPATH, index=False)
+    # Print output to dictated output filepath without index
+    WriteAligned(events_df, OUTPUT_EVENTS_FILEPATH, OUTPUT_FORMAT)
     
 
+OUTPUT_FORMATS = ['csv', 'parquet', 'feather', 'npy']
+
+# Writes an aligned Dataframe in one of `OUTPUT_FORMATS`, without its index
+def WriteAligned(df, filepath:str, fmt:str = 'csv'):
+    if fmt == 'csv':
+        df.to_csv(filepath, index=False)
+    elif fmt == 'parquet':
+        df.to_parquet(filepath, index=False)
+    elif fmt == 'feather':
+        df.reset_index(drop=True).to_feather(filepath)
+    elif fmt == 'npy':
+        os.makedirs(filepath, exist_ok=True)
+        categories = {}
+        for column in df.columns:
+            values = df[column]
+            if not (pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values)):
+                # Text can't be memory-mapped, so it is stored as codes into a list of categories (-1 is NA)
+                categorical = pd.Categorical(values)
+                categories[column] = categorical.categories.tolist()
+                values = categorical.codes
+            np.save(os.path.join(filepath, column+'.npy'), np.ascontiguousarray(values))
+        with open(os.path.join(filepath, 'columns.json'), 'w') as jsonfile:
+            json.dump({'columns':df.columns.tolist(), 'categories':categories}, jsonfile, indent=4)
+    else:
+        raise ValueError(f"Unknown output format '{fmt}', expected one of {OUTPUT_FORMATS}")
+
+# Returns the format of an aligned output from its path
+def AlignedFormat(filepath:str):
+    if os.path.isdir(filepath):
+        return 'npy'
+    ext = os.path.splitext(filepath)[1].lower()
+    return {'.parquet':'parquet', '.feather':'feather'}.get(ext, 'csv')
+
+# Reads an aligned output back, in any of `OUTPUT_FORMATS`. Only `columns` are read if given, and with `npy`
+# the numeric columns stay memory-mapped views of their files.
+def ReadAligned(filepath:str, columns = None, fmt:str = None):
+    fmt = AlignedFormat(filepath) if fmt is None else fmt
+    if fmt == 'csv':
+        return pd.read_csv(filepath, usecols=columns)
+    if fmt == 'parquet':
+        return pd.read_parquet(filepath, columns=columns)
+    if fmt == 'feather':
+        return pd.read_feather(filepath, columns=columns)
+    with open(os.path.join(filepath, 'columns.json')) as jsonfile:
+        layout = json.load(jsonfile)
+    data = {}
+    for column in (layout['columns'] if columns is None else columns):
+        values = np.load(os.path.join(filepath, column+'.npy'), mmap_mode='r')
+        if column in layout['categories']:
+            values = pd.Categorical.from_codes(np.asarray(values), layout['categories'][column])
+        data[column] = values
+    return pd.DataFrame(data, copy=False)
+
+# Helper: keeps the first `start` rows of a 1-D .npy file and appends `values` after them (if given). The shape in
+# the header is rewritten in place, as NumPy leaves room in the header for it to grow. If `values` don't fit the
+# file's dtype (e.g. more categories than int8 codes can hold), the whole file is rewritten with a wider one.
+def _AppendNpy(filepath:str, start:int, values = None):
+    with open(filepath, 'r+b') as npyfile:
+        version = np.lib.format.read_magic(npyfile)
+        read_header, write_header = {
+            (1, 0):(np.lib.format.read_array_header_1_0, np.lib.format.write_array_header_1_0),
+            (2, 0):(np.lib.format.read_array_header_2_0, np.lib.format.write_array_header_2_0)}[version]
+        shape, fortran_order, dtype = read_header(npyfile)
+        header_end = npyfile.tell()
+        if values is not None and np.result_type(dtype, values.dtype) != dtype:
+            kept = np.fromfile(npyfile, dtype=dtype, count=start)
+            npyfile.close()
+            np.save(filepath, np.concatenate([kept, values]))
+            return
+        n_rows = start + (0 if values is None else len(values))
+        npyfile.seek(0)
+        write_header(npyfile, {'descr':np.lib.format.dtype_to_descr(dtype), 'fortran_order':fortran_order, 'shape':(n_rows,)})
+        if npyfile.tell() != header_end:
+            raise ValueError(f"The header of {filepath} has no room for {n_rows} rows")
+        npyfile.truncate(header_end + start * dtype.itemsize)
+        npyfile.seek(0, os.SEEK_END)
+        if values is not None:
+            npyfile.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+
+# Writes an aligned output one chunk at a time. Only `csv` and `npy` can be written this way, and with `npy`, the
+# categories of every text column must be known up front.
+# With `position` (a value of `Position()` from writing the same output before), the rows up to that point are
+# kept and new rows are added after them. Otherwise, a new output is written.
+class AlignedWriter:
+    STREAM_FORMATS = ['csv', 'npy']
+
+    def __init__(self, filepath:str, fmt:str = 'csv', categories:dict = None, position:int = None):
+        if fmt not in self.STREAM_FORMATS:
+            raise ValueError(f"Can't write '{fmt}' one chunk at a time, expected one of {self.STREAM_FORMATS}")
+        self.filepath = filepath
+        self.fmt = fmt
+        self.categories = {} if categories is None else categories
+        self.columns = None
+        self.position = position
+        if position is None:
+            return
+        if fmt == 'csv':
+            self.columns = pd.read_csv(filepath, nrows=0).columns.tolist()
+            os.truncate(filepath, position)
+        else:
+            with open(os.path.join(filepath, 'columns.json')) as jsonfile:
+                self.columns = json.load(jsonfile)['columns']
+            for column in self.columns:
+                _AppendNpy(os.path.join(filepath, column+'.npy'), position)
+
+    # Where the output ends: its size in bytes for `csv`, or its number of rows for `npy`. None until rows are written.
+    def Position(self):
+        return self.position
+
+    def Write(self, df):
+        if self.fmt == 'csv':
+            df.to_csv(self.filepath, index=False, mode='w' if self.position is None else 'a', header=self.position is None)
+            self.position = os.path.getsize(self.filepath)
+        else:
+            os.makedirs(self.filepath, exist_ok=True)
+            for column in df.columns:
+                values = df[column]
+                if column in self.categories:
+                    values = pd.Categorical(values, categories=self.categories[column]).codes
+                values = np.asarray(values)
+                if self.position is None:
+                    np.save(os.path.join(self.filepath, column+'.npy'), np.ascontiguousarray(values))
+                else:
+                    _AppendNpy(os.path.join(self.filepath, column+'.npy'), self.position, values)
+            self.position = (0 if self.position is None else self.position) + len(df)
+        self.columns = df.columns.tolist()
+
+    # Recomputes the `Rel_*` columns of the rows kept so far, relative to a new `global_max`. With `csv`, the
+    # rows are read back (as `dtypes`) and rewritten; with `npy`, only the `Rel_*` files are.
+    def Rescale(self, colnames:list, global_max:float, dtypes:dict, chunksize:int = 100_000):
+        if self.position is None:
+            return
+        if self.fmt == 'npy':
+            for column in colnames:
+                power = np.load(os.path.join(self.filepath, column+'.npy'), mmap_mode='r')
+                rel = np.load(os.path.join(self.filepath, f"Rel_{column}.npy"), mmap_mode='r+')
+                for start in range(0, self.position, chunksize):
+                    end = min(start + chunksize, self.position)
+                    rel[start:end] = ((power[start:end] / global_max) * 100).astype('int')
+                rel.flush()
+                del power, rel
+            return
+        rel_columns = [f"Rel_{c}" for c in colnames]
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(self.filepath)), suffix='.csv', delete=False) as tmpfile:
+            tmp_filepath = tmpfile.name
+        with open_byte_range(self.filepath, 0, self.position) as infile:
+            header = True
+            for df in pd.read_csv(infile, dtype=dtypes, float_precision='round_trip', chunksize=chunksize):
+                df[rel_columns] = ((df[colnames].to_numpy() / global_max) * 100).astype('int')
+                df.to_csv(tmp_filepath, index=False, mode='w' if header else 'a', header=header)
+                header = False
+        os.replace(tmp_filepath, self.filepath)
+        self.position = os.path.getsize(self.filepath)
+
+    def Close(self):
+        if self.fmt == 'npy' and self.columns is not None:
+            with open(os.path.join(self.filepath, 'columns.json'), 'w') as jsonfile:
+                json.dump({'columns':self.columns, 'categories':self.categories}, jsonfile, indent=4)
+
+# Helper: the dtypes `pd.read_csv()` would give each column of a CSV file (or file object) if it read the whole
+# file at once, found by reading it in chunks. Columns that are whole numbers in some chunks and decimals (or
+# empty) in others are floats, and columns that are text in any chunk are text.
+def _CsvDtypes(src, chunksize:int):
+    kinds = {}
+    for df in pd.read_csv(src, chunksize=chunksize):
+        for column, dtype in df.dtypes.items():
+            kinds.setdefault(column, set()).add(dtype)
+    dtypes = {}
+    for column, found in kinds.items():
+        if len(found) == 1:
+            dtypes[column] = found.pop()
+        elif all(pd.api.types.is_integer_dtype(d) or pd.api.types.is_float_dtype(d) for d in found):
+            dtypes[column] = np.float64
+        else:
+            dtypes[column] = str
+    return dtypes
+
+# Helper: an as-of join against EEG chunks that arrive in time order. `Match()` is given the (sorted) timestamps
+# of the next events, and returns the timestamp and values of the latest EEG row at or before each. Only the EEG
+# rows from the latest match onwards are kept, since no later event can match anything before it. `tail` is
+# what was kept by an earlier run, as (timestamps, values), which the new chunks continue from.
+class _StreamingAsOf:
+    def __init__(self, eeg_chunks, colnames, tail = None):
+        self.eeg_chunks = iter(eeg_chunks)
+        self.colnames = colnames
+        self.times = np.empty(0, dtype=np.int64) if tail is None else tail[0]
+        self.values = np.empty((0, len(colnames))) if tail is None else tail[1]
+        self.exhausted = False
+
+    def _Load(self):
+        for df in self.eeg_chunks:
+            times = df['unix_ms'].to_numpy()
+            if len(times) == 0:
+                continue
+            if np.any(np.diff(times) < 0) or (len(self.times) > 0 and times[0] < self.times[-1]):
+                raise ValueError("The EEG data isn't sorted by time, so it can't be aligned in a streaming pass")
+            self.times = np.concatenate([self.times, times])
+            self.values = np.concatenate([self.values, df[self.colnames].to_numpy()])
+            return
+        self.exhausted = True
+
+    def Match(self, times):
+        # Read EEG rows until one comes after the last event, as a later row could still share its timestamp
+        while not self.exhausted and (len(self.times) == 0 or self.times[-1] <= times[-1]):
+            self._Load()
+        if len(self.times) == 0:
+            raise ValueError("The EEG data has no rows")
+        indices = np.clip(np.searchsorted(self.times, times, side='right') - 1, 0, len(self.times) - 1)
+        closest, values = self.times[indices], self.values[indices]
+        self.times, self.values = self.times[indices[-1]:], self.values[indices[-1]:]
+        return closest, values
+
+    # Reads the rest of the EEG rows, and returns the ones later events could still match as (timestamps, values),
+    # or None if there are none
+    def Remaining(self):
+        while not self.exhausted:
+            self._Load()
+        return (self.times, self.values) if len(self.times) > 0 else None
+
+# Helper: the state of an alignment that hasn't read anything yet. The events' dtypes are found from everything
+# up to byte `events_end`.
+def _NewState(EEG_FILEPATH:str, EVENTS_FILEPATH:str, colnames:list, fmt:str, events_end:int, chunksize:int):
+    with open_byte_range(EVENTS_FILEPATH, 0, events_end) as infile:
+        dtypes = _CsvDtypes(infile, chunksize)
+    return {
+        'eeg':os.path.abspath(EEG_FILEPATH),
+        'events':os.path.abspath(EVENTS_FILEPATH),
+        'colnames':colnames,
+        'format':fmt,
+        'dtypes':dtypes,
+        'eeg_offset':0,                                  # Bytes of each input that have been read
+        'events_offset':0,
+        'eeg_tail':None,                                 # EEG rows from the latest event's match on, as (timestamps, log values)
+        'pending':None,                                  # Events at or after the latest EEG row
+        'last_time':None,                                # The latest final event's timestamp
+        'column_max':np.full(len(colnames), np.nan),     # The maximum of each column, over the other events
+        'global_max':None,                               # What the output's `Rel_*` columns are relative to
+        'position':None,                                 # Where the output's pending rows start
+        'categories':{}}                                 # The categories of each text column, for `npy`
+
+# Helper: raised when rows added to the events file don't fit the column types found when it was first read
+class _ColumnTypesChanged(ValueError):
+    pass
+
+# Helper: aligns everything that was added to both files since `state`, up to bytes `eeg_end` and `events_end`,
+# and adds it to the output. Updates and returns `state`.
+# Events before the latest EEG row can't match anything that is added to the EEG file later, so they are final.
+# The rest are pending: they are written to the output too, but are kept in the state and aligned again next
+# time, replacing them in the output. The running maxima only cover final rows, and the `Rel_*` columns of the
+# rows kept in the output are only recomputed if the global maximum has changed.
+def _AlignIncrement(
+        EEG_FILEPATH:str,
+        EVENTS_FILEPATH:str,
+        OUTPUT_EVENTS_FILEPATH:str,
+        state:dict,
+        eeg_end:int,
+        events_end:int,
+        chunksize:int):
+    colnames = state['colnames']
+    dtypes = state['dtypes']
+    eeg_chunks = iter_eeg_chunks(EEG_FILEPATH, colnames, chunksize, start=state['eeg_offset'], end=eeg_end)
+    asof = _StreamingAsOf(eeg_chunks, colnames, state['eeg_tail'])
+    text_columns = [c for c, d in dtypes.items() if not (pd.api.types.is_numeric_dtype(d) or pd.api.types.is_bool_dtype(d))]
+
+    # The pending events from last time, followed by the new ones
+    def event_chunks():
+        if state['pending'] is not None and len(state['pending']) > 0:
+            yield state['pending']
+        if events_end > state['events_offset']:
+            with open_byte_range(EVENTS_FILEPATH, state['events_offset'], events_end, header=True) as infile:
+                try:
+                    yield from pd.read_csv(infile, dtype=dtypes, chunksize=chunksize)
+                except ValueError as e:
+                    raise _ColumnTypesChanged(str(e)) from e
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(OUTPUT_EVENTS_FILEPATH))) as spool_dir:
+        # PASS 1: align each chunk of events, and keep the running maxima and text values
+        final_max = state['column_max'].copy()
+        pending_max = np.full(len(colnames), np.nan)
+        values_seen = {c:set() for c in text_columns}
+        pending = []
+        n_final = []
+        last_time = last_final_time = state['last_time']
+        for events_df in event_chunks():
+            if len(events_df) == 0:
+                continue
+            times = events_df['unix_ms'].to_numpy()
+            if np.any(np.diff(times) < 0) or (last_time is not None and times[0] < last_time):
+                raise ValueError("The events aren't sorted by time, so they can't be aligned in a streaming pass")
+            last_time = times[-1]
+            closest, values = asof.Match(times)
+            power = 10 ** values
+            n = int(np.searchsorted(times, asof.times[-1], side='left'))
+            if n > 0:
+                last_final_time = times[n-1]
+                final_max = np.fmax(final_max, np.fmax.reduce(power[:n], axis=0))
+            if n < len(times):
+                pending_max = np.fmax(pending_max, np.fmax.reduce(power[n:], axis=0))
+                pending.append(events_df.iloc[n:])
+            events_df = events_df.assign(closest_unix_ms=closest)
+            events_df = pd.concat([events_df, pd.DataFrame(power, columns=colnames, index=events_df.index)], axis=1)
+            for column in text_columns:
+                values_seen[column].update(events_df[column].dropna())
+            events_df.to_pickle(os.path.join(spool_dir, f"{len(n_final)}.pkl"))
+            n_final.append(n)
+        global_max = np.max(np.fmax(final_max, pending_max))
+
+        # New text values go after the existing categories, so the codes already written stay valid
+        categories = {}
+        for column in text_columns:
+            existing = state['categories'].get(column, []) if state['position'] is not None else []
+            categories[column] = existing + sorted(values_seen[column].difference(existing))
+
+        # PASS 2: rescale the rows that are kept if needed, then add the relative values and append everything
+        writer = AlignedWriter(OUTPUT_EVENTS_FILEPATH, state['format'], categories, state['position'])
+        rescaled = state['position'] is not None and not np.array_equal(global_max, state['global_max'], equal_nan=True)
+        if rescaled:
+            output_dtypes = {**dtypes, 'closest_unix_ms':np.int64, **{c:np.float64 for c in colnames}, **{f"Rel_{c}":np.int64 for c in colnames}}
+            writer.Rescale(colnames, global_max, output_dtypes, chunksize)
+        position = writer.Position()
+        for i, n in enumerate(n_final):
+            events_df = pd.read_pickle(os.path.join(spool_dir, f"{i}.pkl"))
+            rel = pd.DataFrame((events_df[colnames].to_numpy() / global_max) * 100, columns=[f"Rel_{c}" for c in colnames], index=events_df.index).astype('int')
+            events_df = pd.concat([events_df, rel], axis=1)
+            if n > 0:
+                writer.Write(events_df.iloc[:n])
+                position = writer.Position()
+            if n < len(events_df):
+                writer.Write(events_df.iloc[n:])
+        writer.Close()
+
+    state.update({
+        'eeg_offset':eeg_end,
+        'events_offset':events_end,
+        'eeg_tail':asof.Remaining(),
+        'pending':pd.concat(pending) if len(pending) > 0 else None,
+        'last_time':last_final_time,
+        'column_max':final_max,
+        'global_max':global_max,
+        'position':position,
+        'categories':categories})
+    return {'rows':int(sum(n_final)), 'pending':sum(len(p) for p in pending), 'rescaled':rescaled}
+
+# Same as `AlignData()`, but both files are read `CHUNKSIZE` rows at a time, so memory use stays flat no matter
+# how long the session is. Both files must already be sorted by time, as recordings are.
+# The events are aligned in one pass, which also keeps the running maximum of each EEG column. The aligned
+# chunks are kept in a temporary directory next to the output, and the `Rel_*` columns are added to them in a
+# second pass once the global maximum is known. The output is identical to `AlignData()`'s.
+def AlignDataStreaming(
+    EEG_FILEPATH:str,
+    EVENTS_FILEPATH:str,
+    OUTPUT_EVENTS_FILEPATH:str,
+    FBANDS = ['Theta', 'Alpha', 'Beta', 'Gamma'],
+    ECHANNELS = ['AF7', 'AF8'],
+    OUTPUT_FORMAT:str = 'csv',
+    CHUNKSIZE:int = 100_000
+):
+    colnames = [f"{band}_{channel}" for band in FBANDS for channel in ECHANNELS]
+    eeg_end, events_end = os.path.getsize(EEG_FILEPATH), os.path.getsize(EVENTS_FILEPATH)
+    state = _NewState(EEG_FILEPATH, EVENTS_FILEPATH, colnames, OUTPUT_FORMAT, events_end, CHUNKSIZE)
+    _AlignIncrement(EEG_FILEPATH, EVENTS_FILEPATH, OUTPUT_EVENTS_FILEPATH, state, eeg_end, events_end, CHUNKSIZE)
+
+STATE_SUFFIX = '.state.pkl'
+
+# Returns where the state of an incremental alignment into `filepath` is kept
+def AlignedStateFilename(filepath:str):
+    return filepath.rstrip('/\\') + STATE_SUFFIX
+
+# Helper: whether an incremental alignment can carry on from `state`, i.e. it used the same settings and both
+# files have only grown since. The start of each file is compared to what it was, to catch replaced files.
+def _Resumable(state:dict, EEG_FILEPATH:str, EVENTS_FILEPATH:str, OUTPUT_EVENTS_FILEPATH:str, colnames:list, fmt:str, eeg_end:int, events_end:int):
+    if state.get('version') != 1 or state['colnames'] != colnames or state['format'] != fmt:
+        return False
+    if state['eeg'] != os.path.abspath(EEG_FILEPATH) or state['events'] != os.path.abspath(EVENTS_FILEPATH):
+        return False
+    if not os.path.exists(OUTPUT_EVENTS_FILEPATH) or eeg_end < state['eeg_offset'] or events_end < state['events_offset']:
+        return False
+    return state['fingerprint'] == (_Fingerprint(EEG_FILEPATH, state['eeg_offset']), _Fingerprint(EVENTS_FILEPATH, state['events_offset']))
+
+# Helper: a hash of the first bytes of a file, up to `length`
+def _Fingerprint(filepath:str, length:int, max_length:int = 1 << 16):
+    with open(filepath, 'rb') as infile:
+        return hashlib.sha256(infile.read(min(length, max_length))).hexdigest()
+
+# Aligns only what was added to the EEG and events files since the last call, and appends it to the output. This
+# is meant for recordings that are still growing: a row that is still being written at the end of either file is
+# left for next time. Progress (how far each file was read, the EEG rows after the latest event's match, the
+# events after the latest EEG row and the running maxima) is kept in `<output>.state.pkl`.
+# The `Rel_*` columns already written are only recomputed when the global maximum changes. Otherwise, the cost of
+# each call only depends on how much was added. The output always matches aligning both files from scratch,
+# except that with `npy`, text values that first appear in later calls are added to the end of the categories.
+# If the settings changed, either file was replaced, or new rows don't fit the column types found so far, everything
+# is aligned again from scratch.
+# Returns how many event rows were finalized and left pending, and whether the `Rel_*` columns were recomputed.
+def AlignDataIncremental(
+    EEG_FILEPATH:str,
+    EVENTS_FILEPATH:str,
+    OUTPUT_EVENTS_FILEPATH:str,
+    FBANDS = ['Theta', 'Alpha', 'Beta', 'Gamma'],
+    ECHANNELS = ['AF7', 'AF8'],
+    OUTPUT_FORMAT:str = 'csv',
+    CHUNKSIZE:int = 100_000
+):
+    colnames = [f"{band}_{channel}" for band in FBANDS for channel in ECHANNELS]
+    state_filepath = AlignedStateFilename(OUTPUT_EVENTS_FILEPATH)
+    eeg_end, events_end = complete_rows_end(EEG_FILEPATH), complete_rows_end(EVENTS_FILEPATH)
+
+    summary = None
+    if os.path.isfile(state_filepath):
+        state = pd.read_pickle(state_filepath)
+        if _Resumable(state, EEG_FILEPATH, EVENTS_FILEPATH, OUTPUT_EVENTS_FILEPATH, colnames, OUTPUT_FORMAT, eeg_end, events_end):
+            try:
+                summary = _AlignIncrement(EEG_FILEPATH, EVENTS_FILEPATH, OUTPUT_EVENTS_FILEPATH, state, eeg_end, events_end, CHUNKSIZE)
+            except _ColumnTypesChanged:
+                summary = None
+    if summary is None:
+        state = _NewState(EEG_FILEPATH, EVENTS_FILEPATH, colnames, OUTPUT_FORMAT, events_end, CHUNKSIZE)
+        summary = _AlignIncrement(EEG_FILEPATH, EVENTS_FILEPATH, OUTPUT_EVENTS_FILEPATH, state, eeg_end, events_end, CHUNKSIZE)
+
+    state['version'] = 1
+    state['fingerprint'] = (_Fingerprint(EEG_FILEPATH, eeg_end), _Fingerprint(EVENTS_FILEPATH, events_end))
+    pd.to_pickle(state, state_filepath)
+    return summary
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -113,10 +519,27 @@ if __name__ == "__main__":
     parser.add_argument('-ec','--electrode_channels',
                         help='The list of electrode channels that must be included', 
                         default=['AF7', 'AF8'])
+    parser.add_argument('-f','--format',
+                        help='The format of the output. `npy` writes a directory with one file per column',
+                        choices=OUTPUT_FORMATS,
+                        default='csv')
+    parser.add_argument('-c','--chunksize',
+                        help='Read both files this many rows at a time, so memory use stays flat for long sessions. Only for `csv` and `npy` outputs',
+                        type=int,
+                        default=None)
+    parser.add_argument('-i','--incremental',
+                        help='Only align what was added to both files since the last run with `-i`, and append it to the output',
+                        action='store_true')
 
     # Call the function
     args = parser.parse_args()
-    AlignData(args.eeg, args.events, args.output, args.frequency_bands, args.electrode_channels)
+    if args.incremental:
+        summary = AlignDataIncremental(args.eeg, args.events, args.output, args.frequency_bands, args.electrode_channels, args.format, args.chunksize or 100_000)
+        print(f"Aligned {summary['rows']} new rows ({summary['pending']} pending), rescaled: {summary['rescaled']}")
+    elif args.chunksize is None:
+        AlignData(args.eeg, args.events, args.output, args.frequency_bands, args.electrode_channels, args.format)
+    else:
+        AlignDataStreaming(args.eeg, args.events, args.output, args.frequency_bands, args.electrode_channels, args.format, args.chunksize)
     
     #EEG_FILEPATH = './samples/eeg_events/eeg.csv'
     #EVENTS_FILEPATH = './samples/eeg_events/events.csv'
@@ -1,7 +1,13 @@
+import io
 import os
 import datetime
+import numpy as np
 import pandas as pd
-from IPython.display import display, Markdown, Latex
+
+# The format of MindMonitor's `TimeStamp` column, which is in local time
+EEG_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+# Columns of a MindMonitor recording that none of the processing uses
+EEG_UNUSED_COLUMNS = ['RAW_TP9', 'RAW_AF7', 'RAW_AF8', 'RAW_TP10', 'AUX_RIGHT']
 
 # Converts the format of a local timestamp into unix seconds. Requires the datetime package
 def timestamp_to_unix_seconds(x):
@@ -16,6 +22,104 @@ def timestamp_to_unix_milliseconds(x):
     unix_milliseconds = int(unix_seconds * 1000)
     return unix_milliseconds
 
+# Vectorized `timestamp_to_unix_milliseconds()` over a whole Series of local timestamps, with identical results.
+# The strings are parsed in one pass as if they were UTC. The local UTC offset can only change on a whole minute,
+# so it is looked up with `datetime` once per distinct minute, which also handles DST the same way (fold=0).
+# The final float arithmetic and truncation are the same as `int(timestamp * 1000)`.
+def timestamps_to_unix_milliseconds(timestamps):
+    wall_ns = pd.to_datetime(timestamps, format=EEG_TIMESTAMP_FORMAT).to_numpy().astype('datetime64[ns]').view(np.int64)
+    wall_seconds = wall_ns // 1_000_000_000
+    microseconds = (wall_ns - wall_seconds * 1_000_000_000) // 1000
+    minutes, inverse = np.unique(wall_seconds // 60, return_inverse=True)
+    epoch = datetime.datetime(1970, 1, 1)
+    offsets = np.array([m*60 - int(datetime.datetime.timestamp(epoch + datetime.timedelta(minutes=int(m)))) for m in minutes], dtype=np.int64)
+    unix_seconds = (wall_seconds - offsets[inverse.ravel()]).astype(np.float64) + microseconds / 1e6
+    return (unix_seconds * 1000).astype(np.int64)
+
+# A raw file object over bytes `start` to `end` of a file, after `prefix`. See `open_byte_range()`
+class _ByteRangeReader(io.RawIOBase):
+    def __init__(self, src:str, start:int, end:int, prefix:bytes = b''):
+        self._file = open(src, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+        self._prefix = prefix
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if len(self._prefix) > 0:
+            n = min(len(buffer), len(self._prefix))
+            buffer[:n] = self._prefix[:n]
+            self._prefix = self._prefix[n:]
+            return n
+        n = self._file.readinto(memoryview(buffer)[:min(len(buffer), self._remaining)])
+        self._remaining -= n
+        return n
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+# Opens bytes `start` to `end` (the end of the file if not given) of a file for reading, e.g. by `pd.read_csv()`.
+# Used to read only the rows that were appended to a recording since it was last read. With `header`, the first
+# line of the file comes first, so the rows are parsed exactly as they would be when reading the whole file.
+def open_byte_range(src:str, start:int = 0, end:int = None, header:bool = False):
+    end = os.path.getsize(src) if end is None else end
+    prefix = b''
+    if header and start > 0:
+        with open(src, 'rb') as infile:
+            prefix = infile.readline()
+    return io.BufferedReader(_ByteRangeReader(src, start, max(start, end), prefix))
+
+# Returns the byte offset just past the last complete row of a text file. A recording that is still being written
+# can end with a partial row, which should be left for the next read.
+def complete_rows_end(src:str, block_size:int = 1 << 16):
+    with open(src, 'rb') as infile:
+        end = infile.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - block_size)
+            infile.seek(start)
+            newline = infile.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+    return 0
+
+# Reads a MindMonitor EEG recording `chunksize` rows at a time, and yields each chunk with a `unix_ms` column in
+# place of `TimeStamp`. Only `columns` are read (all but `EEG_UNUSED_COLUMNS` if not given), with the numeric ones
+# as `value_dtype`. Rows without a timestamp or battery reading are removed if `parse_na` is set, like the
+# original per-row processing, and the row labels of the file (counted from `start`) are kept.
+# Only the rows between byte offsets `start` and `end` are read, where `start` is 0 or just past a complete row.
+def iter_eeg_chunks(
+        src:str,
+        columns = None,
+        chunksize:int = 100_000,
+        parse_na:bool = True,
+        value_dtype = np.float64,
+        start:int = 0,
+        end:int = None):
+    header = pd.read_csv(src, nrows=0).columns
+    if columns is None:
+        columns = [c for c in header if c not in EEG_UNUSED_COLUMNS and c != 'TimeStamp']
+    usecols = [c for c in header if c == 'TimeStamp' or c in columns or (parse_na and c == 'Battery')]
+    dtypes = {c:(str if c in ['TimeStamp', 'Elements'] else value_dtype) for c in usecols}
+    if start > 0 and start >= (os.path.getsize(src) if end is None else end):
+        return
+    with open_byte_range(src, start, end, header=True) as infile:
+        for df in pd.read_csv(infile, usecols=usecols, dtype=dtypes, chunksize=chunksize):
+            if parse_na:
+                df = df[~df['TimeStamp'].isna() & ~df['Battery'].isna()]
+            unix_ms = timestamps_to_unix_milliseconds(df['TimeStamp'])
+            df = df.drop(columns=[c for c in df.columns if c not in columns])
+            df['unix_ms'] = unix_ms
+            yield df
+
+# Reads a whole MindMonitor EEG recording with `iter_eeg_chunks()`
+def load_eeg(src:str, columns = None, chunksize:int = 100_000, parse_na:bool = True, value_dtype = np.float64):
+    chunks = list(iter_eeg_chunks(src, columns, chunksize, parse_na, value_dtype))
+    return pd.concat(chunks) if len(chunks) > 1 else chunks[0]
+
 # Gets immediate child subdirectories
 # Src: https://stackoverflow.com/questions/800197/how-to-get-all-of-the-immediate-subdirectories-in-python
 def get_immediate_subdirectories(a_dir):
@@ -39,11 +143,9 @@ def process_raw_eeg(
         frequency_bands = ['Delta', 'Theta', 'Alpha', 'Beta', 'Gamma'],
         electrode_channels = ['AF7', 'AF8', 'TP9', 'TP10']):
     
-    df = pd.read_csv(src)       # Read csv file into Dataframe
-    if parse_na:                # If told to parse NA files, then it will here.
-        df = df[~df['TimeStamp'].isna()]                                                        # Remove rows where timestamp is na
-        df = df[~df['Battery'].isna()]                                                          # Remove battery rows - useless
-    df['unix_ms'] = df['TimeStamp'].apply(lambda x: int(timestamp_to_unix_milliseconds(x)))     # TimeStamp => Unix Milliseconds
+    # Read csv file into Dataframe, without the unused columns. If told to parse NA files, removes rows where the
+    # timestamp or battery is na. TimeStamp => Unix Milliseconds
+    df = load_eeg(src, parse_na=parse_na)
     if convert_log:             # If told to convert from log power to power, does that here
         orig_colnames = []
         new_colnames = []
@@ -57,7 +159,6 @@ def process_raw_eeg(
         col_rename_dict = {i:j for i,j in zip(new_colnames,orig_colnames)}
         df.drop(columns=orig_colnames, inplace=True)
         df.rename(columns=col_rename_dict, inplace=True)
-    df.drop(columns=['TimeStamp', 'RAW_TP9', 'RAW_AF7', 'RAW_AF8', 'RAW_TP10', 'AUX_RIGHT'], inplace=True)  # Drop unecessary remaining columns
     return df                   # Return dataframe
 
 # Given a Dataframe containing participants, filter out specific pedestrians
@@ -79,6 +180,7 @@ def merge_and_filter_participants(df, participants_df, participant_filter_list,
 
 # Given a Dataframe with participants' data already merged in, print out statistics
 def participant_stats(df, print_df:bool=True):
+    from IPython.display import display, Markdown
     # Ensure to condense all rows into singular rows
     df2 = df.groupby(['participant'], as_index=False).first()
 
@@ -1,5 +1,6 @@
 import numpy as np
 import os
+import time
 import cv2 as cv
 import easyocr
 import argparse
@@ -16,6 +17,14 @@ parser.add_argument('-thr', '--threshold',
                     help='The threshold value for OCR',
                     type=int,
                     default=100)
+parser.add_argument('-n', '--n_frames',
+                    help='If more than 1, also time OCR over this many consecutive frames from the timestamp, one at a time and in batches',
+                    type=int,
+                    default=1)
+parser.add_argument('-bs', '--batch_size',
+                    help='How many thresholded frames to send to EasyOCR at once when timing batches',
+                    type=int,
+                    default=16)
 args = parser.parse_args()
 
 _dir = os.path.dirname(args.source)
@@ -43,3 +52,32 @@ if len(screen_text) > 0:
 cv.imwrite(gry_filename, gry)
 cv.imwrite(thr_filename, thr)
 
+# Compare per-frame OCR against batched OCR over consecutive frames
+if args.n_frames > 1:
+    cam = cv.VideoCapture(args.source)
+    cam.set(cv.CAP_PROP_POS_MSEC, args.timestamp*1000)
+    thrs = []
+    while len(thrs) < args.n_frames:
+        success, frame = cam.read()
+        if not success:
+            break
+        frame_gry = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+        thrs.append(cv.threshold(frame_gry, args.threshold, 255, cv.THRESH_BINARY)[1])
+    cam.release()
+
+    start = time.perf_counter()
+    single = [reader.readtext(t) for t in thrs]
+    single_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = []
+    for i in range(0, len(thrs), args.batch_size):
+        batch = thrs[i:i+args.batch_size]
+        batched.extend(reader.readtext_batched(batch, batch_size=len(batch)))
+    batched_time = time.perf_counter() - start
+
+    first_text = lambda results: [r[0][1] if len(r) > 0 else None for r in results]
+    agreement = np.mean([a == b for a, b in zip(first_text(single), first_text(batched))])
+    print(f"Per-frame: {len(thrs)/single_time:.2f} fps")
+    print(f"Batches of {args.batch_size}: {len(thrs)/batched_time:.2f} fps")
+    print(f"Agreement: {agreement*100:.1f}%")